@@ -0,0 +1,44 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# python benchmarks/backends.py -c configs/my_config.yaml -m 10000 --repeats 3
+
+BACKENDS = ("rdf", "uproot")
+
+def time_conversion(config_paths, backend, max_events, repeats):
+    """Return the wall time of each conversion run with an input backend, or None if it fails."""
+    command = [
+        sys.executable, "-m", "r2h5.cli", "-c", *config_paths, "--backend", backend,
+        "-o", f"bench_{backend}", "-k",
+    ]
+    if max_events:
+        command += ["-m", str(max_events)]
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            return None
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the conversion time of the RDataFrame and uproot input backends")
+    parser.add_argument("--config", "-c", type=str, nargs="+", required=True, help="Config without cpp_helpers or rdf_defines")
+    parser.add_argument("--max-events-per-file", "-m", type=int, default=None, help="Maximum number of events per file")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of runs per backend")
+    args = parser.parse_args()
+
+    print(f"{'backend':<10s} {'median [s]':>10s} {'min [s]':>10s}")
+    for backend in BACKENDS:
+        times = time_conversion(args.config, backend, args.max_events_per_file, args.repeats)
+        if times is None:
+            print(f"{backend:<10s} {'failed':>10s}")
+            continue
+        print(f"{backend:<10s} {statistics.median(times):>10.3f} {min(times):>10.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import os
+import tempfile
+import time
+import h5py
+import numpy as np
+from r2h5 import read_fields
+from r2h5.converter import COLUMNAR_CHUNK_ROWS
+
+# python benchmarks/columnar_read.py --rows 100000 --max-objects 50 --fields 20
+
+def write_files(directory, n_rows, max_objects, n_fields):
+    """Write the same padded collection with the compound and the columnar layout."""
+    rng = np.random.default_rng(0)
+    dtype = [(f"field_{i}", np.float32) for i in range(n_fields)] + [("valid", bool)]
+    data = np.empty((n_rows, max_objects), dtype=dtype)
+    for field in data.dtype.names:
+        data[field] = rng.random((n_rows, max_objects)) if field != "valid" else True
+    compound_file = os.path.join(directory, "compound.h5")
+    columnar_file = os.path.join(directory, "columnar.h5")
+    with h5py.File(compound_file, "w") as h5f:
+        h5f.create_dataset("cells", data=data)
+    with h5py.File(columnar_file, "w") as h5f:
+        group = h5f.create_group("cells", track_order=True)
+        for field in data.dtype.names:
+            group.create_dataset(field, data=data[field], chunks=(min(COLUMNAR_CHUNK_ROWS, n_rows), max_objects))
+    return compound_file, columnar_file
+
+def time_read(file_name, fields, repeats):
+    """Return the best wall time of reading some fields of the whole collection."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with h5py.File(file_name, "r") as h5f:
+            read_fields(h5f, "cells", fields)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare reading one field of a collection with the compound and columnar layouts")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of rows")
+    parser.add_argument("--max-objects", type=int, default=50, help="Number of objects per row")
+    parser.add_argument("--fields", type=int, default=20, help="Number of fields")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of reads per layout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        compound_file, columnar_file = write_files(directory, args.rows, args.max_objects, args.fields)
+        print(f"{'layout':<10s} {'one field [s]':>14s} {'all fields [s]':>15s}")
+        for layout, file_name in (("compound", compound_file), ("columnar", columnar_file)):
+            one = time_read(file_name, ["field_0"], args.repeats)
+            every = time_read(file_name, None, args.repeats)
+            print(f"{layout:<10s} {one:>14.3f} {every:>15.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# python benchmarks/import_time.py --repeats 5
+
+COMMANDS = {
+    "import r2h5": [sys.executable, "-c", "import r2h5"],
+    "import r2h5.cli": [sys.executable, "-c", "import r2h5.cli"],
+    "r2h5 --help": [sys.executable, "-m", "r2h5.cli", "--help"],
+    "import ROOT": [sys.executable, "-c", "import ROOT"],
+}
+
+def time_command(command, repeats):
+    """Return the wall time of each run of a command in a fresh interpreter."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            return None
+    return times
+
+def root_is_loaded_by_package():
+    """Check that importing the package and its CLI does not import ROOT."""
+    code = "import sys, r2h5, r2h5.cli; print('ROOT' in sys.modules or 'cppyy' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    return result.stdout.strip() == "True"
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import and startup time of r2h5")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of runs per command")
+    args = parser.parse_args()
+
+    print(f"{'command':<20s} {'median [s]':>10s} {'min [s]':>10s}")
+    for name, command in COMMANDS.items():
+        times = time_command(command, args.repeats)
+        if times is None:
+            print(f"{name:<20s} {'failed':>10s}")
+            continue
+        print(f"{name:<20s} {statistics.median(times):>10.3f} {min(times):>10.3f}")
+    print(f"ROOT loaded by 'import r2h5': {root_is_loaded_by_package()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# python benchmarks/postprocess_threads.py -c configs/my_config.yaml -m 10000 --threads 1 2 4 8 16 32
+
+def time_conversion(config_paths, threads, max_events, repeats):
+    """Return the wall time and conversion stage time of each run with a number of post-processing threads."""
+    times = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report_path = os.path.join(tmp_dir, "stage_report.json")
+        command = [
+            sys.executable, "-m", "r2h5.cli", "-c", *config_paths, "--postprocess-threads", str(threads),
+            "-o", f"bench_threads_{threads}", "-k", "--stage-report", report_path,
+        ]
+        if max_events:
+            command += ["-m", str(max_events)]
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wall = time.perf_counter() - start
+            if result.returncode != 0:
+                return None
+            with open(report_path) as f:
+                times.append((wall, json.load(f)["stage_times"].get("conversion", 0)))
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the speedup of ObjectCollection post-processing with the number of threads")
+    parser.add_argument("--config", "-c", type=str, nargs="+", required=True, help="Config with wide ObjectCollections")
+    parser.add_argument("--max-events-per-file", "-m", type=int, default=None, help="Maximum number of events per file")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8], help="Thread counts to compare")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of runs per thread count")
+    args = parser.parse_args()
+
+    print(f"{'threads':>8s} {'wall [s]':>10s} {'conversion [s]':>15s} {'speedup':>8s}")
+    reference = None
+    for threads in args.threads:
+        times = time_conversion(args.config, threads, args.max_events_per_file, args.repeats)
+        if times is None:
+            print(f"{threads:>8d} {'failed':>10s}")
+            continue
+        wall = statistics.median(t[0] for t in times)
+        conversion = statistics.median(t[1] for t in times)
+        # Speedup of the conversion stage, where the post-processing is done, relative to the first thread count
+        reference = reference or conversion
+        print(f"{threads:>8d} {wall:>10.3f} {conversion:>15.3f} {reference / max(conversion, 1e-9):>7.2f}x")
+
+if __name__ == "__main__":
+    main()
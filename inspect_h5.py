@@ -31,10 +31,20 @@ else:
     
     # Iterate over all keys in the file
     for key in h5_file.keys():
+        node = h5_file[key]
+        layout = node.attrs.get("layout", "")
         print("\n~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        print(f"~~~~~~ Key: [{key}] (size {len(h5_file[key])}) ~~~~~~~~")
-        # Use the format_dtype function to print dtype info nicely
-        print(format_dtype(h5_file[key].dtype))
+        if isinstance(node, h5py.Group):
+            # Columnar layout: one dataset per field, with the same number of rows
+            fields = list(node.keys())
+            size = len(node[fields[0]]) if fields else 0
+            print(f"~~~~~~ Key: [{key}] (size {size}, columnar{', ' + layout if layout else ''}) ~~~~~~~~")
+            for field in fields:
+                print(f"{field:20s} : {node[field].dtype}  chunks {node[field].chunks}")
+        else:
+            print(f"~~~~~~ Key: [{key}] (size {len(node)}{', ' + layout if layout else ''}) ~~~~~~~~")
+            # Use the format_dtype function to print dtype info nicely
+            print(format_dtype(node.dtype))
     
     # Don't forget to close the file when done
     h5_file.close()
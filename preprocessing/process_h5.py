@@ -7,6 +7,43 @@ from pathlib import Path
 from tqdm import tqdm
 
 # python process_h5.py --input-dir ./Vertex_timing_with_jets --output-dir ./selected_h5 --end-idx 0 --max-events 20 --cell-jet-delta-r 0.3
+# Compact output: python process_h5.py --input-dir ./Vertex_timing_with_jets --output-dir ./selected_h5 --precision float=float32 int=int8 --max-cells auto
+# Ragged output:  python process_h5.py --input-dir ./Vertex_timing_with_jets --output-dir ./selected_h5 --precision float=float32 int=int8 --layout ragged
+
+# Fields of the output cells dataset and their default dtypes
+CELL_FIELDS = {
+    'Cell_time': np.float64,
+    'valid': np.bool_,
+    'Cell_time_TOF_corrected': np.float64,
+    'Cell_e': np.float64,
+    'Cell_x': np.float64,
+    'Cell_y': np.float64,
+    'Cell_z': np.float64,
+    'Cell_eta': np.float64,
+    'Cell_phi': np.float64,
+    'Cell_Barrel': np.int32,
+    'Cell_layer': np.int32,
+    'Cell_significance': np.float64,
+    'Sig_above_4_celle_above_1GeV': np.int32,
+    'matched_track_HS': np.int32,
+    'matched_track_pt': np.float64,
+    'matched_track_deltaR': np.float64,
+    'cell_jet_matched': np.bool_,
+    'matched_jet_pt': np.float64,
+    'matched_jet_eta': np.float64,
+    'matched_jet_phi': np.float64,
+    'matched_jet_width': np.float64,
+    'matched_jet_deltaR': np.float64,
+}
+# Output fields copied as they are from the input cells
+COPIED_FIELDS = [
+    'Cell_time', 'valid', 'Cell_time_TOF_corrected', 'Cell_e', 'Cell_x', 'Cell_y', 'Cell_z',
+    'Cell_eta', 'Cell_phi', 'Cell_layer', 'Cell_significance', 'Sig_above_4_celle_above_1GeV',
+]
+TRACK_MATCH_FIELDS = ['matched_track_HS', 'matched_track_pt', 'matched_track_deltaR']
+JET_MATCH_FIELDS = ['cell_jet_matched', 'matched_jet_pt', 'matched_jet_eta', 'matched_jet_phi', 'matched_jet_width', 'matched_jet_deltaR']
+# Output dtypes that can be set with --precision
+PRECISIONS = ['float16', 'float32', 'float64', 'int8', 'int16', 'int32', 'int64', 'uint8', 'bool']
 
 def compute_distance(x1, y1, z1, x2, y2, z2):
     return np.sqrt((x1-x2)**2 + (y1-y2)**2 + (z1-z2)**2)
@@ -126,11 +163,140 @@ def match_cell_to_jet(cell_eta, cell_phi, jet_data, jet_valid_mask, deltaRThresh
             -999.0   # matched_jet_deltaR
         )
 
-def process_h5_file(input_file, output_file, max_events=None, cell_jet_deltaR_threshold=0.3):
+def parse_precision(entries):
+    """Parse FIELD=DTYPE entries, FIELD can also be float or int to set every field of that kind."""
+    precision = {}
+    for entry in entries or []:
+        field, _, dtype = entry.partition('=')
+        if field not in CELL_FIELDS and field not in ('float', 'int'):
+            raise ValueError(f"Unknown field {field} in --precision {entry}")
+        if dtype not in PRECISIONS:
+            raise ValueError(f"Unsupported dtype {dtype} in --precision {entry}, use one of {', '.join(PRECISIONS)}")
+        precision[field] = np.dtype(dtype)
+    return precision
+
+def cells_output_dtype(fields, precision):
+    """Build the cells dtype, a field takes its own precision, then the one of its kind, then its default."""
+    dtype = []
+    for field in fields:
+        default = np.dtype(CELL_FIELDS[field])
+        kind = {'f': 'float', 'i': 'int'}.get(default.kind)
+        dtype.append((field, precision.get(field, precision.get(kind, default))))
+    return np.dtype(dtype)
+
+def count_selected_cells(cells, event_indices, chunk_events):
+    """Number of selected cells of each event, reading only the two fields of the selection."""
+    counts = np.zeros(len(event_indices), dtype=np.int64)
+    selection = cells.fields(['valid', 'Sig_above_4_celle_above_1GeV'])
+    for start in range(0, len(event_indices), chunk_events):
+        chunk = selection[event_indices[start:start + chunk_events]]
+        counts[start:start + len(chunk)] = ((chunk['valid'] == True) & (chunk['Sig_above_4_celle_above_1GeV'] == 1)).sum(axis=1)
+    return counts
+
+def process_event_cells(cells, event_tracks, event_jets, fields, cell_jet_deltaR_threshold):
+    """Return the values of the output fields for the selected cells of one event, in their default dtypes."""
+    values = {field: cells[field] for field in COPIED_FIELDS if field in fields}
+    is_barrel = cells['Cell_isEM_Barrel'] == 1
+    values['Cell_Barrel'] = is_barrel.astype(np.int32)
+
+    # Matching loops over the tracks and jets of each cell, it is only done for the fields written
+    if any(field in fields for field in TRACK_MATCH_FIELDS):
+        valid_tracks_mask = (event_tracks['valid'] == True) & (event_tracks['Track_isGoodFromHS_old_files'] == 1)
+        matches = [
+            match_track_to_cell(cell['Cell_eta'], cell['Cell_phi'], barrel, cell['Cell_layer'], event_tracks, valid_tracks_mask)
+            for cell, barrel in zip(cells, is_barrel)
+        ]
+        for field, column in zip(TRACK_MATCH_FIELDS, zip(*matches)):
+            values[field] = np.array(column, dtype=CELL_FIELDS[field])
+
+    if any(field in fields for field in JET_MATCH_FIELDS):
+        valid_jets_mask = (event_jets['valid'] == True)
+        matches = [
+            match_cell_to_jet(cell['Cell_eta'], cell['Cell_phi'], event_jets, valid_jets_mask, deltaRThreshold=cell_jet_deltaR_threshold)
+            for cell in cells
+        ]
+        for field, column in zip(JET_MATCH_FIELDS, zip(*matches)):
+            values[field] = np.array(column, dtype=CELL_FIELDS[field])
+    return values
+
+def copy_events(dataset, f_out, name, event_indices, chunk_events):
+    """Copy the rows of the selected events of a dataset, one chunk of events at a time."""
+    out = f_out.create_dataset(name, shape=(len(event_indices),) + dataset.shape[1:], dtype=dataset.dtype, compression="gzip", compression_opts=9)
+    for start in range(0, len(event_indices), chunk_events):
+        out[start:start + chunk_events] = dataset[event_indices[start:start + chunk_events]]
+
+def print_statistics(valid_cell_counts, matched_hs_cell_counts, matched_jet_cell_counts, matched_jet_pts, matched_jet_deltaRs):
+    n_events = len(valid_cell_counts)
+    events_with_cells_mask = valid_cell_counts > 0
+    events_with_cells_count = np.sum(events_with_cells_mask)
+
+    print(f"Max cells per event: {np.max(valid_cell_counts)}")
+    print(f"Min cells per event (of events with cells): {np.min(valid_cell_counts[events_with_cells_mask]) if events_with_cells_count > 0 else 0}")
+
+    # Track matching statistics
+    events_with_matched_hs_cells_mask = matched_hs_cell_counts > 0
+    events_with_matched_hs_cells_count = np.sum(events_with_matched_hs_cells_mask)
+
+    if events_with_matched_hs_cells_count > 0:
+        max_matched_hs_cells = np.max(matched_hs_cell_counts)
+        min_matched_hs_cells = np.min(matched_hs_cell_counts[events_with_matched_hs_cells_mask])
+        avg_matched_hs_cells = np.mean(matched_hs_cell_counts[events_with_matched_hs_cells_mask])
+
+        print(f"Events with HS-matched cells: {events_with_matched_hs_cells_count} out of {n_events} ({events_with_matched_hs_cells_count/n_events*100:.2f}%)")
+        print(f"Max HS-matched cells per event: {max_matched_hs_cells}")
+        print(f"Min HS-matched cells per event (of events with HS-matched cells): {min_matched_hs_cells}")
+        print(f"Avg HS-matched cells per event (of events with HS-matched cells): {avg_matched_hs_cells:.2f}")
 
+    # Jet matching statistics
+    events_with_matched_jet_cells_mask = matched_jet_cell_counts > 0
+    events_with_matched_jet_cells_count = np.sum(events_with_matched_jet_cells_mask)
+
+    if events_with_matched_jet_cells_count > 0:
+        max_matched_jet_cells = np.max(matched_jet_cell_counts)
+        min_matched_jet_cells = np.min(matched_jet_cell_counts[events_with_matched_jet_cells_mask])
+        avg_matched_jet_cells = np.mean(matched_jet_cell_counts[events_with_matched_jet_cells_mask])
+
+        print(f"Events with jet-matched cells: {events_with_matched_jet_cells_count} out of {n_events} ({events_with_matched_jet_cells_count/n_events*100:.2f}%)")
+        print(f"Max jet-matched cells per event: {max_matched_jet_cells}")
+        print(f"Min jet-matched cells per event (of events with jet-matched cells): {min_matched_jet_cells}")
+        print(f"Avg jet-matched cells per event (of events with jet-matched cells): {avg_matched_jet_cells:.2f}")
+
+        all_matched_jet_pts = np.concatenate(matched_jet_pts)
+        all_matched_jet_deltaRs = np.concatenate(matched_jet_deltaRs)
+        if len(all_matched_jet_pts):
+            print(f"Matched jet pt statistics:")
+            print(f"  Min: {np.min(all_matched_jet_pts):.2f} GeV")
+            print(f"  Max: {np.max(all_matched_jet_pts):.2f} GeV")
+            print(f"  Mean: {np.mean(all_matched_jet_pts):.2f} GeV")
+            print(f"  Median: {np.median(all_matched_jet_pts):.2f} GeV")
+
+            print(f"Matched jet deltaR statistics:")
+            print(f"  Min: {np.min(all_matched_jet_deltaRs):.5f}")
+            print(f"  Max: {np.max(all_matched_jet_deltaRs):.5f}")
+            print(f"  Mean: {np.mean(all_matched_jet_deltaRs):.5f}")
+            print(f"  Median: {np.median(all_matched_jet_deltaRs):.5f}")
+    else:
+        print("No events with jet-matched cells found.")
+
+def process_h5_file(input_file, output_file, max_events=None, cell_jet_deltaR_threshold=0.3,
+                    fields=None, precision=None, max_cells=1000, layout="padded", chunk_events=1000):
+    """Select the events and cells of an input file and add the track and jet matching of each cell.
+
+    The cells are written chunk_events events at a time, either padded to max_cells per event
+    ("auto" for the largest number of selected cells of the file) with a valid mask, or ragged with
+    a cells_offsets dataset giving the cells of each event. fields selects the written cell fields
+    and precision maps fields, or the float and int kinds, to their output dtype.
+    """
     print(f"Processing {input_file} -> {output_file}")
     print(f"Cell-Jet deltaR threshold: {cell_jet_deltaR_threshold}")
-    
+    fields = list(fields or CELL_FIELDS)
+    if layout == "padded" and 'valid' not in fields:
+        fields.insert(0, 'valid')
+    elif layout == "ragged" and 'valid' in fields:
+        # Every stored cell is valid, the mask is rebuilt from the offsets when loading
+        fields.remove('valid')
+    cells_dtype = cells_output_dtype(fields, precision or {})
+
     with h5py.File(input_file, 'r') as f_in:
         hs_vertex = f_in['HSvertex'][:]
         
@@ -150,13 +316,20 @@ def process_h5_file(input_file, output_file, max_events=None, cell_jet_deltaR_th
         if len(valid_event_indices) == 0:
             print("No valid events found. Skipping file.")
             return
-        
-        cells_data = f_in['cells'][valid_event_indices]
-        tracks_data = f_in['tracks'][valid_event_indices]
-        jets_data = f_in['jets'][valid_event_indices]  # Read jets data
-        
-        with h5py.File(output_file, 'w') as f_out:
 
+        # The number of selected cells of each event sizes the output before any cell is processed
+        valid_cell_counts = count_selected_cells(f_in['cells'], valid_event_indices, chunk_events)
+        if max_cells == "auto":
+            max_cells = max(int(valid_cell_counts.max()), 1)
+            print(f"Padding cells to the largest number of selected cells per event: {max_cells}")
+        stored_counts = valid_cell_counts if layout == "ragged" else np.minimum(valid_cell_counts, max_cells)
+        if layout == "padded" and (valid_cell_counts > max_cells).any():
+            print(f"Warning: {np.sum(valid_cell_counts > max_cells)} events have more than {max_cells} selected cells, "
+                  f"dropping {np.sum(valid_cell_counts - stored_counts)} cells")
+        offsets = np.zeros(len(stored_counts) + 1, dtype=np.int64)
+        np.cumsum(stored_counts, out=offsets[1:])
+
+        with h5py.File(output_file, 'w') as f_out:
             hs_vertex_dtype = np.dtype([
                 ('HSvertex_time', np.float32),
                 ('HSvertex_reco_x', np.float32),
@@ -165,211 +338,75 @@ def process_h5_file(input_file, output_file, max_events=None, cell_jet_deltaR_th
                 ('eventNumber', np.int32)
             ])
             hs_vertex_out = np.empty(len(valid_event_indices), dtype=hs_vertex_dtype)
-            
-            for i, idx in enumerate(valid_event_indices):
-                hs_vertex_out[i]['HSvertex_time'] = hs_vertex[idx]['HSvertex_time']
-                hs_vertex_out[i]['HSvertex_reco_x'] = hs_vertex[idx]['HSvertex_reco_x']
-                hs_vertex_out[i]['HSvertex_reco_y'] = hs_vertex[idx]['HSvertex_reco_y']
-                hs_vertex_out[i]['HSvertex_reco_z'] = hs_vertex[idx]['HSvertex_reco_z']
-                hs_vertex_out[i]['eventNumber'] = hs_vertex[idx]['eventNumber']
-            
+            for field in hs_vertex_dtype.names:
+                hs_vertex_out[field] = hs_vertex[field][valid_event_indices]
             f_out.create_dataset('HSvertex', data=hs_vertex_out)
-            
-            # Enhanced cell dtype with jet matching information
-            cells_dtype = np.dtype([
-                ('Cell_time', np.float64),
-                ('valid', np.bool_),
-                ('Cell_time_TOF_corrected', np.float64),
-                ('Cell_e', np.float64),
-                ('Cell_x', np.float64),
-                ('Cell_y', np.float64),
-                ('Cell_z', np.float64),
-                ('Cell_eta', np.float64),
-                ('Cell_phi', np.float64),
-                ('Cell_Barrel', np.int32),   
-                ('Cell_layer', np.int32),  
-                ('Cell_significance', np.float64),
-                ('Sig_above_4_celle_above_1GeV', np.int32),
-                ('matched_track_HS', np.int32),
-                ('matched_track_pt', np.float64),
-                ('matched_track_deltaR', np.float64),
-                # New jet matching fields
-                ('cell_jet_matched', np.bool_),
-                ('matched_jet_pt', np.float64),
-                ('matched_jet_eta', np.float64),
-                ('matched_jet_phi', np.float64),
-                ('matched_jet_width', np.float64),
-                ('matched_jet_deltaR', np.float64)
-            ])
-            
-            processed_cells = np.zeros((len(valid_event_indices), 1000), dtype=cells_dtype)
 
-            valid_cell_counts = np.zeros(len(valid_event_indices), dtype=np.int32)
+            cells_shape = (len(valid_event_indices), max_cells) if layout == "padded" else (int(offsets[-1]),)
+            cells_out = f_out.create_dataset('cells', shape=cells_shape, dtype=cells_dtype, chunks=True, compression="gzip", compression_opts=9)
+            if layout == "ragged":
+                f_out.create_dataset('cells_offsets', data=offsets)
+                cells_out.attrs['offsets'] = 'cells_offsets'
+                cells_out.attrs['layout'] = 'ragged'
+
             matched_hs_cell_counts = np.zeros(len(valid_event_indices), dtype=np.int32)
             matched_jet_cell_counts = np.zeros(len(valid_event_indices), dtype=np.int32)
-            
+            matched_jet_pts, matched_jet_deltaRs = [], []
+            # Integer and bool outputs narrower than their default must hold every value exactly
+            checked_fields = [field for field in fields if cells_dtype[field].kind != 'f' and cells_dtype[field] != CELL_FIELDS[field]]
+            lossy_fields = set()
 
-            for event_idx, global_event_idx in enumerate(tqdm(valid_event_indices, desc="Processing events")):
-                event_cells = cells_data[event_idx]
-                event_tracks = tracks_data[event_idx]
-                event_jets = jets_data[event_idx]
-                
-                valid_cells_mask = (event_cells['valid'] == True) & (event_cells['Sig_above_4_celle_above_1GeV'] == 1)
-                valid_cells = event_cells[valid_cells_mask]
-                
-                if len(valid_cells) == 0:
-                    continue
-                
-                valid_cell_counts[event_idx] = len(valid_cells)
-                valid_tracks_mask = (event_tracks['valid'] == True) & (event_tracks['Track_isGoodFromHS_old_files'] == 1)
-                valid_jets_mask = (event_jets['valid'] == True)  # Get valid jets for this event
-
-                matched_hs_count = 0
-                matched_jet_count = 0
-                
-                for i, cell in enumerate(valid_cells):
-                    if i >= 1000:
-                        break
-                        
-                    # Copy existing cell data
-                    processed_cells[event_idx, i]['Cell_time'] = cell['Cell_time']
-                    processed_cells[event_idx, i]['valid'] = cell['valid']
-                    processed_cells[event_idx, i]['Cell_time_TOF_corrected'] = cell['Cell_time_TOF_corrected']
-                    processed_cells[event_idx, i]['Cell_e'] = cell['Cell_e']
-                    processed_cells[event_idx, i]['Cell_x'] = cell['Cell_x']
-                    processed_cells[event_idx, i]['Cell_y'] = cell['Cell_y']
-                    processed_cells[event_idx, i]['Cell_z'] = cell['Cell_z']
-                    processed_cells[event_idx, i]['Cell_eta'] = cell['Cell_eta']
-                    processed_cells[event_idx, i]['Cell_phi'] = cell['Cell_phi']
-                    processed_cells[event_idx, i]['Cell_significance'] = cell['Cell_significance']
-                    processed_cells[event_idx, i]['Sig_above_4_celle_above_1GeV'] = cell['Sig_above_4_celle_above_1GeV']
-                    
-                    is_barrel = (cell['Cell_isEM_Barrel'] == 1)
-                    processed_cells[event_idx, i]['Cell_Barrel'] = 1 if is_barrel else 0
-                    processed_cells[event_idx, i]['Cell_layer'] = cell['Cell_layer']
-                    
-                    # Track matching (existing functionality)
-                    matched_hs, matched_pt, matched_deltaR = match_track_to_cell(
-                        cell['Cell_eta'], cell['Cell_phi'], 
-                        is_barrel,
-                        processed_cells[event_idx, i]['Cell_layer'],
-                        event_tracks, valid_tracks_mask
-                    )
-                    
-                    processed_cells[event_idx, i]['matched_track_HS'] = matched_hs
-                    processed_cells[event_idx, i]['matched_track_pt'] = matched_pt
-                    processed_cells[event_idx, i]['matched_track_deltaR'] = matched_deltaR
-
-                    if matched_hs == 1:
-                        matched_hs_count += 1
-                        
-                    # Jet matching (new functionality)
-                    (is_jet_matched, jet_pt, jet_eta, jet_phi, jet_width, jet_deltaR) = match_cell_to_jet(
-                        cell['Cell_eta'], cell['Cell_phi'],
-                        event_jets, valid_jets_mask,
-                        deltaRThreshold=cell_jet_deltaR_threshold
-                    )
-                    
-                    processed_cells[event_idx, i]['cell_jet_matched'] = is_jet_matched
-                    processed_cells[event_idx, i]['matched_jet_pt'] = jet_pt
-                    processed_cells[event_idx, i]['matched_jet_eta'] = jet_eta
-                    processed_cells[event_idx, i]['matched_jet_phi'] = jet_phi
-                    processed_cells[event_idx, i]['matched_jet_width'] = jet_width
-                    processed_cells[event_idx, i]['matched_jet_deltaR'] = jet_deltaR
-                    
-                    if is_jet_matched:
-                        matched_jet_count += 1
-                        
-                matched_hs_cell_counts[event_idx] = matched_hs_count
-                matched_jet_cell_counts[event_idx] = matched_jet_count
-            
-            f_out.create_dataset(
-                'cells', 
-                data=processed_cells,
-                compression="gzip", 
-                compression_opts=9
-            )
-
-            events_with_cells_mask = valid_cell_counts > 0
-            events_with_cells_count = np.sum(events_with_cells_mask)
-            
-            print(f"Saved cells data with shape {processed_cells.shape}")
-            print(f"Max cells per event: {np.max(valid_cell_counts)}")
-            print(f"Min cells per event (of events with cells): {np.min(valid_cell_counts[events_with_cells_mask]) if events_with_cells_count > 0 else 0}")
+            for start in tqdm(range(0, len(valid_event_indices), chunk_events), desc="Processing event chunks"):
+                chunk_indices = valid_event_indices[start:start + chunk_events]
+                cells_data = f_in['cells'][chunk_indices]
+                tracks_data = f_in['tracks'][chunk_indices]
+                jets_data = f_in['jets'][chunk_indices]
+                if layout == "padded":
+                    processed_cells = np.zeros((len(chunk_indices), max_cells), dtype=cells_dtype)
+                else:
+                    processed_cells = np.zeros(offsets[start + len(chunk_indices)] - offsets[start], dtype=cells_dtype)
+
+                for event_idx in range(len(chunk_indices)):
+                    event_cells = cells_data[event_idx]
+                    valid_cells_mask = (event_cells['valid'] == True) & (event_cells['Sig_above_4_celle_above_1GeV'] == 1)
+                    n_cells = stored_counts[start + event_idx]
+                    if n_cells == 0:
+                        continue
+                    valid_cells = event_cells[valid_cells_mask][:n_cells]
+                    values = process_event_cells(valid_cells, tracks_data[event_idx], jets_data[event_idx], fields, cell_jet_deltaR_threshold)
+
+                    if layout == "padded":
+                        target = processed_cells[event_idx, :n_cells]
+                    else:
+                        row = offsets[start + event_idx] - offsets[start]
+                        target = processed_cells[row:row + n_cells]
+                    for field in fields:
+                        target[field] = values[field]
+                    lossy_fields.update(field for field in checked_fields if not np.array_equal(target[field], values[field]))
+
+                    if 'matched_track_HS' in values:
+                        matched_hs_cell_counts[start + event_idx] = np.sum(values['matched_track_HS'] == 1)
+                    if 'cell_jet_matched' in values:
+                        jet_matched = values['cell_jet_matched']
+                        matched_jet_cell_counts[start + event_idx] = np.sum(jet_matched)
+                        matched_jet_pts.append(values['matched_jet_pt'][jet_matched])
+                        matched_jet_deltaRs.append(values['matched_jet_deltaR'][jet_matched])
+
+                if layout == "padded":
+                    cells_out[start:start + len(chunk_indices)] = processed_cells
+                else:
+                    cells_out[offsets[start]:offsets[start + len(chunk_indices)]] = processed_cells
+                del processed_cells, cells_data, tracks_data, jets_data
+
+            for field in sorted(lossy_fields):
+                print(f"Warning: values of {field} do not fit in {cells_dtype[field]}, choose a wider --precision for it")
+            print(f"Saved cells data with shape {cells_out.shape} and {cells_dtype.itemsize} bytes per cell")
+            print_statistics(valid_cell_counts, matched_hs_cell_counts, matched_jet_cell_counts, matched_jet_pts, matched_jet_deltaRs)
 
-            # Track matching statistics
-            events_with_matched_hs_cells_mask = matched_hs_cell_counts > 0
-            events_with_matched_hs_cells_count = np.sum(events_with_matched_hs_cells_mask)
-            
-            if events_with_matched_hs_cells_count > 0:
-                max_matched_hs_cells = np.max(matched_hs_cell_counts)
-                min_matched_hs_cells = np.min(matched_hs_cell_counts[events_with_matched_hs_cells_mask])
-                avg_matched_hs_cells = np.mean(matched_hs_cell_counts[events_with_matched_hs_cells_mask])
-                
-                print(f"Events with HS-matched cells: {events_with_matched_hs_cells_count} out of {len(valid_event_indices)} ({events_with_matched_hs_cells_count/len(valid_event_indices)*100:.2f}%)")
-                print(f"Max HS-matched cells per event: {max_matched_hs_cells}")
-                print(f"Min HS-matched cells per event (of events with HS-matched cells): {min_matched_hs_cells}")
-                print(f"Avg HS-matched cells per event (of events with HS-matched cells): {avg_matched_hs_cells:.2f}")
-            
-            # Jet matching statistics
-            events_with_matched_jet_cells_mask = matched_jet_cell_counts > 0
-            events_with_matched_jet_cells_count = np.sum(events_with_matched_jet_cells_mask)
-            
-            if events_with_matched_jet_cells_count > 0:
-                max_matched_jet_cells = np.max(matched_jet_cell_counts)
-                min_matched_jet_cells = np.min(matched_jet_cell_counts[events_with_matched_jet_cells_mask])
-                avg_matched_jet_cells = np.mean(matched_jet_cell_counts[events_with_matched_jet_cells_mask])
-                
-                print(f"Events with jet-matched cells: {events_with_matched_jet_cells_count} out of {len(valid_event_indices)} ({events_with_matched_jet_cells_count/len(valid_event_indices)*100:.2f}%)")
-                print(f"Max jet-matched cells per event: {max_matched_jet_cells}")
-                print(f"Min jet-matched cells per event (of events with jet-matched cells): {min_matched_jet_cells}")
-                print(f"Avg jet-matched cells per event (of events with jet-matched cells): {avg_matched_jet_cells:.2f}")
-                
-                # Collect all jet matching statistics
-                all_matched_jet_pts = []
-                all_matched_jet_deltaRs = []
-                for event_idx in range(len(valid_event_indices)):
-                    valid_cell_count = valid_cell_counts[event_idx]
-                    if valid_cell_count > 0:
-                        for i in range(valid_cell_count):
-                            if processed_cells[event_idx, i]['cell_jet_matched']:
-                                all_matched_jet_pts.append(processed_cells[event_idx, i]['matched_jet_pt'])
-                                all_matched_jet_deltaRs.append(processed_cells[event_idx, i]['matched_jet_deltaR'])
-                
-                if all_matched_jet_pts:
-                    all_matched_jet_pts = np.array(all_matched_jet_pts)
-                    all_matched_jet_deltaRs = np.array(all_matched_jet_deltaRs)
-                    
-                    print(f"Matched jet pt statistics:")
-                    print(f"  Min: {np.min(all_matched_jet_pts):.2f} GeV")
-                    print(f"  Max: {np.max(all_matched_jet_pts):.2f} GeV")
-                    print(f"  Mean: {np.mean(all_matched_jet_pts):.2f} GeV")
-                    print(f"  Median: {np.median(all_matched_jet_pts):.2f} GeV")
-                    
-                    print(f"Matched jet deltaR statistics:")
-                    print(f"  Min: {np.min(all_matched_jet_deltaRs):.5f}")
-                    print(f"  Max: {np.max(all_matched_jet_deltaRs):.5f}")
-                    print(f"  Mean: {np.mean(all_matched_jet_deltaRs):.5f}")
-                    print(f"  Median: {np.median(all_matched_jet_deltaRs):.5f}")
-            else:
-                print("No events with jet-matched cells found.")
-            
             # Save tracks and jets data as well
-            f_out.create_dataset(
-                'tracks', 
-                data=tracks_data,
-                compression="gzip", 
-                compression_opts=9
-            )
-            
-            f_out.create_dataset(
-                'jets', 
-                data=jets_data,
-                compression="gzip", 
-                compression_opts=9
-            )
-            
-            print(f"Saved {len(tracks_data)} tracks and {len(jets_data)} jets for valid events")
+            copy_events(f_in['tracks'], f_out, 'tracks', valid_event_indices, chunk_events)
+            copy_events(f_in['jets'], f_out, 'jets', valid_event_indices, chunk_events)
+            print(f"Saved {len(valid_event_indices)} tracks and {len(valid_event_indices)} jets for valid events")
 
 def main():
 
@@ -381,7 +418,15 @@ def main():
     parser.add_argument('--end-idx', type=int, default=49, help='Ending file index (inclusive, default: 49)')
     parser.add_argument('--max-events', type=int, default=None, help='Maximum number of events to process per file (default: all)')
     parser.add_argument('--cell-jet-delta-r', type=float, default=0.3, help='DeltaR threshold for cell-jet matching (default: 0.3)')
+    parser.add_argument('--fields', type=str, nargs='+', default=None, choices=list(CELL_FIELDS), metavar='FIELD', help='Cell fields to write (default: all)')
+    parser.add_argument('--precision', type=str, nargs='+', default=None, metavar='FIELD=DTYPE',
+                        help='Output dtype of cell fields, FIELD can be float or int for all fields of that kind, e.g. float=float32 int=int8 valid=bool (default: float64 and int32)')
+    parser.add_argument('--max-cells', type=str, default='1000', help='Cells stored per event in the padded layout, or auto for the largest number of selected cells of each file (default: 1000)')
+    parser.add_argument('--layout', type=str, choices=['padded', 'ragged'], default='padded', help='padded cells with a valid mask, or ragged cells with cells_offsets (default: padded)')
+    parser.add_argument('--chunk-events', type=int, default=1000, help='Events processed and written at a time (default: 1000)')
     args = parser.parse_args()
+    precision = parse_precision(args.precision)
+    max_cells = args.max_cells if args.max_cells == 'auto' else int(args.max_cells)
     
     output_dir = Path(args.output_dir)
     output_dir.mkdir(exist_ok=True, parents=True)
@@ -394,7 +439,8 @@ def main():
         
         if input_file.exists():
             try:
-                process_h5_file(input_file, output_file, args.max_events, args.cell_jet_delta_r)
+                process_h5_file(input_file, output_file, args.max_events, args.cell_jet_delta_r,
+                                args.fields, precision, max_cells, args.layout, args.chunk_events)
                 print(f"Completed: {output_file}")
             except Exception as e:
                 print(f"Error processing {input_file}: {e}")
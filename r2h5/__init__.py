@@ -32,7 +32,8 @@ def setup_logging(level=logging.INFO):
 from .config_parser import load_yaml_config
 from .converter import DatasetConverter
 from .batch import get_slurm_script
-from .type import get_dtype, convert_rvec_to_numpy, fix_array_size, fix_array_size_and_create_valid
+from .type import get_dtype, convert_rvec_to_numpy, fix_array_size, fix_array_size_and_create_valid, build_offsets, build_event_index, flatten_arrays, select_jagged, gather_jagged, pad_indices, pad_jagged
+from .reader import read_fields, count_rows, get_event_slice, get_event_rows, gather_linked, load_padded
 from .rdf_defines import super_ntuples
 
 # Save absolute path of the package (this file up 1 directory)
@@ -12,6 +12,8 @@ def get_slurm_script(
         partition="roma",
         account="atlas:usatlas",
         cpu_count=1,
+        status_file=None,
+        add_fields=False,
     ):
     """Return a Slurm script for batch processing."""
     slurm_script = f"""#!/bin/bash
@@ -36,6 +38,6 @@ source /sdf/group/fermi/sw/conda/bin/activate fermitools-2.4.0
 conda activate r2h5
 echo "r2h5 got activated!"
 pwd
-r2h5 -c {config_path} -i {file_name} --file-index-offset {file_index_offset} {"--debug" if debug else ""}
+r2h5 -c {config_path} -i {file_name} --file-index-offset {file_index_offset} --postprocess-threads {cpu_count} {f"--status-file {status_file}" if status_file else ""} {"--add-fields" if add_fields else ""} {"--debug" if debug else ""}
 """
     return slurm_script
\ No newline at end of file
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import h5py
+from r2h5.sharding import append_block, dataset_event_offsets, dataset_sizes, finish_appended, read_events, storage_layout
+
+def entry_ranges(n_entries, checkpoint_events):
+    """Split the entries of an input file into consecutive (start, stop) blocks of checkpoint_events entries."""
+    return [(start, min(n_entries, start + checkpoint_events)) for start in range(0, n_entries, checkpoint_events)]
+
+def parts_path(output_file_name):
+    """Folder holding the committed blocks of an output file and its progress record."""
+    return f"{output_file_name}.parts"
+
+def part_file(output_file_name, i_block):
+    return os.path.join(parts_path(output_file_name), f"block_{i_block:05}.h5")
+
+def has_progress(output_file_name):
+    return os.path.exists(os.path.join(parts_path(output_file_name), "progress.json"))
+
+def discard(output_file_name):
+    """Remove the committed blocks and progress record of an output file."""
+    shutil.rmtree(parts_path(output_file_name), ignore_errors=True)
+
+def config_digest(config):
+    """Digest of the Objects and ObjectCollections of an output config, which the committed blocks are written with."""
+    collections = {}
+    for name, objcol_config in config.get("ObjectCollections", {}).items():
+        # The converter adds the selection to the branches of a collection, with or without it the schema is the same
+        objcol_config = dict(objcol_config, branches=list(objcol_config["branches"]))
+        selection = objcol_config.get("selection")
+        if selection and selection not in objcol_config["branches"] and selection not in objcol_config.get("derived", {}):
+            objcol_config["branches"].append(selection)
+        collections[name] = objcol_config
+    schema = {"Objects": config.get("Objects", {}), "ObjectCollections": collections}
+    return hashlib.sha256(json.dumps(schema, sort_keys=True, default=str).encode()).hexdigest()
+
+def committed_blocks(output_file_name, source_file, ranges, config):
+    """Number of leading blocks already committed for an output file of source_file split into ranges.
+
+    A progress record written for another input file, other entry ranges or another output config
+    is discarded.
+    """
+    progress_file = os.path.join(parts_path(output_file_name), "progress.json")
+    if not os.path.exists(progress_file):
+        return 0
+    with open(progress_file) as f:
+        progress = json.load(f)
+    if progress["input_file"] != source_file or [tuple(r) for r in progress["entry_ranges"]] != list(ranges) \
+            or progress.get("config") != config_digest(config):
+        logging.warning(f"Progress record {progress_file} was written for another input, block size or config, starting over")
+        discard(output_file_name)
+        return 0
+    n_committed = 0
+    for i_block in range(progress["committed"]):
+        if not os.path.exists(part_file(output_file_name, i_block)):
+            break
+        n_committed += 1
+    return n_committed
+
+def commit_block(output_file_name, source_file, ranges, i_block, config):
+    """Move the finished block into place and record it, a block is either fully committed or not at all."""
+    block_file = part_file(output_file_name, i_block)
+    os.replace(f"{block_file}.tmp", block_file)
+    progress_file = os.path.join(parts_path(output_file_name), "progress.json")
+    with open(f"{progress_file}.tmp", "w") as f:
+        progress = {"input_file": source_file, "entry_ranges": ranges, "committed": i_block + 1, "config": config_digest(config)}
+        json.dump(progress, f, indent=2)
+    os.replace(f"{progress_file}.tmp", progress_file)
+
+def merge_blocks(output_file_name, config, source_file, n_blocks, chunk_rows=None):
+    """Write the committed blocks one at a time into the output file and remove them.
+
+    Only one block is held in memory. The datasets are created with their final sizes and the
+    layout of a conversion in one go, the offsets are shifted as the blocks are written and the
+    eventNumber indices are built over the whole file, so the output is the same as the one of a
+    conversion of the file in one go. chunk_rows is the default chunking of the columnar layout.
+    """
+    logging.info(f"Merging {n_blocks} committed blocks into {output_file_name}")
+    sizes = {}
+    for i_block in range(n_blocks):
+        with h5py.File(part_file(output_file_name, i_block), "r") as h5f:
+            dataset_sizes(h5f, config, sizes)
+            if i_block == 0:
+                columnar = [name for name in sizes if storage_layout(h5f[name])["columnar"]]
+    # Blocks with fewer rows than a chunk were written with smaller chunks, the config gives the chunking
+    object_configs = {**config.get("Objects", {}), **config.get("ObjectCollections", {})}
+    chunk_rows = {name: object_configs.get(name, {}).get("chunk_rows", chunk_rows) for name in columnar} if n_blocks else {}
+    state = {}
+    with h5py.File(f"{output_file_name}.tmp", "w") as out:
+        out.attrs["source_file"] = source_file
+        for i_block in range(n_blocks):
+            with h5py.File(part_file(output_file_name, i_block), "r") as h5f:
+                n_events, offsets = dataset_event_offsets(h5f, config)
+                block = read_events(h5f, config, 0, n_events, offsets)
+            append_block(out, block, state, sizes, chunk_rows)
+            del block
+        finish_appended(out, state)
+    os.replace(f"{output_file_name}.tmp", output_file_name)
+    discard(output_file_name)
@@ -3,12 +3,12 @@
 import argparse
 import logging
 from r2h5 import setup_logging
-from r2h5.config_parser import load_yaml_config
+from r2h5.config_parser import load_yaml_configs
 from r2h5.converter import DatasetConverter
 
 def main():
     parser = argparse.ArgumentParser(description="Convert ROOT TTrees to HDF5")
-    parser.add_argument("--config", "-c", type=str, required=True, help="Path to YAML configuration file")
+    parser.add_argument("--config", "-c", type=str, nargs="+", required=True, help="Path to YAML configuration file(s), several configs sharing the same input are converted in a single pass")
     parser.add_argument("--n-threads", "-t", type=int, default=1, help="Number of threads to use")
     parser.add_argument("--output-subfolder", '-o', type=str, default=None, help="Subfolder name to save output files on top of the paths specified in the config")
     parser.add_argument("--input-file", "-i", type=str, default=None, help="Since input ROOT file that overrides the config, which can be used for batch running")
@@ -18,28 +18,88 @@ def main():
     parser.add_argument("--file-index-offset", type=int, default=0, help="Offset for file index in batch mode")
     parser.add_argument("--dry-run", action="store_true", help="Dry run batch submission or deleting incomplete files")
     parser.add_argument("--overwrite-existing-output-files", "-k", action="store_true", help="Overwrite existing output files")
+    parser.add_argument("--add-fields", action="store_true", help="Add the fields of the config missing from existing output files, reading only their branches")
     parser.add_argument("--delete-incomplete-output-files", "-d", action="store_true", help="Delete incomplete files")
-    parser.add_argument("--save-intermediate", "-s", action="store_true", help="Save intermediate ROOT files [CURRENTLY NOT IMPLEMENTED]")
+    parser.add_argument("--save-intermediate", "-s", action="store_true", help="Save the columns needed by the config to intermediate ROOT files, which are reused by later runs")
+    parser.add_argument("--profile-multiplicity", action="store_true", help="Report the multiplicity of each ObjectCollection and the truncation and size for candidate max_objects")
+    parser.add_argument("--truncation-target", type=float, default=0.01, help="Fraction of truncated rows used to recommend max_objects when profiling multiplicity")
+    parser.add_argument("--writer-queue-depth", type=int, default=2, help="Number of extracted blocks queued for the background H5 writer, 0 writes synchronously")
+    parser.add_argument("--postprocess-threads", type=int, default=1, help="Number of threads post-processing the branches of an ObjectCollection")
+    parser.add_argument("--checkpoint-events", type=int, default=None, help="Convert each input file in blocks of this many entries and resume from the last committed block, overrides input.checkpoint_events in the config")
+    parser.add_argument("--status-file", type=str, default=None, help="Periodically write the progress, throughput, memory and stage of the conversion to this JSON file")
+    parser.add_argument("--status-interval", type=float, default=30, help="Seconds between two progress updates")
+    parser.add_argument("--status", action="store_true", help="Print the combined progress of the batch jobs submitted with these configs")
+    parser.add_argument("--reshard", action="store_true", help="Rewrite the converted output files into shards following output.sharding in the config")
+    parser.add_argument("--split", action="store_true", help="Write shuffled train/val/test shards of the converted output files following output.split in the config")
+    parser.add_argument("--backend", choices=["auto", "rdf", "uproot"], default=None, help="Library used to read input files, overrides input.backend in the config")
+    parser.add_argument("--plan", action="store_true", help="Convert a few sample files to predict the runtime, memory and output size of each batch job, uses -m as the number of sample events")
+    parser.add_argument("--plan-files", type=int, default=10, help="Number of input files converted as samples by --plan")
+    parser.add_argument("--stage-report", type=str, default=None, help="Write the time and peak memory of each conversion stage to a JSON file")
+    parser.add_argument("--no-cpp-cache", action="store_true", help="JIT compile cpp_helpers instead of using the compiled library cache")
     args = parser.parse_args()
 
     # Load configuration and run converter
     setup_logging(logging.DEBUG if args.debug else logging.INFO)
-    config = load_yaml_config(
-        config_path = args.config, 
+    config = load_yaml_configs(
+        config_paths = args.config, 
         input_file = args.input_file,
         output_subfolder = args.output_subfolder
     )
-    converter = DatasetConverter(config, save_intermediate=args.save_intermediate, overwrite_existing_output_files=args.overwrite_existing_output_files)
+    converter = DatasetConverter(
+        config,
+        save_intermediate=args.save_intermediate,
+        overwrite_existing_output_files=args.overwrite_existing_output_files,
+        use_cpp_cache=not args.no_cpp_cache,
+        writer_queue_depth=args.writer_queue_depth,
+        backend=args.backend,
+        postprocess_threads=args.postprocess_threads,
+        checkpoint_events=args.checkpoint_events,
+        status_file=args.status_file,
+        status_interval=args.status_interval,
+        add_fields=args.add_fields,
+    )
     if args.delete_incomplete_output_files:
         converter.delete_incomplete_output_files(dry_run=args.dry_run)
         return
 
+    if args.status:
+        converter.production_status(args.config)
+        return
+
+    if args.reshard or args.split:
+        if args.reshard:
+            converter.reshard_outputs()
+        if args.split:
+            converter.split_outputs()
+        return
+
+    if args.plan:
+        converter.plan_batch(
+            args.config,
+            sample_events=args.max_events_per_file or 1000,
+            n_files=args.plan_files,
+            output_subfolder=args.output_subfolder,
+        )
+        return
+
+    if args.profile_multiplicity:
+        converter.format_ntuples(n_threads=args.n_threads, max_events_per_file=args.max_events_per_file)
+        converter.profile_multiplicity(truncation_target=args.truncation_target)
+        return
+
     # Run interactively or in batch mode
     if args.batch:
         converter.submit_batch(args.config, args.batch, dry_run=args.dry_run, debug=args.debug)
     else:
         converter.format_ntuples(n_threads=args.n_threads, max_events_per_file=args.max_events_per_file)
         converter.run(file_index_offset=args.file_index_offset)
+        if args.stage_report:
+            converter.write_stage_report(args.stage_report)
+        # Batch jobs convert a single input file, their outputs are resharded with --reshard and split
+        # with --split once all jobs are done
+        if not args.input_file:
+            converter.reshard_outputs()
+            converter.split_outputs()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
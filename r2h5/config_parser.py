@@ -1,4 +1,5 @@
 import yaml
+import logging
 import os, glob
 
 def load_yaml_config(config_path, input_file=None, output_subfolder=None):
@@ -8,7 +9,52 @@ def load_yaml_config(config_path, input_file=None, output_subfolder=None):
         # parse list of input files and prepare full output path
         config = format_paths(raw_config, input_file, output_subfolder)
         config = add_internal_settings(config)
-        return config 
+        return config
+
+def load_yaml_configs(config_paths, input_file=None, output_subfolder=None):
+    """Load one or several YAML configuration files sharing the same input."""
+    configs = [load_yaml_config(config_path, input_file, output_subfolder) for config_path in config_paths]
+    if len(configs) == 1:
+        return configs[0]
+    return merge_configs(configs)
+
+def get_output_configs(config):
+    """Return the configs of the outputs written from a single pass over the input.
+
+    Each of them holds the output path, Objects and ObjectCollections of one H5 output.
+    """
+    return config.get("outputs", [config])
+
+def merge_configs(configs):
+    """Combine configs reading the same input files into one config with several outputs."""
+    for config in configs[1:]:
+        if sorted(config["input"]["root_file_list"]) != sorted(configs[0]["input"]["root_file_list"]) \
+                or config["input"]["tree_name"] != configs[0]["input"]["tree_name"]:
+            logging.error("Configs processed together must have the same input files and tree name")
+            exit(1)
+        # Only the input and batch settings of the first config are used
+        for section in ("input", "batch"):
+            ignored = {
+                key for key in set(config.get(section, {})) | set(configs[0].get(section, {}))
+                if key != "root_file_list" and config.get(section, {}).get(key) != configs[0].get(section, {}).get(key)
+            }
+            if ignored:
+                logging.warning(f"Configs processed together differ in the {section} settings {', '.join(sorted(ignored))}, using those of the first config")
+    merged = {key: value for key, value in configs[0].items() if key not in ("outputs", "output", "Objects", "ObjectCollections")}
+    merged["cpp_helpers"] = list(dict.fromkeys(h for config in configs for h in config.get("cpp_helpers", [])))
+    merged["rdf_defines"] = list(dict.fromkeys(d for config in configs for d in config.get("rdf_defines", [])))
+    merged["output"] = configs[0]["output"]
+    merged["outputs"] = [output_config for config in configs for output_config in get_output_configs(config)]
+    check_output_paths(merged["outputs"])
+    return merged
+
+def check_output_paths(output_configs):
+    """Outputs written from the same pass must go to different folders, they all write output_XXX.h5."""
+    h5_paths = [os.path.normpath(output_config["output"]["h5_path"]) for output_config in output_configs]
+    duplicates = sorted({h5_path for h5_path in h5_paths if h5_paths.count(h5_path) > 1})
+    if duplicates:
+        logging.error(f"Several outputs are written to {', '.join(duplicates)}, give each output its own h5_path")
+        exit(1)
 
 def format_paths(config, input_file, output_subfolder):
     """Glob multiple files."""
@@ -22,18 +68,26 @@ def format_paths(config, input_file, output_subfolder):
         ))
     config['input'].pop('root_file')
 
-    config["output"]["h5_path"] = os.path.join(
-        config["output"].get("base_path",""), 
-        config["output"]["h5_path"],
-        output_subfolder if output_subfolder else ""
-    )
- 
+    for output_config in get_output_configs(config):
+        # Outputs listed in a single config inherit the base path of the top-level output section
+        base_path = output_config["output"].get("base_path", config.get("output", {}).get("base_path", ""))
+        output_config["output"]["h5_path"] = os.path.join(
+            base_path,
+            output_config["output"]["h5_path"],
+            output_subfolder if output_subfolder else ""
+        )
+    if "outputs" in config and "output" not in config:
+        config["output"] = config["outputs"][0]["output"]
+    if "outputs" in config:
+        check_output_paths(config["outputs"])
+
     return config
 
 def add_internal_settings(config):
-    for obj, obj_config in config["Objects"].items():
-        # Add internal settings to each object
-        for objcol, objcol_config in config["ObjectCollections"].items():
-            if "object_link" in objcol_config and objcol_config["object_link"]["object"] == obj:
-                obj_config["store_length"] = True
-    return config
\ No newline at end of file
+    for output_config in get_output_configs(config):
+        for obj, obj_config in output_config.get("Objects", {}).items():
+            # Add internal settings to each object
+            for objcol, objcol_config in output_config.get("ObjectCollections", {}).items():
+                if "object_link" in objcol_config and objcol_config["object_link"]["object"] == obj:
+                    obj_config["store_length"] = True
+    return config
@@ -1,134 +1,548 @@
 import h5py
 import numpy as np
-import ROOT
+import glob
+import hashlib
 import importlib
+import importlib.util
+import inspect
+import json
 import logging
 import os
-import cppyy
 import r2h5
+import shutil
 import subprocess
+import sys
+import tempfile
+import time
 import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+from r2h5 import checkpoint, cost_model, cpp_cache, derived, multiplicity, sharding, split
+from r2h5.status import StatusReporter, production_status
+from r2h5.config_parser import get_output_configs
+from r2h5.uproot_backend import UprootSource
+from r2h5.writer import BackgroundWriter
+
+# Default number of rows per chunk of the datasets of the columnar layout
+COLUMNAR_CHUNK_ROWS = 1024
+# Storage layouts of ObjectCollections, linked ones can also store each value once per event
+COLLECTION_LAYOUTS = ("padded", "ragged", "linked")
+# Events between two progress counts of each RDataFrame processing slot
+PROGRESS_EVENTS = 10000
+PROGRESS_CPP = """
+namespace r2h5_progress {
+std::atomic<ULong64_t> processed{0};
+ROOT::RDF::RResultPtr<ULong64_t> Book(ROOT::RDF::RNode df, ULong64_t every) {
+    processed = 0;
+    auto count = df.Count();
+    count.OnPartialResultSlot(every, [every](unsigned int, ULong64_t &) { processed += every; });
+    return count;
+}
+ULong64_t Run(ROOT::RDF::RResultPtr<ULong64_t> &count) { return *count; }
+ULong64_t Processed() { return processed.load(); }
+}
+"""
+
+class _DefinePlanRecorder:
+    """Stand-in for an RDataFrame that records the calls made by an rdf_defines function."""
+    RECORDED_METHODS = ("Define", "Redefine", "Filter", "Alias")
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, method):
+        if method not in self.RECORDED_METHODS:
+            raise AttributeError(method)
+        def record(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return record
 
 class DatasetConverter:
-    def __init__(self, config, save_intermediate=False, overwrite_existing_output_files=False):
+    def __init__(self, config, save_intermediate=False, overwrite_existing_output_files=False, use_cpp_cache=True, writer_queue_depth=2, backend=None, postprocess_threads=1, checkpoint_events=None, status_file=None, status_interval=30, add_fields=False):
         self._start_memory_monitor()
         self._log_memory_snapshot()
+        self.stage_times = {}
+        self.stage_rss = {}
         self.config = config
         self.root_file_list = config["input"]["root_file_list"]
-        self.output_path = config["output"]["h5_path"]
+        # Every output is written from the same pass over the input files
+        self.output_configs = get_output_configs(config)
+        self.output_paths = [output_config["output"]["h5_path"] for output_config in self.output_configs]
+        self.output_path = self.output_paths[0]
+        self._column_cache = None
+        self._events_before = 0
         self.save_intermediate = save_intermediate
         self.overwrite_existing_output_files = overwrite_existing_output_files
-        self.df_list = None
-        logging.info(f"Writing output path: {self.output_path}")
+        self.use_cpp_cache = use_cpp_cache
+        self.writer_queue_depth = writer_queue_depth
+        self.postprocess_threads = postprocess_threads
+        self.checkpoint_events = checkpoint_events or config["input"].get("checkpoint_events")
+        self.add_fields = add_fields
+        job_name = os.path.splitext(os.path.basename(status_file))[0] if status_file else None
+        self.status = StatusReporter(status_file, job=job_name, interval=status_interval)
+        self.define_plan = None
+        self.max_events_per_file = None
+        for output_path in self.output_paths:
+            logging.info(f"Writing output path: {output_path}")
         logging.debug(f"Input ROOT files:")
         for root_file in self.root_file_list:
             logging.debug(f"    {root_file}")
         if len(self.root_file_list) == 0:
             logging.error("No input ROOT files found. Please check that your input file paths exist!")
             exit(1)
-        os.makedirs(self.output_path, exist_ok=True)
+        for output_path in self.output_paths:
+            os.makedirs(output_path, exist_ok=True)
+        self._check_derived_fields()
+        self.backend = self._select_backend(backend)
 
     def format_ntuples(self, n_threads=8, max_events_per_file=None):
-        """Format ROOT files to RDataFrame."""
+        """Prepare the RDataFrame computation graph shared by all input files."""
+        if max_events_per_file is not None and max_events_per_file < 1:
+            logging.warning(f"max_events_per_file is {max_events_per_file}. Must be greater than 0! Ignoring it.")
+            max_events_per_file = None
+        self.max_events_per_file = max_events_per_file
+        if self.backend == "uproot":
+            # Branches are read as they are stored, there is nothing to compile or define
+            self.define_plan = []
+            return
+
+        # ROOT is only imported once a conversion starts, so that --help, batch submission
+        # and output validation do not pay for its initialization
+        import ROOT
         # Set up multithreading
         if n_threads > 1:
             logging.info(f"Enabling implicit multithreading with {n_threads} threads")
             ROOT.ROOT.EnableImplicitMT(n_threads)
 
+        # Report the duration of the just-in-time compilation of each RDataFrame computation graph
+        self._enable_rdf_jit_logging()
+
         self._log_memory_snapshot()
         # Compile ROOT macros
-        for macro in self.config.get("cpp_helpers", []):
-            logging.info(f"Compiling cpp_helper file {macro}")
-            macro = f"{__package__}/cpp_helpers/{macro}"
-            if not os.path.exists(macro):
-                logging.warning(f"File {macro} does not exist.")
-                continue
-            ROOT.gInterpreter.Declare(f'#include "{macro}"')
+        with self._time_stage("cpp_helpers"):
+            self._load_cpp_helpers()
 
         self._log_memory_snapshot()
-        df_list = []
-        N_files = len(self.root_file_list)
-        logging.info(f"Creating RDataFrame from {N_files} files")
-        for root_file in self.root_file_list:
-            logging.debug(f"Adding file {root_file}")
-            df = ROOT.RDataFrame(self.config["input"]["tree_name"], root_file)
-            if max_events_per_file:
-                if max_events_per_file < 1:
-                    logging.warning(f"max_events is {max_events}. Must be greater than 0! Skipping dataframe.")
-                    continue
-                logging.info(f"Limiting to {max_events_per_file} events per file")
-                df = df.Range(0, max_events_per_file)
-            df_list.append(df)
-        
+        # Record the branch definitions from config once, they are replayed on the RDataFrame of each file
+        with self._time_stage("rdf_defines"):
+            self.define_plan = self._build_define_plan()
         self._log_memory_snapshot()
-        # Apply branch definitions from config
-        for rdf_define in self.config.get("rdf_defines", []):
-            module_path, function_name = rdf_define.split(".")
-            module_path = f"{__package__}.rdf_defines.{module_path}"
-            module = importlib.import_module(module_path)
-            logging.info(f"Applying RDF define {module_path}.{function_name}")
+
+    def run(self, file_index_offset=0):
+        """Run the conversion.
+
+        The status is refreshed from a background thread throughout, so a job busy in an event
+        loop or a write that does not report progress is not taken for stale.
+        """
+        with self.status.heartbeat():
+            # Check if ROOT files were previously formatted
+            if self.define_plan is None:
+                logging.info("Formatting ROOT files was not previously run. Consider doing this first.")
+                self.format_ntuples()
+
+            # Convert ROOT files to H5, building each RDataFrame only when its file is processed
+            N_files = len(self.root_file_list)
+            entries = self._entry_counts()
+            # The progress total is left unknown when the entries of a file cannot be read
+            self.status.start(files_total=N_files, events_total=sum(entries) if None not in entries else 0)
             try:
-                module = importlib.import_module(module_path)
-            except ImportError as e:
-                logging.error(f"Could not import {module_path}: {e}")
-                exit(1)
-            module_function = getattr(module, function_name)
-            for i_file, df in enumerate(df_list):
-                df_list[i_file] = module_function(df)
+                for i_df, root_file in enumerate(self.root_file_list):
+                    logging.info(f"Converting ROOT file {i_df+1+file_index_offset} of {N_files+file_index_offset}")
+                    self._log_memory_snapshot()
+                    events_before = self.status.status["events_done"]
+                    self.status.update(input_file=root_file, force=True)
+                    output_file_names = [
+                        os.path.join(output_path, f"output_{i_df+file_index_offset:03}.h5") for output_path in self.output_paths
+                    ]
+                    if self.add_fields:
+                        self._add_fields(root_file, output_file_names)
+                    elif self.checkpoint_events:
+                        self._convert_in_blocks(root_file, output_file_names, entries[i_df])
+                    else:
+                        self._convert_entries(root_file, list(zip(self.output_configs, output_file_names)))
+                    # The events read by the event loops stand in for the entries of a file that could not be counted
+                    n_entries = entries[i_df] if entries[i_df] is not None else self.status.status["events_done"] - events_before
+                    self.status.update(files_done=i_df + 1, events_done=events_before + n_entries)
+            except BaseException:
+                self.status.finish("failed")
+                raise
+            self.status.finish("done")
+            self._log_timing_summary()
+            #self._plot_memory_profile(file_index_offset=file_index_offset)
 
-        self.df_list = df_list
+    def _convert_entries(self, root_file, outputs, entry_range=None):
+        """Convert the entries of one input file, or the (start, stop) entry_range of it, to (config, file name) outputs."""
+        with self._time_stage("dataframe"):
+            df = self._open_input(root_file, entry_range)
+        # Events read by the event loops of this input are counted from the events done before it
+        self._events_before = self.status.status["events_done"]
+        if len(self.output_configs) > 1 or isinstance(df, UprootSource):
+            # Read every column needed by any output in a single event loop, shared by all outputs
+            with self._time_stage("event_loop"):
+                self._prefetch_columns(df, [output_file_name for _, output_file_name in outputs])
+        with self._time_stage("conversion"):
+            for output_config, output_file_name in outputs:
+                self._root_to_h5(df=df, output_file_name=output_file_name, config=output_config, source_file=root_file)
+        self._column_cache = None
 
-    def run(self, file_index_offset=0):
-        """Run the conversion."""
-        # Check if ROOT files were previously formatted
-        if self.df_list is None:
-            logging.info("Formatting ROOT files was not previously run. Consider doing this first.")
+    def _add_fields(self, root_file, output_file_names):
+        """Extract only the fields of the config missing from the existing outputs of one input file and add them.
+
+        The missing fields are converted with the same selection, link and padding as the rest of the
+        output, so that their rows line up, then merged into the output file. Outputs that do not
+        exist yet are converted in full.
+        """
+        outputs = []
+        for output_config, output_file_name in zip(self.output_configs, output_file_names):
+            if not os.path.exists(output_file_name):
+                logging.info(f"Output file {output_file_name} does not exist. Converting all fields.")
+                outputs.append((output_config, output_file_name, output_file_name, {}, None))
+                continue
+            with h5py.File(output_file_name, "r") as h5f:
+                added_config, object_lengths = self._missing_fields_config(h5f, output_config)
+                event_number = self._stored_event_numbers(h5f, output_config)
+            if added_config is None:
+                logging.info(f"Output file {output_file_name} has every field of the config. Skipping it.")
+                continue
+            added_file_name = f"{output_file_name}.added.tmp"
+            if os.path.exists(added_file_name):
+                # Left over by a job stopped while adding fields
+                os.remove(added_file_name)
+            outputs.append((added_config, added_file_name, output_file_name, object_lengths, event_number))
+        if not outputs:
+            return
+
+        with self._time_stage("dataframe"):
+            df = self._open_input(root_file)
+        self._events_before = self.status.status["events_done"]
+        if len(outputs) > 1 or isinstance(df, UprootSource):
+            with self._time_stage("event_loop"):
+                self._prefetch_columns(df, [added_file_name for _, added_file_name, _, _, _ in outputs], [config for config, _, _, _, _ in outputs])
+        # The events must come in the same order as when the outputs were written
+        input_event_number = None
+        if any(event_number is not None for *_, event_number in outputs):
+            input_event_number = self._get_scalar(df, "eventNumber")
+        with self._time_stage("conversion"):
+            for added_config, added_file_name, output_file_name, object_lengths, event_number in outputs:
+                self._root_to_h5(df=df, output_file_name=added_file_name, config=added_config, source_file=root_file, object_lengths=object_lengths)
+                if added_file_name != output_file_name:
+                    self._merge_added_fields(output_file_name, added_file_name, added_config, (event_number, input_event_number))
+        self._column_cache = None
+
+    def _missing_fields_config(self, h5f, output_config):
+        """Return the Objects and ObjectCollections of an output config reduced to the fields missing from its file, or None.
+
+        Also returns the lengths per event of the vector Objects in the file, which link the collections
+        whose Object has no missing field.
+        """
+        added_config = {"Objects": {}, "ObjectCollections": {}}
+        object_lengths = {}
+        for section in ("Objects", "ObjectCollections"):
+            for name, object_config in output_config.get(section, {}).items():
+                if name not in h5f:
+                    logging.info(f"Adding {name} to {h5f.filename}")
+                    added_config[section][name] = object_config
+                    continue
+                if object_config.get("store_length", False):
+                    object_lengths[name] = np.diff(h5f[h5f[name].attrs["offsets"]][()])
+                existing = self._stored_fields(h5f[name])
+                missing = [field for field in self._output_fields(section, object_config) if field not in existing]
+                if missing:
+                    logging.info(f"Adding fields {', '.join(missing)} to {name} in {h5f.filename}")
+                    added_config[section][name] = self._reduced_config(object_config, missing)
+        if not added_config["Objects"] and not added_config["ObjectCollections"]:
+            return None, object_lengths
+        return added_config, object_lengths
+
+    def _output_fields(self, section, config):
+        """Fields written for an Object or ObjectCollection of the config, the valid mask excluded."""
+        fields = list(config.get("branches", []))
+        derived_fields = config.get("derived", {})
+        selection = config.get("selection")
+        if section == "ObjectCollections" and selection and selection not in fields and selection not in derived_fields:
+            fields.append(selection)
+        fields.extend(derived_fields)
+        if section == "Objects" and config["source_format"] == "vector" and config.get("event_number", False):
+            fields.append("eventNumber")
+        return fields
+
+    def _stored_fields(self, node):
+        return list(node.keys()) if isinstance(node, h5py.Group) else list(node.dtype.names)
+
+    def _stored_event_numbers(self, h5f, output_config):
+        """eventNumber of each event of an output file, from a scalar Object or an eventNumber index, or None."""
+        for name, object_config in output_config.get("Objects", {}).items():
+            if name not in h5f:
+                continue
+            if object_config["source_format"] == "scalar" and "eventNumber" in self._stored_fields(h5f[name]):
+                return r2h5.read_fields(h5f, name, ["eventNumber"])["eventNumber"]
+            if "event_index" in h5f[name].attrs:
+                index = h5f[h5f[name].attrs["event_index"]][()]
+                event_number = np.empty(len(index), dtype=index["eventNumber"].dtype)
+                event_number[index["event"]] = index["eventNumber"]
+                return event_number
+        return None
+
+    def _reduced_config(self, config, missing):
+        """Copy of an Object or ObjectCollection config extracting only the missing fields.
+
+        The selection and link are kept so that the rows are the same. One branch is still read when
+        only derived fields or the eventNumber are missing, for the lengths per event.
+        """
+        reduced = dict(config)
+        derived_fields = config.get("derived", {})
+        reduced["branches"] = [branch for branch in config["branches"] if branch in missing and branch not in derived_fields] or config["branches"][:1]
+        # Derived fields can read each other and the selection, so they are evaluated together
+        if not any(field in missing for field in derived_fields) and config.get("selection") not in derived_fields:
+            reduced["derived"] = {}
+        reduced["event_number"] = "eventNumber" in missing
+        reduced["event_index"] = False
+        return reduced
+
+    def _merge_added_fields(self, output_file_name, added_file_name, added_config, event_numbers=(None, None)):
+        """Write the output file again with the fields of added_file_name added, and replace it.
+
+        event_numbers holds the eventNumber of each event in the output file, when it has them, and in
+        the input. Datasets without new fields are copied as they are, so only the extended ones are
+        rewritten.
+        """
+        logging.info(f"Merging the added fields into {output_file_name}")
+        stored_event_number, input_event_number = event_numbers
+        if stored_event_number is not None and not np.array_equal(stored_event_number, input_event_number):
+            os.remove(added_file_name)
+            logging.error(f"The events of the input are not in the order of {output_file_name}, the fields cannot be added. Convert it again with --overwrite-existing-output-files.")
+            exit(1)
+        with h5py.File(output_file_name, "r") as old, h5py.File(added_file_name, "r") as added:
+            for section in ("Objects", "ObjectCollections"):
+                for name in added_config[section]:
+                    mismatch = self._rows_mismatch(old, added, name) if name in old else None
+                    if mismatch:
+                        os.remove(added_file_name)
+                        logging.error(f"The rows of the added fields of {name} do not match {output_file_name}: {mismatch}. Its layout, max_objects, selection or link changed. Convert it again with --overwrite-existing-output-files.")
+                        exit(1)
+        with h5py.File(output_file_name, "r") as old, h5py.File(added_file_name, "r") as added, h5py.File(f"{output_file_name}.tmp", "w") as h5f:
+            h5f.attrs.update(old.attrs)
+            extended = {}
+            for section, storage_layouts in (("Objects", ()), ("ObjectCollections", COLLECTION_LAYOUTS)):
+                for name, object_config in added_config[section].items():
+                    if name in old:
+                        extended[name] = (object_config, storage_layouts)
+                        continue
+                    # A new Object or ObjectCollection is copied with its offsets, index and link datasets
+                    for key in (name, f"{name}_offsets", f"{name}_event_index", f"{name}_link_indices", f"{name}_link_offsets"):
+                        if key in added:
+                            added.copy(added[key], h5f, key)
+            for key in old:
+                # Columnar groups are copied and get their new fields as additional datasets
+                if key not in extended or isinstance(old[key], h5py.Group):
+                    old.copy(old[key], h5f, key)
+
+            for name, (object_config, storage_layouts) in extended.items():
+                existing = self._stored_fields(old[name])
+                new_fields = [field for field in self._stored_fields(added[name]) if field not in existing]
+                data = r2h5.read_fields(added, name, new_fields)
+                save = self._saver(name, object_config, storage_layouts)
+                if isinstance(old[name], h5py.Group):
+                    save(h5f, name, data)
+                    continue
+                stored = old[name][()]
+                combined = np.empty(stored.shape, dtype=[(field, stored.dtype[field]) for field in existing] + [(field, data.dtype[field]) for field in new_fields])
+                for field in existing:
+                    combined[field] = stored[field]
+                for field in new_fields:
+                    combined[field] = data[field]
+                del stored, data
+                save(h5f, name, combined)
+                h5f[name].attrs.update(old[name].attrs)
+        os.replace(f"{output_file_name}.tmp", output_file_name)
+        os.remove(added_file_name)
+
+    def _rows_mismatch(self, h5f, other, name):
+        """Describe how the rows of an Object or ObjectCollection differ between two files, or return None.
+
+        Besides the shape and the offsets per event, the fields stored in both files are compared:
+        the valid mask and the selection of a padded collection, whose shape does not depend on them,
+        and the branches read again for the lengths.
+        """
+        shapes = [node[next(iter(node.keys()))].shape if isinstance(node, h5py.Group) else node.shape for node in (h5f[name], other[name])]
+        if shapes[0] != shapes[1]:
+            return f"{shapes[0]} rows instead of {shapes[1]}"
+        if "offsets" in h5f[name].attrs and not np.array_equal(h5f[h5f[name].attrs["offsets"]][()], other[other[name].attrs["offsets"]][()]):
+            return "different offsets per event"
+        other_fields = self._stored_fields(other[name])
+        for field in self._stored_fields(h5f[name]):
+            if field not in other_fields:
+                continue
+            values = [r2h5.read_fields(node, name, [field])[field] for node in (h5f, other)]
+            if not np.array_equal(*values, equal_nan=values[0].dtype.kind in "fc"):
+                return f"different {field}"
+        return None
+
+    def _entry_counts(self):
+        """Number of entries converted from each input file, None for the files whose entries cannot be read."""
+        entries = cost_model.entry_counts(self.root_file_list, self.config["input"]["tree_name"])
+        if self.max_events_per_file:
+            entries = [n_entries if n_entries is None else min(n_entries, self.max_events_per_file) for n_entries in entries]
+        return entries
+
+    def _convert_in_blocks(self, root_file, output_file_names, n_entries):
+        """Convert one input file in blocks of checkpoint_events entries, committing each block.
+
+        A rerun after the job was stopped continues after the last committed block, and the blocks
+        are merged into the output file once all of them are done.
+        """
+        outputs = []
+        for output_config, output_file_name in zip(self.output_configs, output_file_names):
+            if self.overwrite_existing_output_files:
+                checkpoint.discard(output_file_name)
+            elif os.path.exists(output_file_name):
+                logging.info(f"Output file {output_file_name} already exists. Skipping conversion.")
+                continue
+            outputs.append((output_config, output_file_name))
+        if not outputs:
+            return
+        if n_entries is None:
+            logging.error(f"Could not read the entries of {root_file}, which are needed to convert it in blocks. Run without --checkpoint-events.")
+            exit(1)
+
+        ranges = checkpoint.entry_ranges(n_entries, self.checkpoint_events)
+        events_before = self.status.status["events_done"]
+        n_committed = min(checkpoint.committed_blocks(output_file_name, root_file, ranges, output_config) for output_config, output_file_name in outputs)
+        if n_committed:
+            logging.info(f"Resuming {root_file} after {n_committed} of {len(ranges)} committed blocks")
+        for i_block in range(n_committed, len(ranges)):
+            logging.info(f"Converting entries {ranges[i_block][0]} to {ranges[i_block][1]} (block {i_block+1} of {len(ranges)})")
+            self.status.update(events_done=events_before + ranges[i_block][0])
+            block_outputs = []
+            for output_config, output_file_name in outputs:
+                block_file = f"{checkpoint.part_file(output_file_name, i_block)}.tmp"
+                os.makedirs(checkpoint.parts_path(output_file_name), exist_ok=True)
+                if os.path.exists(block_file):
+                    # Left over by a job stopped while writing this block
+                    os.remove(block_file)
+                block_outputs.append((output_config, block_file))
+            self._convert_entries(root_file, block_outputs, ranges[i_block])
+            for output_config, output_file_name in outputs:
+                checkpoint.commit_block(output_file_name, root_file, ranges, i_block, output_config)
+        with self._time_stage("merge"):
+            for output_config, output_file_name in outputs:
+                checkpoint.merge_blocks(output_file_name, output_config, root_file, len(ranges), COLUMNAR_CHUNK_ROWS)
+
+    def profile_multiplicity(self, truncation_target=0.01, max_multiplicity=10000):
+        """Report the per-collection multiplicity after selection and the cost of candidate max_objects.
+
+        Only a histogram of the multiplicity per row is filled in the event loop, no branch is extracted.
+        """
+        import ROOT
+        if self.define_plan is None:
             self.format_ntuples()
 
-        # Convert ROOT files to H5
-        for i_df, df in enumerate(self.df_list):
-            logging.info(f"Converting ROOT file {i_df+1+file_index_offset} of {len(self.df_list)+file_index_offset}")
-            self._log_memory_snapshot()
-            self._root_to_h5(
-                df=df,
-                output_file_name=os.path.join(self.output_path, f"output_{i_df+file_index_offset:03}.h5")
+        objcol_configs = {}
+        for output_config in self.output_configs:
+            for name, objcol_config in output_config.get("ObjectCollections", {}).items():
+                if objcol_config.get("selection") in objcol_config.get("derived", {}):
+                    logging.error(f"The selection of '{name}' is a derived field, which the multiplicity profile cannot evaluate")
+                    exit(1)
+                label = name if len(self.output_configs) == 1 else f"{output_config['output']['h5_path']}:{name}"
+                objcol_configs[label] = objcol_config
+        counts = {name: np.zeros(max_multiplicity, dtype=np.int64) for name in objcol_configs}
+        row_bytes = {}
+        for i_df, root_file in enumerate(self.root_file_list):
+            logging.info(f"Profiling multiplicity in ROOT file {i_df+1} of {len(self.root_file_list)}")
+            df = self._build_dataframe(root_file)
+            histograms, maxima = {}, {}
+            for i_objcol, (name, objcol_config) in enumerate(objcol_configs.items()):
+                column = f"r2h5_multiplicity_{i_objcol}"
+                df = df.Define(column, self._multiplicity_expression(objcol_config))
+                model = ROOT.RDF.TH1DModel(column, column, max_multiplicity, -0.5, max_multiplicity - 0.5)
+                histograms[name] = df.Histo1D(model, column)
+                maxima[name] = df.Max(column)
+                # The selection branch is written as a field of the collection as well
+                branches = list(objcol_config["branches"])
+                if objcol_config.get("selection") and objcol_config["selection"] not in branches:
+                    branches.append(objcol_config["selection"])
+                row_bytes[name] = sum(multiplicity.output_itemsize(df.GetColumnType(branch)) for branch in branches)
+                # Derived fields are written as fields of the collection too
+                derived_fields = objcol_config.get("derived", {})
+                if derived_fields:
+                    input_itemsizes = {column: multiplicity.output_itemsize(df.GetColumnType(column)) for column in derived.input_columns(derived_fields)}
+                    try:
+                        row_bytes[name] += sum(multiplicity.derived_itemsizes(derived_fields, input_itemsizes).values())
+                    except ValueError as e:
+                        logging.error(f"Derived fields of '{name}': {e}")
+                        exit(1)
+
+            # All histograms are filled in a single event loop
+            for name, histogram in histograms.items():
+                counts[name] += np.array([histogram.GetBinContent(i + 1) for i in range(max_multiplicity)], dtype=np.int64)
+                if maxima[name].GetValue() >= max_multiplicity:
+                    logging.warning(f"Multiplicity of {name} reaches {maxima[name].GetValue()}, above the histogram range {max_multiplicity}")
+
+        for name, objcol_config in objcol_configs.items():
+            last_filled = np.flatnonzero(counts[name])
+            summary = multiplicity.summarize(
+                counts[name][:last_filled[-1] + 1 if len(last_filled) else 1],
+                row_bytes[name],
+                configured_max_objects=objcol_config.get("max_objects"),
+                truncation_target=truncation_target,
             )
-        #self._plot_memory_profile(file_index_offset=file_index_offset)
+            multiplicity.log_summary(name, summary, objcol_config.get("max_objects"))
 
-    def submit_batch(self, config_path, batch_system, dry_run=False, debug=False):
+    def submit_batch(self, config_paths, batch_system, dry_run=False, debug=False):
         """Submit conversion to batch system."""
+        if isinstance(config_paths, str):
+            config_paths = [config_paths]
         if batch_system == "slurm":
             logging.info("Submitting to SLURM")
-            slurm_path = f"{r2h5.__package_path__}/r2h5/slurm/{os.path.splitext(os.path.basename(config_path))[0]}"
+            slurm_path = self._slurm_path(config_paths)
             os.makedirs(slurm_path, exist_ok=True)
             os.makedirs(f"{slurm_path}/logs", exist_ok=True)
             os.makedirs(f"{slurm_path}/submission", exist_ok=True)
+            os.makedirs(f"{slurm_path}/status", exist_ok=True)
             logging.info(f"Writing SLURM submission files to {slurm_path}")
             self.config['batch'] = self.config.get("batch", {})
             max_files = self.config['batch'].get("max_files", -1)
+            # Per-job time and memory from the cost model of plan_batch, when it was run
+            plan, plan_jobs = None, {}
+            safety_margin = self.config["batch"].get("safety_margin", 1.5)
+            if os.path.exists(f"{slurm_path}/plan.json"):
+                with open(f"{slurm_path}/plan.json") as f:
+                    plan = json.load(f)
+                plan_jobs = {job["input_file"]: job for job in plan["jobs"]}
+                logging.info(f"Requesting per-job resources from {slurm_path}/plan.json")
+                if dry_run:
+                    cost_model.log_estimate(plan, safety_margin)
             for i_df in range(len(self.root_file_list)):
                 if max_files>0 and i_df >= max_files:
                     logging.info(f"Reached maximum number of files to process: {max_files}")
                     break
-                if not self.overwrite_existing_output_files:
-                    output_file_name = os.path.join(self.output_path, f"output_{i_df:03}.h5")
-                    if os.path.exists(output_file_name):
-                        logging.info(f"Output file {output_file_name} already exists. Skipping batch submission.")
+                # Existing outputs are the ones fields are added to
+                if not self.overwrite_existing_output_files and not self.add_fields:
+                    output_file_names = [os.path.join(output_path, f"output_{i_df:03}.h5") for output_path in self.output_paths]
+                    if all(os.path.exists(output_file_name) for output_file_name in output_file_names):
+                        logging.info(f"Output file {output_file_names[0]} already exists. Skipping batch submission.")
                         continue
                 job_name = f"{self.config['batch'].get('batch_name','r2h5')}_{i_df:03}"
+                job_time = self.config["batch"].get("time", "00:30:00")
+                job_memory = self.config["batch"].get("memory", 4)
+                if plan is not None and self.root_file_list[i_df] in plan_jobs:
+                    job_time, job_memory = cost_model.slurm_resources(plan_jobs[self.root_file_list[i_df]], safety_margin)
                 slurm_submission_file = r2h5.get_slurm_script(
                     job_name=job_name,
-                    config_path=config_path,
+                    config_path=" ".join(config_paths),
                     debug=debug,
                     file_name=self.root_file_list[i_df],
                     file_index_offset=i_df,
                     job_path=slurm_path, 
-                    time=self.config["batch"].get("time", "00:30:00"),
-                    memory=self.config["batch"].get("memory", 4),
+                    time=job_time,
+                    memory=job_memory,
                     partition=self.config["batch"].get("partition", "roma"),
                     account=self.config["batch"].get("account", "atlas:usatlas"),
                     cpu_count=self.config["batch"].get("cpu_count", 1),
+                    status_file=f"{slurm_path}/status/{job_name}.json",
+                    add_fields=self.add_fields,
                 )
                 logging.debug(f"    file {job_name}.sh")
                 with open(f"{slurm_path}/submission/{job_name}.sh", "w") as f:
@@ -145,49 +559,425 @@ class DatasetConverter:
             exit(1)
         logging.info("Submitted all jobs to batch system")
 
+    def production_status(self, config_paths):
+        """Print the combined progress of the batch jobs of these configs from their status files."""
+        if isinstance(config_paths, str):
+            config_paths = [config_paths]
+        slurm_path = self._slurm_path(config_paths)
+        n_jobs = len(glob.glob(f"{slurm_path}/submission/*.sh"))
+        logging.info(f"Reading the status of {n_jobs} jobs in {slurm_path}/status")
+        return production_status(f"{slurm_path}/status", n_jobs)
+
+    def plan_batch(self, config_paths, sample_events=1000, n_files=10, output_subfolder=None):
+        """Predict the runtime, memory and output size of every batch job from a few sample conversions.
+
+        Sample files are chosen across the range of entry counts and converted with sample_events events
+        each in a subprocess. The stage timings separate the fixed cost of a job from its cost per event,
+        and the largest rates over the samples are used for every file. The plan is written to plan.json
+        in the submission folder, where submit_batch picks it up.
+        """
+        if isinstance(config_paths, str):
+            config_paths = [config_paths]
+        tree_name = self.config["input"]["tree_name"]
+        entries = cost_model.entry_counts(self.root_file_list, tree_name)
+        if None in entries:
+            logging.error(f"Could not read the entries of {self.root_file_list[entries.index(None)]}, which the plan is based on")
+            exit(1)
+        # Samples are written next to the outputs and removed once measured
+        sample_dir = "r2h5_plan_sample"
+        samples = []
+        for i_file in cost_model.sample_files(entries, n_files):
+            root_file = self.root_file_list[i_file]
+            logging.info(f"Converting {sample_events} events of {root_file} ({entries[i_file]} entries)")
+            sample_paths = [os.path.join(output_path, sample_dir) for output_path in self.output_paths]
+            for sample_path in sample_paths:
+                shutil.rmtree(sample_path, ignore_errors=True)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                report_path = os.path.join(tmp_dir, "stage_report.json")
+                command = [
+                    sys.executable, "-m", "r2h5.cli", "-c", *config_paths, "-i", root_file,
+                    "-m", str(sample_events), "-o", os.path.join(output_subfolder or "", sample_dir), "-k", "--stage-report", report_path,
+                ]
+                result = cost_model.run_sample(command, report_path)
+            if result is None:
+                continue
+            wall, peak_memory, report = result
+            output_bytes = sum(
+                os.path.getsize(os.path.join(sample_path, "output_000.h5"))
+                for sample_path in sample_paths if os.path.exists(os.path.join(sample_path, "output_000.h5"))
+            )
+            for sample_path in sample_paths:
+                shutil.rmtree(sample_path, ignore_errors=True)
+            sample = cost_model.sample_costs(min(entries[i_file], sample_events), wall, peak_memory, report, output_bytes)
+            sample["input_file"] = root_file
+            samples.append(sample)
+            logging.debug(f"    {wall:.1f} s, {peak_memory/1024**2:.0f} MB peak, {output_bytes/1024**2:.1f} MB written")
+        if not samples:
+            logging.error("All sample conversions failed, no plan was made")
+            exit(1)
+
+        model = cost_model.fit_model(samples)
+        jobs = [
+            {"input_file": root_file, "entries": n_entries, **cost_model.predict(model, n_entries)}
+            for root_file, n_entries in zip(self.root_file_list, entries)
+        ]
+        plan = {"model": model, "jobs": jobs, "samples": samples}
+        slurm_path = self._slurm_path(config_paths)
+        os.makedirs(slurm_path, exist_ok=True)
+        with open(f"{slurm_path}/plan.json", "w") as f:
+            json.dump(plan, f, indent=2)
+        logging.info(f"Wrote batch plan to {slurm_path}/plan.json")
+        cost_model.log_estimate(plan, self.config.get("batch", {}).get("safety_margin", 1.5))
+        return plan
+
+    def reshard_outputs(self):
+        """Rewrite the per-input output files into shards of a fixed number of events.
+
+        Only outputs with an output.sharding section in their config are resharded.
+        """
+        for output_config in self.output_configs:
+            sharding_config = output_config["output"].get("sharding")
+            if not sharding_config:
+                logging.debug(f"No sharding configured for {output_config['output']['h5_path']}, skipping it")
+                continue
+            with self._time_stage("resharding"):
+                sharding.reshard(self._converted_output_files(output_config), output_config, sharding_config)
+
+    def split_outputs(self):
+        """Write shuffled train/val/test shards of the converted output files.
+
+        Only outputs with an output.split section in their config are split.
+        """
+        for output_config in self.output_configs:
+            split_config = output_config["output"].get("split")
+            if not split_config:
+                logging.debug(f"No split configured for {output_config['output']['h5_path']}, skipping it")
+                continue
+            with self._time_stage("splitting"):
+                split.split_outputs(self._converted_output_files(output_config), output_config, split_config)
+
     def delete_incomplete_output_files(self, dry_run=False):
         """Delete output files that do not have the expected data features in the output."""
-        file_status = {"good": 0, "incomplete": 0, "corrupted": 0, 'notfound': 0}
+        file_status = {"good": 0, "incomplete": 0, "corrupted": 0, 'notfound': 0, "resumable": 0}
         if dry_run: logging.info("Running in dry run mode. No files will be deleted.")
-        for i_df in range(len(self.root_file_list)):
-            logging.debug(f"Checking output file {i_df+1} of {len(self.root_file_list)}")
-            output_file_name = os.path.join(self.output_path, f"output_{i_df:03}.h5")
-            # Openn h5 file and check if it has the expected data features
-            if not os.path.exists(output_file_name):
-                logging.debug(f" -> file {output_file_name} does not exist!")
-                file_status["notfound"] += 1
-                continue
-            try:
-                with h5py.File(output_file_name, "r") as h5f:
-                    good = True
-                    # Check if the file has the expected data features
-                    for object_name, object_config in self.config.get("Objects", {}).items():
-                        if object_name not in h5f:
-                            logging.debug(f" -> does not contain {object_name}. Deleting it.")
-                            file_status["incomplete"] += 1
-                            good = False
-                            if not dry_run: os.remove(output_file_name)
-                            break
-                    for objcol_name, objcol_config in self.config.get("ObjectCollections", {}).items():
-                        if objcol_name not in h5f:
-                            logging.debug(f" -> does not contain {objcol_name}. Deleting it.")
-                            file_status["incomplete"] += 1
-                            good = False
-                            if not dry_run: os.remove(output_file_name)
-                            break
-                    file_status["good"] += 1 if good else 0
-            except:
-                logging.debug(f" -> file {output_file_name} is corrupted. Deleting it.")
-                file_status["corrupted"] += 1
-                if not dry_run: os.remove(output_file_name)
-        logging.info(f"File status: {file_status['good']} good, {file_status['incomplete']} incomplete, {file_status['corrupted']} corrupted, {file_status['notfound']} not found")
+        for output_config in self.output_configs:
+            for i_df in range(len(self.root_file_list)):
+                logging.debug(f"Checking output file {i_df+1} of {len(self.root_file_list)}")
+                output_file_name = os.path.join(output_config["output"]["h5_path"], f"output_{i_df:03}.h5")
+                # Openn h5 file and check if it has the expected data features
+                if not os.path.exists(output_file_name) and checkpoint.has_progress(output_file_name):
+                    # Committed blocks of a stopped job are kept, the next run resumes from them
+                    logging.debug(f" -> file {output_file_name} has committed blocks to resume from")
+                    file_status["resumable"] += 1
+                    continue
+                if not os.path.exists(output_file_name):
+                    logging.debug(f" -> file {output_file_name} does not exist!")
+                    file_status["notfound"] += 1
+                    continue
+                try:
+                    with h5py.File(output_file_name, "r") as h5f:
+                        good = True
+                        # Check if the file has the expected data features
+                        for object_name, object_config in output_config.get("Objects", {}).items():
+                            if object_name not in h5f:
+                                logging.debug(f" -> does not contain {object_name}. Deleting it.")
+                                file_status["incomplete"] += 1
+                                good = False
+                                if not dry_run: os.remove(output_file_name)
+                                break
+                        for objcol_name, objcol_config in output_config.get("ObjectCollections", {}).items():
+                            if objcol_name not in h5f:
+                                logging.debug(f" -> does not contain {objcol_name}. Deleting it.")
+                                file_status["incomplete"] += 1
+                                good = False
+                                if not dry_run: os.remove(output_file_name)
+                                break
+                        file_status["good"] += 1 if good else 0
+                except:
+                    logging.debug(f" -> file {output_file_name} is corrupted. Deleting it.")
+                    file_status["corrupted"] += 1
+                    if not dry_run: os.remove(output_file_name)
+        logging.info(f"File status: {file_status['good']} good, {file_status['incomplete']} incomplete, {file_status['corrupted']} corrupted, {file_status['notfound']} not found, {file_status['resumable']} resumable")
 
 
     """ 
     Private methods for internal data conversion
     """
-    def _root_to_h5(self, df, output_file_name):
-        """Convert processed ROOT DataFrame to H5 format."""
+    def _converted_output_files(self, output_config):
+        """Return the output files of all input files, which must all be converted."""
+        output_files = [
+            os.path.join(output_config["output"]["h5_path"], f"output_{i_df:03}.h5") for i_df in range(len(self.root_file_list))
+        ]
+        missing = [output_file for output_file in output_files if not os.path.exists(output_file)]
+        if missing:
+            logging.error(f"{len(missing)} output files are missing, e.g. {missing[0]}. Convert all input files first.")
+            exit(1)
+        return output_files
+
+    def _slurm_path(self, config_paths):
+        config_names = "+".join(os.path.splitext(os.path.basename(config_path))[0] for config_path in config_paths)
+        return f"{r2h5.__package_path__}/r2h5/slurm/{config_names}"
+
+    def _cpp_helper_paths(self):
+        header_paths = []
+        for macro in self.config.get("cpp_helpers", []):
+            macro = f"{__package__}/cpp_helpers/{macro}"
+            if not os.path.exists(macro):
+                logging.warning(f"File {macro} does not exist.")
+                continue
+            header_paths.append(macro)
+        return header_paths
+
+    def _load_cpp_helpers(self):
+        """Load cpp_helpers from the compiled library cache, or declare them to the interpreter."""
+        header_paths = self._cpp_helper_paths()
+        if not header_paths:
+            return
+        import ROOT
+
+        if self.use_cpp_cache:
+            cache_dir = cpp_cache.get_cache_dir(self.config)
+            if cpp_cache.load_cpp_helpers(header_paths, cache_dir):
+                return
+            logging.warning("Falling back to JIT compilation of cpp_helpers")
+
+        for macro in header_paths:
+            logging.info(f"Compiling cpp_helper file {macro}")
+            ROOT.gInterpreter.Declare(f'#include "{macro}"')
+
+    def _build_define_plan(self):
+        """Import each rdf_defines function once and record the RDataFrame calls it makes."""
+        define_plan = []
+        modules = {}
+        for rdf_define in self.config.get("rdf_defines", []):
+            module_path, function_name = rdf_define.split(".")
+            module_path = f"{__package__}.rdf_defines.{module_path}"
+            logging.info(f"Applying RDF define {module_path}.{function_name}")
+            if module_path not in modules:
+                try:
+                    modules[module_path] = importlib.import_module(module_path)
+                except ImportError as e:
+                    logging.error(f"Could not import {module_path}: {e}")
+                    exit(1)
+            module_function = getattr(modules[module_path], function_name)
+            recorder = _DefinePlanRecorder()
+            try:
+                module_function(recorder)
+                define_plan.extend(recorder.calls)
+            except AttributeError:
+                # The function inspects the dataframe, so it is called on each file instead
+                logging.debug(f"Cannot record {rdf_define}, it will be applied to each RDataFrame")
+                define_plan.append(("__call__", (module_function,), {}))
+        logging.debug(f"Recorded {len(define_plan)} RDataFrame calls from rdf_defines")
+        return define_plan
+
+    def _select_backend(self, backend=None):
+        """Choose how input files are read: with an RDataFrame ("rdf") or with uproot ("uproot").
+
+        In "auto" mode uproot is used when the config needs neither cpp_helpers nor rdf_defines
+        and uproot and awkward are installed.
+        """
+        backend = backend or self.config["input"].get("backend", "auto")
+        if backend not in ("auto", "rdf", "uproot"):
+            logging.error(f"Input backend {backend} not recognized. Use auto, rdf or uproot.")
+            exit(1)
+        needs_rdf = bool(self.config.get("cpp_helpers") or self.config.get("rdf_defines"))
+        if backend == "uproot" and needs_rdf:
+            logging.error("The uproot backend cannot apply cpp_helpers or rdf_defines. Use the rdf backend.")
+            exit(1)
+        if backend == "auto":
+            backend = "rdf"
+            # Only check that they are installed, they are imported when an input file is opened
+            if not needs_rdf:
+                if importlib.util.find_spec("uproot") and importlib.util.find_spec("awkward"):
+                    backend = "uproot"
+                else:
+                    logging.debug("uproot or awkward not installed, reading input with RDataFrame")
+        logging.info(f"Reading input files with the {backend} backend")
+        return backend
+
+    def _open_input(self, root_file, entry_range=None):
+        """Open one input file, or the (start, stop) entry_range of it, with the selected backend."""
+        if self.backend == "uproot":
+            logging.debug(f"Opening file {root_file} with uproot")
+            if entry_range is not None:
+                return UprootSource(root_file, self.config["input"]["tree_name"], entry_range[1], entry_range[0])
+            return UprootSource(root_file, self.config["input"]["tree_name"], self.max_events_per_file)
+        return self._build_dataframe(root_file, entry_range)
+
+    def _build_dataframe(self, root_file, entry_range=None):
+        """Create the RDataFrame of one input file and replay the recorded define plan on it.
+
+        A valid intermediate file of this input is read instead when one exists, and one is
+        written when save_intermediate is enabled.
+        """
+        tree_name = self.config["input"]["tree_name"]
+        intermediate_file = self._find_intermediate_file(root_file)
+        if intermediate_file:
+            logging.info(f"Reading intermediate file {intermediate_file} instead of {root_file}")
+            return self._input_dataframe(tree_name, intermediate_file, entry_range)
+
+        logging.debug(f"Creating RDataFrame for file {root_file}")
+        df = self._input_dataframe(tree_name, root_file, entry_range)
+        if self.max_events_per_file and entry_range is None:
+            logging.info(f"Limiting to {self.max_events_per_file} events per file")
+            df = df.Range(0, self.max_events_per_file)
+        # Identical Define expressions are only compiled once per process by ROOT, so replaying
+        # the plan does not add JIT time for the second and later files
+        for method, args, kwargs in self.define_plan:
+            if method == "__call__":
+                df = args[0](df)
+            else:
+                df = getattr(df, method)(*args, **kwargs)
+
+        if self.save_intermediate and entry_range is None:
+            df = self._save_intermediate_file(df, root_file)
+        return df
+
+    def _input_dataframe(self, tree_name, file_name, entry_range=None):
+        """Return an RDataFrame over a file, restricted to the (start, stop) entry_range if given."""
+        import ROOT
+        if entry_range is None:
+            return ROOT.RDataFrame(tree_name, file_name)
+        # Range() cannot be used with implicit multithreading, a global range of the dataset spec can
+        spec = ROOT.RDF.Experimental.RDatasetSpec()
+        spec.AddSample(ROOT.RDF.Experimental.RSample("input", tree_name, file_name))
+        spec.WithGlobalRange(ROOT.RDF.Experimental.RDatasetSpec.REntryRange(*entry_range))
+        return ROOT.RDataFrame(spec)
+
+    def _required_columns(self, output_configs=None):
+        """List the input and derived columns read by the Objects and ObjectCollections in the config, or in output_configs."""
+        columns = []
+        for output_config in output_configs or self.output_configs:
+            for object_config in output_config.get("Objects", {}).values():
+                columns.extend(self._input_branches(object_config))
+                if object_config.get("event_number", False) or object_config.get("event_index", False):
+                    columns.append("eventNumber")
+            for objcol_config in output_config.get("ObjectCollections", {}).values():
+                columns.extend(self._input_branches(objcol_config))
+                if objcol_config.get("selection") and objcol_config["selection"] not in objcol_config.get("derived", {}):
+                    columns.append(objcol_config["selection"])
+                if objcol_config.get("object_link"):
+                    columns.append(objcol_config["object_link"]["link"])
+        return list(dict.fromkeys(columns))
+
+    def _input_branches(self, config):
+        """Branches read from the input for an Object or ObjectCollection, the inputs of its derived fields included."""
+        derived_fields = config.get("derived", {})
+        branches = [branch for branch in config.get("branches", []) if branch not in derived_fields]
+        return list(dict.fromkeys(branches + derived.input_columns(derived_fields)))
+
+    def _check_derived_fields(self):
+        """Check the expressions of the derived fields in the config before any input is read."""
+        for output_config in self.output_configs:
+            for section in ("Objects", "ObjectCollections"):
+                for name, object_config in output_config.get(section, {}).items():
+                    try:
+                        derived.check(object_config.get("derived", {}), object_config.get("branches", []))
+                    except ValueError as e:
+                        logging.error(f"Derived fields of '{name}': {e}")
+                        exit(1)
+
+    def _evaluate_derived(self, name, config, columns, lengths=None):
+        """Evaluate the derived fields of an Object or ObjectCollection on the flat values of its input branches.
+
+        For vector inputs the lengths per event of every input branch must be the same.
+        """
+        derived_fields = config.get("derived", {})
+        if not derived_fields:
+            return {}
+        inputs = {column: columns[column] for column in derived.input_columns(derived_fields)}
+        if lengths is not None:
+            for column in inputs:
+                if not np.array_equal(lengths[column], next(iter(lengths.values()))):
+                    logging.error(f"Derived fields of '{name}' read {column}, which does not have the same lengths per event as the other branches")
+                    exit(1)
+        logging.info(f"Evaluating {len(derived_fields)} derived fields of {name}")
+        try:
+            # Fields reading no column still get one value per row of the branches
+            return derived.evaluate(derived_fields, inputs, size=len(next(iter(columns.values()))) if columns else None)
+        except ValueError as e:
+            logging.error(f"Derived fields of '{name}': {e}")
+            exit(1)
+
+    def _intermediate_key(self, root_file):
+        """Describe everything the content of an intermediate file depends on, except the column list."""
+        import ROOT
+        file_stat = os.stat(root_file)
+        define_plan = [
+            [f"{args[0].__module__}.{args[0].__qualname__}", self._source_hash(args[0])] if method == "__call__" else [method, list(args), kwargs]
+            for method, args, kwargs in self.define_plan
+        ]
+        return {
+            "input_file": os.path.abspath(root_file),
+            "input_size": file_stat.st_size,
+            "input_mtime": file_stat.st_mtime,
+            "tree_name": self.config["input"]["tree_name"],
+            "max_events_per_file": self.max_events_per_file,
+            "define_plan": define_plan,
+            "cpp_helpers": cpp_cache.helper_hash(self._cpp_helper_paths(), ROOT.gROOT.GetVersion()),
+        }
+
+    def _source_hash(self, function):
+        """Hash of the module source of an rdf_defines function applied to each file, so that editing it or its helpers changes the key."""
+        try:
+            with open(inspect.getsourcefile(function), "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except (OSError, TypeError):
+            logging.warning(f"Source of {function.__qualname__} not found, edits to it are not detected by intermediate files")
+            return None
+
+    def _intermediate_file_name(self, root_file):
+        intermediate_path = self.config["output"].get("intermediate_path", os.path.join(self.output_path, "intermediate"))
+        key = json.dumps(self._intermediate_key(root_file), sort_keys=True, default=str)
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        stem = os.path.splitext(os.path.basename(root_file))[0]
+        return os.path.join(intermediate_path, f"{stem}_{digest}.root")
+
+    def _find_intermediate_file(self, root_file):
+        """Return the intermediate file of an input if it is up to date and contains all required columns."""
+        intermediate_file = self._intermediate_file_name(root_file)
+        metadata_file = f"{intermediate_file}.json"
+        if not os.path.exists(intermediate_file) or not os.path.exists(metadata_file):
+            return None
+        with open(metadata_file, "r") as f:
+            metadata = json.load(f)
+        missing_columns = set(self._required_columns()) - set(metadata["columns"])
+        if missing_columns:
+            logging.info(f"Intermediate file {intermediate_file} is missing columns {sorted(missing_columns)}")
+            return None
+        return intermediate_file
+
+    def _save_intermediate_file(self, df, root_file):
+        """Snapshot the columns needed by the config to a slim ROOT file and read back from it."""
+        import ROOT
+        intermediate_file = self._intermediate_file_name(root_file)
+        os.makedirs(os.path.dirname(intermediate_file), exist_ok=True)
+        columns = self._required_columns()
+        logging.info(f"Saving {len(columns)} columns to intermediate file {intermediate_file}")
+        tree_name = self.config["input"]["tree_name"]
+        with self._time_stage("intermediate"):
+            df.Snapshot(tree_name, f"{intermediate_file}.tmp", columns)
+        # Only rename once the snapshot is complete so that interrupted runs are never reused
+        os.replace(f"{intermediate_file}.tmp", intermediate_file)
+        with open(f"{intermediate_file}.json", "w") as f:
+            json.dump({"key": self._intermediate_key(root_file), "columns": columns}, f, indent=2, default=str)
+        return ROOT.RDataFrame(tree_name, intermediate_file)
+
+    def _enable_rdf_jit_logging(self):
+        import ROOT
+        try:
+            self._rdf_log_verbosity = ROOT.Experimental.RLogScopedVerbosity(
+                ROOT.Detail.RDF.RDFLogChannel(), ROOT.Experimental.ELogLevel.kInfo
+            )
+        except AttributeError:
+            logging.debug("RDataFrame logging is not available in this ROOT version")
+
+    def _root_to_h5(self, df, output_file_name, config, source_file=None, object_lengths=None):
+        """Convert processed ROOT DataFrame to H5 format.
+
+        object_lengths gives the lengths per event of linked Objects that are not in the config.
+        """
         logging.info(f"Converting ROOT RDataFrame to H5 file {output_file_name}")
         # Check if the output file already exists
         if os.path.exists(output_file_name):
@@ -198,34 +988,44 @@ class DatasetConverter:
                 logging.info(f"Output file {output_file_name} already exists. Deleting it for overwrite.")
                 os.remove(output_file_name)
 
-        with h5py.File(output_file_name, "w") as h5f:
-            vector_object_lengths = {}
+        # Extraction of the next block overlaps with the H5 writes done by the background writer
+        # Branches of an ObjectCollection are post-processed in parallel when more than one thread is set
+        pool = ThreadPoolExecutor(self.postprocess_threads, thread_name_prefix="r2h5-postprocess") if self.postprocess_threads > 1 else nullcontext()
+        with h5py.File(output_file_name, "w") as h5f, BackgroundWriter(self.writer_queue_depth) as writer, pool:
+            vector_object_lengths = dict(object_lengths or {})
+            if source_file is not None:
+                # Record the input of this output, used to trace shards back to the input files
+                h5f.attrs["source_file"] = source_file
 
             # Loop over objects in the config
-            for object_name, object_config in self.config.get("Objects", {}).items():
+            for object_name, object_config in config.get("Objects", {}).items():
                 self._log_memory_snapshot()
+                self.status.update(step=f"{os.path.basename(output_file_name)}: {object_name}")
+                save = self._saver(object_name, object_config, storage_layouts=())
                 if object_config["source_format"] == "vector":
                     logging.info(f"Converting Object data {object_name} with vector source format to H5")
-                    structured_data, object_lengths = self._extract_vector_object(df, object_name, object_config)
+                    structured_data, object_lengths, event_number = self._extract_vector_object(df, object_name, object_config)
                     if object_config.get("store_length", False):
                         vector_object_lengths[object_name] = object_lengths
-                    self._save_to_h5(h5f, object_name, structured_data)
+                    writer.submit(save, h5f, object_name, structured_data)
+                    writer.submit(self._save_offsets, h5f, object_name, object_lengths, event_number)
                     logging.info(f"Deleting {object_name} extracted data from memory")
                     del structured_data
 
                 elif object_config["source_format"] == "scalar":
                     logging.info(f"Converting Object data {object_name} with scalar source format to H5")
                     structured_data = self._extract_scalar_object(df, object_name, object_config)
-                    self._save_to_h5(h5f, object_name, structured_data)
+                    writer.submit(save, h5f, object_name, structured_data)
 
                 else:
                     logging.warning(f"Unsupported source_format '{source_format}' for object '{object_name}'")
 
             # Loop over object collections in the config
-            for objcol_name, objcol_config in self.config.get("ObjectCollections", {}).items():
+            for objcol_name, objcol_config in config.get("ObjectCollections", {}).items():
                 self._log_memory_snapshot()
+                self.status.update(step=f"{os.path.basename(output_file_name)}: {objcol_name}")
                 logging.info(f"Converting ObjectCollection data {objcol_name} with vector format to H5")
-                self._extract_object_collection(df, objcol_name, objcol_config, vector_object_lengths, h5f)
+                self._extract_object_collection(df, objcol_name, objcol_config, vector_object_lengths, h5f, writer, pool)
 
         logging.info(f"Saved H5 file to {output_file_name}")
 
@@ -234,102 +1034,300 @@ class DatasetConverter:
         lengths = None
         selection_branch = config.get("selection")
 
-        for branch in config['branches']:
+        raw = {}
+        for branch in self._input_branches(config):
             logging.info(f"Extracting branch {branch}")
             self._log_memory_snapshot()
-            raw = [r2h5.convert_rvec_to_numpy(x) for x in df.AsNumpy(columns=[branch])[branch]]
-            if config.get('store_length', False):
-                lengths = [len(x) for x in raw]
-            data[branch] = np.concatenate(raw)
+            raw[branch] = self._get_jagged(df, branch)
+            if lengths is None:
+                lengths = raw[branch][1]
+        for branch in config['branches']:
+            data[branch] = raw[branch][0]
+        data.update(self._evaluate_derived(object_name, config, {branch: flat for branch, (flat, _) in raw.items()},
+                                           {branch: branch_lengths for branch, (_, branch_lengths) in raw.items()}))
+        del raw
 
+        event_number = None
+        if config.get('event_number', False) or config.get('event_index', False):
+            event_number = self._get_scalar(df, "eventNumber")
         if config.get('event_number', False):
             logging.info(f"Duplicating event number data for {object_name} based on Object lengths.")
             self._log_memory_snapshot()
-            event_number = df.AsNumpy(columns=["eventNumber"])["eventNumber"]
-            repeated = [np.tile(event_number[i], (lengths[i],)) for i in range(len(lengths))]
-            data["eventNumber"] = np.concatenate(repeated)
+            data["eventNumber"] = np.repeat(event_number, lengths)
 
         structured = self._build_structured_array(data)
-        return structured, lengths
+        return structured, lengths, event_number
 
     def _extract_scalar_object(self, df, object_name, config):
-        data = {}
-        for branch in config['branches']:
+        raw = {}
+        for branch in self._input_branches(config):
             logging.debug(f"Extracting branch {branch}")
-            data[branch] = df.AsNumpy(columns=[branch])[branch]
+            raw[branch] = self._get_scalar(df, branch)
+        data = {branch: raw[branch] for branch in config['branches']}
+        data.update(self._evaluate_derived(object_name, config, raw))
 
         return self._build_structured_array(data)
 
-    def _extract_object_collection(self, df, name, config, lengths, h5f):
-        max_objects = config['max_objects']
+    def _extract_object_collection(self, df, name, config, lengths, h5f, writer, pool=None):
+        layout = self._parse_layout(name, config, COLLECTION_LAYOUTS)[0] or "padded"
+        save = self._saver(name, config, COLLECTION_LAYOUTS)
+        max_objects = config.get('max_objects')
+        if layout == "padded" and max_objects is None:
+            logging.error(f"ObjectCollection '{name}' needs max_objects with the padded layout")
+            exit(1)
+        if layout == "linked" and not config.get('object_link'):
+            logging.error(f"ObjectCollection '{name}' needs an object_link with the linked layout")
+            exit(1)
         selection_branch = config.get("selection")
+        derived_fields = config.get("derived", {})
 
         # Ensure selection branch is included if it's used
-        if selection_branch and selection_branch not in config['branches']:
+        if selection_branch and selection_branch not in config['branches'] and selection_branch not in derived_fields:
             logging.debug(f"Adding selection branch {selection_branch} to branches for {name}")
             config['branches'].append(selection_branch)
     
-        # Repeat data if this ObjectCollection is linked to a parent Object
-        indices = None
-        repeat_count = None
+        # Gather data per parent Object if this ObjectCollection is linked to one
+        link = None
         if config.get('object_link'):
             link_object = config['object_link']['object']
             logging.debug(f"Duplicating data for {name} based on length of {link_object} Object per event.")
             repeat_count = lengths.get(link_object, [])
             logging.debug(f"Got {len(repeat_count)} lengths for vector object {link_object}")
-            if repeat_count == []:
+            if len(repeat_count) == 0 and layout == "linked":
+                logging.error(f"Link object {link_object} of '{name}' must be a vector Object converted before it")
+                exit(1)
+            if len(repeat_count) == 0:
                 logging.warning(f"Link object {link_object} not found in vector object lengths dictionary. This will result in a mismatch between the Objects and ObjectCollection lengths.")
+            else:
+                link_col = config['object_link']['link']
+                link = (*self._get_link(df, link_col), repeat_count)
+                logging.debug(f"Got {len(link[1])} indices for {name} ObjectCollection")
 
-            link_col = config['object_link']['link']
-            raw_link_data = df.AsNumpy(columns=[link_col])[link_col]    
-            # Flatten just one level (event -> jets), each item is a vector<int>
-            obj_collection_indices = [jet for event in raw_link_data for jet in event]
-            logging.debug(f"Extracted {len(obj_collection_indices)} link indices")
-            # Convert ROOT RVec to numpy array
-            indices = [r2h5.convert_rvec_to_numpy(collection_indices) for collection_indices in obj_collection_indices]
-            logging.debug(f"Got {len(indices)} indices for {name} ObjectCollection")
-
-        # Extract raw branch data
-        selection_data = self._get_associated_object_collection_data(df, selection_branch, indices, repeat_count) if selection_branch else None
-        saved_valid = False
-        for branch in config['branches']:
-            # Get the raw data
-            raw_branch_data = self._get_associated_object_collection_data(df, branch, indices, repeat_count)
-            
-            # Apply selection if provided
-            if selection_data:
-                raw_branch_data = [
-                    arr[mask.astype(bool)] for arr, mask in zip(raw_branch_data, selection_data)
-                ]
+        # Extract raw branch data as flat values and lengths per event, the input is only read from this thread
+        raw = {}
+        for branch in self._input_branches(config):
+            logging.info(f"Extracting branch {branch}")
+            raw[branch] = self._get_jagged(df, branch)
+        self._log_memory_snapshot()
+        event_lengths = next(iter(raw.values()))[1]
+        # Derived fields are evaluated on the flat values, before linking, selection and padding
+        derived_data = self._evaluate_derived(name, config, {branch: flat for branch, (flat, _) in raw.items()},
+                                              {branch: branch_lengths for branch, (_, branch_lengths) in raw.items()})
+        raw.update((field, (values, event_lengths)) for field, values in derived_data.items())
+        selection = raw[selection_branch][0].astype(bool) if selection_branch else None
+        # Inputs of derived fields that are not listed as branches are not written
+        fields = list(dict.fromkeys(config['branches'] + list(derived_data)))
+
+        # Where each stored value comes from in the flat values, shared by all branches
+        try:
+            if layout == "linked":
+                positions, row_lengths, link_indices, link_lengths = self._linked_positions(event_lengths, link, selection)
+            else:
+                positions, row_lengths = self._collection_positions(event_lengths, link, selection)
+        except IndexError as e:
+            logging.error(f"Link {config['object_link']['link']} of '{name}': {e}")
+            exit(1)
+        rows = columns = None
+        if layout in ("ragged", "linked"):
+            data = np.zeros(len(positions), dtype=[(field, raw[field][0].dtype) for field in fields])
+        else:
+            self._log_truncation(name, row_lengths, max_objects)
+            rows, columns, kept = r2h5.pad_indices(row_lengths, max_objects)
+            positions = positions[kept]
+            dtype = [(field, raw[field][0].dtype) for field in fields]
+            data = np.zeros((len(row_lengths), max_objects), dtype=dtype[:1] + [("valid", bool)] + dtype[1:])
+            data["valid"][rows, columns] = True
+
+        # Gather the values of each field into its preallocated column
+        post_process = lambda field: self._fill_column(data[field], raw[field][0], positions, rows, columns)
+        if isinstance(pool, ThreadPoolExecutor):
+            list(pool.map(post_process, fields))
+        else:
+            for field in fields:
+                post_process(field)
+        del raw
+
+        # Save the data to HDF5
+        writer.submit(save, h5f, name, data)
+        if layout in ("ragged", "linked"):
+            writer.submit(self._save_offsets, h5f, name, row_lengths, None, layout)
+        if layout == "linked":
+            writer.submit(self._save_link_indices, h5f, name, link_indices, link_lengths, config['object_link']['object'])
+        elif link is not None:
+            # Record the Object whose rows this collection follows, for readers that do not have the config
+            writer.submit(self._save_attributes, h5f, name, {"object_link": config['object_link']['object']})
+
+    def _prefetch_columns(self, df, output_file_names, output_configs=None):
+        """Read all columns required by the outputs in one event loop and keep them for this file."""
+        if not self.overwrite_existing_output_files and all(os.path.exists(name) for name in output_file_names):
+            return
+        columns = self._required_columns(output_configs)
+        logging.info(f"Reading {len(columns)} columns shared by {len(output_file_names)} outputs in one event loop")
+        if isinstance(df, UprootSource):
+            df.prefetch(columns, progress=lambda n_events: self.status.update(events_done=self._events_before + n_events))
+        else:
+            self._column_cache = self._as_numpy_with_progress(df, columns)
+
+    def _as_numpy_with_progress(self, df, columns):
+        """Read columns with AsNumpy, reporting the events processed by the event loop to the status.
+
+        The event loop is started from C++ with the GIL released, so that the status threads can
+        poll the event counter and refresh the status while it runs.
+        """
+        import ROOT
+        if not hasattr(ROOT, "r2h5_progress"):
+            ROOT.gInterpreter.Declare(PROGRESS_CPP)
+            ROOT.r2h5_progress.Run.__release_gil__ = True
+        result = df.AsNumpy(columns=columns, lazy=True)
+        count = ROOT.r2h5_progress.Book(ROOT.RDF.AsRNode(df), PROGRESS_EVENTS)
+        with self.status.watch(lambda: int(ROOT.r2h5_progress.Processed()), base=self._events_before):
+            ROOT.r2h5_progress.Run(count)
+        return result.GetValue()
+
+    def _get_column(self, df, column):
+        if self._column_cache is not None and column in self._column_cache:
+            return self._column_cache[column]
+        return self._as_numpy_with_progress(df, [column])[column]
+
+    def _get_scalar(self, df, column):
+        """Return a scalar column as a numpy array."""
+        if isinstance(df, UprootSource):
+            return df.get_scalar(column)
+        return self._get_column(df, column)
 
-            # Final padding
-            data = {}
-            padded, valid = r2h5.fix_array_size_and_create_valid(
-                raw_branch_data, max_objects, compute_valid=("valid" not in config)
+    def _get_jagged(self, df, column):
+        """Return a vector column as flat values and lengths per event."""
+        if isinstance(df, UprootSource):
+            return df.get_jagged(column)
+        return r2h5.flatten_arrays([r2h5.convert_rvec_to_numpy(x) for x in self._get_column(df, column)])
+
+    def _get_link(self, df, column):
+        """Return a vector<vector<int>> link column as flat indices and the number of indices per object."""
+        if isinstance(df, UprootSource):
+            return df.get_link(column)
+        # Flatten just one level (event -> jets), each item is a vector<int>
+        obj_collection_indices = [jet for event in self._get_column(df, column) for jet in event]
+        logging.debug(f"Extracted {len(obj_collection_indices)} link indices")
+        return r2h5.flatten_arrays([r2h5.convert_rvec_to_numpy(indices) for indices in obj_collection_indices])
+
+    def _multiplicity_expression(self, config):
+        """C++ expression for the number of selected objects per event, or per linked object."""
+        selected = f"({config['selection']}[idx] != 0)" if config.get("selection") else "1"
+        if config.get("object_link"):
+            link = config["object_link"]["link"]
+            return (
+                f"ROOT::VecOps::RVec<int> n({link}.size());"
+                f"for (size_t i = 0; i < {link}.size(); ++i) {{ for (auto idx : {link}[i]) n[i] += {selected}; }}"
+                "return n;"
             )
-            data[branch] = padded
-            if valid is not None and not saved_valid:
-                data["valid"] = valid
-                saved_valid = True
-
-            # Save the data to HDF5
-            structured_data = self._build_structured_array(data)
-            self._save_to_h5(h5f, name, structured_data)
-
-    def _get_associated_object_collection_data(self, df, branch, indices, repeat_count):
-        logging.info(f"Extracting branch {branch}")
-        raw_branch_data =  [r2h5.convert_rvec_to_numpy(x) for x in df.AsNumpy(columns=[branch])[branch]]
-        if indices and repeat_count:
-            raw_branch_data = self._repeat_vectors(raw_branch_data, repeat_count)
-            raw_branch_data = [raw_branch_data[i][idx.astype(np.int32)] for i, idx in enumerate(indices)]
-        self._log_memory_snapshot()
-        return raw_branch_data
+        if config.get("selection"):
+            return f"(int) ROOT::VecOps::Sum({config['selection']} != 0)"
+        return f"(int) {config['branches'][0]}.size()"
+
+    def _log_truncation(self, name, row_lengths, max_objects):
+        truncated = row_lengths > max_objects
+        if not truncated.any():
+            return
+        objects_lost = int((row_lengths[truncated] - max_objects).sum())
+        logging.warning(
+            f"{name}: {truncated.sum()} of {len(row_lengths)} rows ({100*truncated.mean():.2f}%) exceed max_objects={max_objects}, "
+            f"dropping {objects_lost} of {row_lengths.sum()} selected objects"
+        )
+
+    def _collection_positions(self, lengths, link, selection=None):
+        """Return the position in the raw flat values of each stored value of a collection, and the stored lengths per row.
+
+        Linking and selection are applied to the positions once, so that each branch is a single gather.
+        """
+        positions, row_lengths = np.arange(lengths.sum(), dtype=np.int64), lengths
+        if link is not None:
+            positions, row_lengths = r2h5.gather_jagged(positions, lengths, *link)
+        if selection is not None:
+            positions, row_lengths = r2h5.select_jagged(positions, row_lengths, selection[positions])
+        return positions, row_lengths
+
+    def _linked_positions(self, lengths, link, selection=None):
+        """Return the positions and number per event of the stored values of a linked layout collection,
+        and the indices of the values of each linked object within its event with their number per object.
+
+        Each selected value is stored once per event, however many objects it is linked to.
+        """
+        positions, event_lengths = np.arange(lengths.sum(), dtype=np.int64), lengths
+        # Index of each value among the stored values of its event, -1 for values that are not selected
+        local = positions - np.repeat(r2h5.build_offsets(lengths)[:-1], lengths)
+        if selection is not None:
+            positions, event_lengths = r2h5.select_jagged(positions, lengths, selection)
+            rank = np.cumsum(selection) - 1
+            local = np.where(selection, rank - np.repeat(r2h5.build_offsets(event_lengths)[:-1], lengths), -1)
+        link_indices, link_lengths = r2h5.gather_jagged(local, lengths, *link)
+        if selection is not None:
+            link_indices, link_lengths = r2h5.select_jagged(link_indices, link_lengths, link_indices >= 0)
+        return positions, event_lengths, link_indices, link_lengths
+
+    def _fill_column(self, column, flat, positions, rows=None, columns=None):
+        """Write the values of one branch into its output column, NumPy releases the GIL for the copies."""
+        if rows is None:
+            column[:] = flat[positions]
+        else:
+            column[rows, columns] = flat[positions]
+
+    def _save_offsets(self, h5f, name, lengths, event_number=None, layout=None):
+        """Save the per-event row offsets of a dataset, and optionally its sorted eventNumber index."""
+        offsets = r2h5.build_offsets(lengths)
+        h5f.create_dataset(f"{name}_offsets", data=offsets)
+        h5f[name].attrs["offsets"] = f"{name}_offsets"
+        if layout is not None:
+            h5f[name].attrs["layout"] = layout
+        if event_number is not None:
+            h5f.create_dataset(f"{name}_event_index", data=r2h5.build_event_index(event_number, offsets))
+            h5f[name].attrs["event_index"] = f"{name}_event_index"
 
-    def _repeat_vectors(self, data_list, counts):
-        repeated = []
-        for i in range(len(counts)):
-            repeated.extend([data_list[i]] * counts[i])
-        return repeated
+    def _save_link_indices(self, h5f, name, indices, lengths, link_object):
+        """Save the indices of the values of each linked object within the stored values of its event."""
+        dtype = np.int16 if len(indices) == 0 or indices.max() <= np.iinfo(np.int16).max else np.int32
+        h5f.create_dataset(f"{name}_link_indices", data=indices.astype(dtype))
+        h5f.create_dataset(f"{name}_link_offsets", data=r2h5.build_offsets(lengths))
+        # The index dataset is a ragged collection linked to the Object, the values are per event
+        h5f[f"{name}_link_indices"].attrs["offsets"] = f"{name}_link_offsets"
+        h5f[f"{name}_link_indices"].attrs["object_link"] = link_object
+        h5f[name].attrs["link_indices"] = f"{name}_link_indices"
+
+    def _save_attributes(self, h5f, name, attributes):
+        for key, value in attributes.items():
+            h5f[name].attrs[key] = value
+
+    def _parse_layout(self, name, config, storage_layouts=("padded", "ragged")):
+        """Return the storage layout of the objects (or None if not set) and whether the fields are stored columnar.
+
+        layout is a single value or a list, e.g. [ragged, columnar].
+        """
+        layouts = config.get("layout", [])
+        layouts = [layouts] if isinstance(layouts, str) else list(layouts)
+        storage = [layout for layout in layouts if layout != "columnar"]
+        if len(storage) > 1 or any(layout not in storage_layouts for layout in storage):
+            logging.error(f"Unsupported layout {config.get('layout')} for '{name}', use columnar or one of {', '.join(storage_layouts)}")
+            exit(1)
+        return (storage[0] if storage else None), "columnar" in layouts
+
+    def _saver(self, name, config, storage_layouts=("padded", "ragged")):
+        """Return the function writing the data of an Object or ObjectCollection in its layout."""
+        if not self._parse_layout(name, config, storage_layouts)[1]:
+            return self._save_to_h5
+        chunk_rows = config.get("chunk_rows", COLUMNAR_CHUNK_ROWS)
+        return lambda h5f, name, data: self._save_columns(h5f, name, data, chunk_rows)
+
+    def _save_columns(self, h5f, name, data, chunk_rows=COLUMNAR_CHUNK_ROWS):
+        """Save each field as its own dataset in a group, all chunked along the rows with chunk_rows."""
+        # Keep the fields in the order of the branches in the config
+        group = h5f[name] if name in h5f else h5f.create_group(name, track_order=True)
+        for field in data.dtype.names:
+            if field in group:
+                logging.debug(f"Field '{field}' already saved in '{name}'")
+                continue
+            logging.debug(f"Saving {name}/{field} as a dataset.")
+            values = np.ascontiguousarray(data[field])
+            chunks = (min(chunk_rows, len(values)),) + values.shape[1:] if len(values) else None
+            group.create_dataset(field, data=values, chunks=chunks)
 
     def _build_structured_array(self, data_dict):
         dtype = [(k, v.dtype) for k, v in data_dict.items()]
@@ -369,12 +1367,34 @@ class DatasetConverter:
                 elif field not in old_dtype.names:
                     extended_data[field] = np.zeros(existing.shape, dtype=extended_data[field].dtype)
 
+            attrs = dict(h5f[name].attrs)
             del h5f[name]
             h5f.create_dataset(name, data=extended_data)
+            h5f[name].attrs.update(attrs)
 
         else:
             h5f.create_dataset(name, data=data)
 
+    @contextmanager
+    def _time_stage(self, stage):
+        start = time.perf_counter()
+        self.status.update(stage=stage, step=None)
+        try:
+            yield
+        finally:
+            self.stage_times[stage] = self.stage_times.get(stage, 0) + time.perf_counter() - start
+            self.stage_rss[stage] = cost_model.peak_rss()
+
+    def _log_timing_summary(self):
+        logging.info("Timing summary:")
+        for stage, seconds in self.stage_times.items():
+            logging.info(f"    {stage:<12s}: {seconds:.2f} s")
+
+    def write_stage_report(self, path):
+        """Write the time spent in each stage and the peak memory at its end to a JSON file."""
+        with open(path, "w") as f:
+            json.dump({"stage_times": self.stage_times, "stage_rss": self.stage_rss}, f, indent=2)
+
     def _start_memory_monitor(self):
         tracemalloc.start()
         current, peak = tracemalloc.get_traced_memory()
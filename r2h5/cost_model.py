@@ -0,0 +1,126 @@
+import json
+import logging
+import math
+import os
+import resource
+import subprocess
+import time
+import numpy as np
+
+# Stages whose duration grows with the number of events, the others are paid once per job
+SCALING_STAGES = ("dataframe", "event_loop", "conversion")
+# Smallest requests made to the batch system
+MIN_MINUTES = 10
+MIN_MEMORY_GB = 1
+
+def peak_rss():
+    """Peak resident memory of this process in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def entry_counts(root_files, tree_name):
+    """Number of entries of the tree in each input file, read from the file metadata only.
+
+    Files are opened with uproot, or with ROOT when uproot is not installed or cannot read them.
+    The count of a file neither can read is None.
+    """
+    return [entry_count(root_file, tree_name) for root_file in root_files]
+
+def entry_count(root_file, tree_name):
+    try:
+        import uproot
+        with uproot.open(root_file) as f:
+            return int(f[tree_name].num_entries)
+    except Exception as e:
+        logging.debug(f"Could not read the entries of {root_file} with uproot: {e}")
+    try:
+        import ROOT
+    except ImportError:
+        logging.warning(f"Could not read the entries of {root_file}")
+        return None
+    f = ROOT.TFile.Open(root_file)
+    tree = f.Get(tree_name) if f and not f.IsZombie() else None
+    n_entries = int(tree.GetEntries()) if tree else None
+    if f:
+        f.Close()
+    if n_entries is None:
+        logging.warning(f"Could not read the entries of {root_file}")
+    return n_entries
+
+def sample_files(entries, n_files):
+    """Indices of n_files input files spread evenly over the range of entry counts."""
+    order = np.argsort(entries, kind="stable")
+    if n_files >= len(order):
+        return sorted(order.tolist())
+    return sorted(order[np.linspace(0, len(order) - 1, n_files).round().astype(int)].tolist())
+
+def run_sample(command, report_path):
+    """Run a sample conversion and return its wall time, peak memory in bytes and stage report."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    # wait4 reaps the process and gives the resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+    if process.returncode != 0:
+        logging.error(f"Sample conversion failed: {' '.join(command)}\n{stderr.decode()[-2000:]}")
+        return None
+    with open(report_path) as f:
+        report = json.load(f)
+    return wall, usage.ru_maxrss * 1024, report
+
+def sample_costs(events, wall, peak_memory, report, output_bytes):
+    """Split the measured cost of a sample conversion into a fixed part and a part per event."""
+    scaling_seconds = sum(report["stage_times"].get(stage, 0) for stage in SCALING_STAGES)
+    # Memory once the input is opened, before any branch is read
+    base_memory = report["stage_rss"].get("dataframe", peak_memory)
+    events = max(events, 1)
+    return {
+        "events": events,
+        "fixed_seconds": max(wall - scaling_seconds, 0),
+        "seconds_per_event": scaling_seconds / events,
+        "base_memory": base_memory,
+        "memory_per_event": max(peak_memory - base_memory, 0) / events,
+        "bytes_per_event": output_bytes / events,
+        "stage_seconds_per_event": {stage: report["stage_times"].get(stage, 0) / events for stage in SCALING_STAGES},
+    }
+
+def fit_model(samples):
+    """Combine the sample costs into one conservative model, taking the largest rate of each kind."""
+    return {
+        "fixed_seconds": max(sample["fixed_seconds"] for sample in samples),
+        "seconds_per_event": max(sample["seconds_per_event"] for sample in samples),
+        "base_memory": max(sample["base_memory"] for sample in samples),
+        "memory_per_event": max(sample["memory_per_event"] for sample in samples),
+        "bytes_per_event": float(np.mean([sample["bytes_per_event"] for sample in samples])),
+    }
+
+def predict(model, entries):
+    """Predicted runtime in seconds, peak memory and output size in bytes of a job over entries events."""
+    return {
+        "seconds": model["fixed_seconds"] + model["seconds_per_event"] * entries,
+        "memory": model["base_memory"] + model["memory_per_event"] * entries,
+        "output_bytes": model["bytes_per_event"] * entries,
+    }
+
+def requested_minutes(prediction, safety_margin=1.5):
+    """Requested wall time in minutes for a predicted job."""
+    return max(MIN_MINUTES, math.ceil(prediction["seconds"] * safety_margin / 60))
+
+def slurm_resources(prediction, safety_margin=1.5):
+    """Slurm time (HH:MM:SS) and memory (GB) requests for a predicted job, with a safety margin."""
+    minutes = requested_minutes(prediction, safety_margin)
+    memory_gb = max(MIN_MEMORY_GB, math.ceil(prediction["memory"] * safety_margin / 1024**3))
+    return f"{minutes // 60:02d}:{minutes % 60:02d}:00", memory_gb
+
+def log_estimate(plan, safety_margin=1.5):
+    """Log the production-wide totals of a plan."""
+    jobs = plan["jobs"]
+    requests = [slurm_resources(job, safety_margin) for job in jobs]
+    core_hours = sum(job["seconds"] for job in jobs) / 3600
+    requested_hours = sum(requested_minutes(job, safety_margin) for job in jobs) / 60
+    logging.info(f"Production estimate for {len(jobs)} jobs over {sum(job['entries'] for job in jobs)} events:")
+    logging.info(f"    runtime  : {core_hours:.1f} core hours in total, longest job {max(job['seconds'] for job in jobs)/60:.1f} min")
+    logging.info(f"    memory   : largest job {max(job['memory'] for job in jobs)/1024**3:.2f} GB")
+    logging.info(f"    output   : {sum(job['output_bytes'] for job in jobs)/1024**3:.2f} GB")
+    logging.info(f"    requested: {requested_hours:.1f} hours, {max(memory for _, memory in requests)} GB for the largest job (safety margin {safety_margin})")
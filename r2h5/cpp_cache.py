@@ -0,0 +1,101 @@
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import re
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "r2h5")
+LIBRARY_NAME = "r2h5_helpers"
+# Includes with quotes, which are searched next to the including file first
+INCLUDE_PATTERN = re.compile(rb'^\s*#\s*include\s*"([^"]+)"', re.MULTILINE)
+
+def get_cache_dir(config):
+    """Return the directory holding compiled cpp_helpers libraries."""
+    return os.environ.get("R2H5_CACHE_DIR", config.get("cpp_cache_dir", DEFAULT_CACHE_DIR))
+
+def helper_hash(header_paths, root_version):
+    """Hash of the header contents and ROOT version identifying a compiled library.
+
+    The local headers included with #include "..." are hashed too, so editing one of them also
+    triggers a rebuild.
+    """
+    digest = hashlib.sha256(root_version.encode())
+    for header_path in header_paths:
+        digest.update(os.path.basename(header_path).encode())
+        for path in _local_includes(header_path):
+            digest.update(os.path.relpath(path, os.path.dirname(os.path.abspath(header_path))).encode())
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+def _local_includes(header_path):
+    """A header followed by the files it includes with quotes, recursively, that exist next to the including file."""
+    paths = [os.path.abspath(header_path)]
+    for path in paths:
+        with open(path, "rb") as f:
+            included = INCLUDE_PATTERN.findall(f.read())
+        for name in included:
+            include_path = os.path.normpath(os.path.join(os.path.dirname(path), name.decode()))
+            if not os.path.isfile(include_path):
+                logging.debug(f"{name.decode()} included by {path} is not a local file, it is not part of the cpp_helpers cache key")
+            elif include_path not in paths:
+                paths.append(include_path)
+    return paths
+
+def load_cpp_helpers(header_paths, cache_dir):
+    """Load the cpp_helpers as a compiled library, building it once if it is not cached yet.
+
+    Returns False if the library could not be built or loaded, in which case the caller
+    should fall back to declaring the headers to the interpreter.
+    """
+    import ROOT
+    digest = helper_hash(header_paths, ROOT.gROOT.GetVersion())
+    build_dir = os.path.join(cache_dir, "cpp_helpers", digest)
+    os.makedirs(build_dir, exist_ok=True)
+
+    # Concurrent batch jobs wait here while the first one compiles the library
+    with open(os.path.join(build_dir, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        library = _find_library(build_dir)
+        if library is None:
+            logging.info(f"Compiling cpp_helpers library in {build_dir}")
+            library = _compile_library(header_paths, build_dir)
+        else:
+            logging.info(f"Found cached cpp_helpers library {library}")
+
+    if library is None:
+        return False
+    if ROOT.gSystem.Load(library) < 0:
+        logging.warning(f"Could not load cached cpp_helpers library {library}")
+        return False
+    return True
+
+def _find_library(build_dir):
+    marker = os.path.join(build_dir, "complete")
+    if not os.path.exists(marker):
+        return None
+    with open(marker, "r") as f:
+        library = f.read().strip()
+    return library if os.path.exists(library) else None
+
+def _compile_library(header_paths, build_dir):
+    import ROOT
+    source = os.path.join(build_dir, f"{LIBRARY_NAME}.C")
+    with open(source, "w") as f:
+        f.write('#include "ROOT/RVec.hxx"\n')
+        for header_path in header_paths:
+            f.write(f'#include "{os.path.abspath(header_path)}"\n')
+
+    if ROOT.gSystem.CompileMacro(source, "kO", os.path.join(build_dir, LIBRARY_NAME), build_dir) != 1:
+        logging.warning(f"Compilation of {source} failed")
+        return None
+    libraries = glob.glob(os.path.join(build_dir, f"{LIBRARY_NAME}*.so"))
+    if not libraries:
+        logging.warning(f"Compiled library not found in {build_dir}")
+        return None
+
+    # Written last so that an interrupted build is never picked up by other jobs
+    with open(os.path.join(build_dir, "complete"), "w") as f:
+        f.write(libraries[0])
+    return libraries[0]
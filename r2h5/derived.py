@@ -0,0 +1,90 @@
+import ast
+import numpy as np
+from r2h5.type import output_dtype
+
+def delta_phi(phi1, phi2):
+    """Difference of two azimuthal angles wrapped into [-pi, pi)."""
+    return (np.asarray(phi1) - phi2 + np.pi) % (2 * np.pi) - np.pi
+
+def delta_r(eta1, phi1, eta2, phi2):
+    return np.hypot(np.asarray(eta1) - eta2, delta_phi(phi1, phi2))
+
+# Elementwise functions that can be called in the expressions of derived fields
+FUNCTIONS = {name: getattr(np, name) for name in (
+    "abs", "sqrt", "square", "exp", "log", "log10", "power", "hypot", "sin", "cos", "tan",
+    "arcsin", "arccos", "arctan", "arctan2", "sinh", "cosh", "tanh", "arcsinh", "arccosh", "arctanh",
+    "minimum", "maximum", "clip", "where", "sign", "floor", "ceil", "round", "mod",
+    "isfinite", "isnan", "logical_and", "logical_or", "logical_not",
+)}
+FUNCTIONS.update(delta_phi=delta_phi, delta_r=delta_r)
+CONSTANTS = {"pi": np.pi, "inf": np.inf}
+# Syntax allowed in expressions: arithmetic, comparisons, & | ~ and calls of the functions above
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Load, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.BitAnd, ast.BitOr, ast.BitXor,
+    ast.USub, ast.UAdd, ast.Invert, ast.Not, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+
+def parse(name, expression):
+    """Check the expression of a derived field and return its compiled code and the columns it reads.
+
+    Raises a ValueError for syntax that is not a plain elementwise expression.
+    """
+    try:
+        tree = ast.parse(str(expression), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"invalid expression for {name}: {expression} ({e.msg})")
+    columns = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.BoolOp):
+            raise ValueError(f"use & and | instead of and/or in the expression of {name}: {expression}")
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError(f"{type(node).__name__} is not allowed in the expression of {name}: {expression}")
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords:
+                raise ValueError(f"{ast.unparse(node.func)} is not an allowed function, or is called with keywords, in the expression of {name}: {expression}")
+        elif isinstance(node, ast.Name) and node.id not in FUNCTIONS and node.id not in CONSTANTS:
+            columns.append(node.id)
+    return compile(tree, f"<derived {name}>", "eval"), list(dict.fromkeys(columns))
+
+def check(derived, branches):
+    """Check the derived fields of an Object or ObjectCollection against its branches."""
+    for name, expression in derived.items():
+        if name in branches:
+            raise ValueError(f"derived field {name} is also listed in branches")
+        parse(name, expression)
+
+def input_columns(derived):
+    """Input columns read by the derived fields, other derived fields excluded."""
+    columns = []
+    for name, expression in derived.items():
+        columns.extend(column for column in parse(name, expression)[1] if column not in derived)
+    return list(dict.fromkeys(columns))
+
+def evaluate(derived, columns, size=None):
+    """Evaluate derived fields in their config order over flat input columns of the same length.
+
+    A derived field can read the fields derived before it. The results are converted to the
+    dtypes the input branches are written with, so comparisons give int32 flags. size is the
+    number of rows, which constant fields are broadcast to, by default the length of the columns.
+    """
+    namespace = {**FUNCTIONS, **CONSTANTS, **columns}
+    if size is None:
+        size = len(next(iter(columns.values()))) if columns else 0
+    results = {}
+    for name, expression in derived.items():
+        code, reads = parse(name, expression)
+        missing = [column for column in reads if column not in namespace]
+        if missing:
+            raise ValueError(f"{name} reads {', '.join(missing)}, which is neither a branch nor an earlier derived field")
+        try:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                value = np.asarray(eval(code, {"__builtins__": {}}, namespace))
+        except (TypeError, ValueError, ArithmeticError) as e:
+            raise ValueError(f"could not evaluate {name} = {expression}: {e}")
+        if value.ndim == 0:
+            value = np.full(size, value)
+        if value.shape != (size,):
+            raise ValueError(f"{name} has shape {value.shape} instead of the {size} values of its inputs")
+        results[name] = namespace[name] = value.astype(output_dtype(value.dtype), copy=False)
+    return results
@@ -0,0 +1,274 @@
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+from r2h5 import setup_logging
+from r2h5.inventory import expand_paths
+from r2h5.reader import count_rows, read_fields
+from r2h5.type import build_offsets
+
+# r2h5-index build index_dir "output/folder/*.h5" "processed/*.h5" -j 16
+# r2h5-index lookup index_dir 123456 123457
+
+INDEX_DTYPE = [("eventNumber", np.int64), ("run", np.int64), ("file_id", np.int32), ("event", np.int64)]
+
+def find_event_numbers(h5f, event_number=None, run_field="runNumber"):
+    """Return the eventNumber and run of each event of a file.
+
+    Taken from event_number ("dataset.field"), from the first event-level dataset with an
+    eventNumber field, or from the event index of a vector Object. The run is 0 if the dataset
+    has no run_field.
+    """
+    candidates = [tuple(event_number.split("."))] if event_number else []
+    for name in h5f:
+        node = h5f[name]
+        # Padded collections are skipped, their first slot is not always filled
+        if "eventNumber" in _fields(node) and not _is_multidimensional(node) and not {"offsets", "object_link"} & set(node.attrs):
+            candidates.append((name, "eventNumber"))
+    for name, field in candidates:
+        with_run = run_field in _fields(h5f[name])
+        data = read_fields(h5f, name, [field] + ([run_field] if with_run else []))
+        runs = data[run_field] if with_run else np.zeros(len(data), dtype=np.int64)
+        return data[field].astype(np.int64), runs.astype(np.int64)
+    for name in h5f:
+        if "event_index" in h5f[name].attrs:
+            index = h5f[h5f[name].attrs["event_index"]][:]
+            if "event" in index.dtype.names:
+                event_numbers = np.empty(len(index), dtype=np.int64)
+                event_numbers[index["event"]] = index["eventNumber"]
+                return event_numbers, np.zeros(len(index), dtype=np.int64)
+    return None, None
+
+def _fields(node):
+    if isinstance(node, h5py.Group):
+        return list(node.keys())
+    return list(node.dtype.names or [])
+
+def _is_multidimensional(node):
+    if isinstance(node, h5py.Group):
+        return any(len(node[field].shape) > 1 for field in node)
+    return len(node.shape) > 1
+
+def event_row_offsets(h5f, n_events):
+    """Return, for each dataset (or columnar group) of a file, the offsets of the rows of each event.
+
+    The rows of event i are offsets[i]:offsets[i+1]. Datasets whose rows cannot be related to the
+    events are left out.
+    """
+    referenced = {h5f[name].attrs[key] for name in h5f for key in ("offsets", "event_index") if key in h5f[name].attrs}
+    events = np.arange(n_events + 1, dtype=np.int64)
+    offsets = {}
+
+    def resolve(name):
+        if name in offsets:
+            return offsets[name]
+        node = h5f[name]
+        parent = events
+        if "object_link" in node.attrs:
+            # Rows of a linked collection follow the rows of the Object it is linked to
+            parent = resolve(node.attrs["object_link"])
+            if parent is None:
+                return None
+        if "offsets" in node.attrs:
+            row_offsets = h5f[node.attrs["offsets"]][:]
+            if len(row_offsets) != parent[-1] + 1:
+                return None
+            offsets[name] = row_offsets[parent]
+        elif count_rows(h5f, name) == parent[-1]:
+            offsets[name] = parent
+        else:
+            return None
+        return offsets[name]
+
+    for name in h5f:
+        if name not in referenced and resolve(name) is None:
+            logging.debug(f"Cannot relate the rows of {name} in {h5f.filename} to its events")
+    return offsets
+
+def scan_file(file_name, event_number=None, run_field="runNumber"):
+    """Read the event numbers and the dataset names of one file."""
+    with h5py.File(file_name, "r") as h5f:
+        event_numbers, runs = find_event_numbers(h5f, event_number, run_field)
+        datasets = [] if event_numbers is None else sorted(event_row_offsets(h5f, len(event_numbers)))
+    stat = os.stat(file_name)
+    return {"path": file_name, "size": stat.st_size, "mtime": stat.st_mtime, "datasets": datasets}, event_numbers, runs
+
+def _unchanged(entry):
+    """Whether an indexed file still has the size and modification time it was scanned with."""
+    try:
+        stat = os.stat(entry["path"])
+    except OSError:
+        return False
+    return (entry["size"], entry["mtime"]) == (stat.st_size, stat.st_mtime)
+
+def update_index(index_path, paths, event_number=None, run_field="runNumber", n_workers=None):
+    """Build or incrementally update the event index of a set of files.
+
+    Files that did not change since the last update keep their entries, new and modified files,
+    indexed ones not in paths included, are scanned in parallel and merged into the sorted index,
+    and removed files are dropped.
+    """
+    os.makedirs(index_path, exist_ok=True)
+    files_path, array_path = os.path.join(index_path, "files.json"), os.path.join(index_path, "index.npy")
+    files, index = [], np.empty(0, dtype=INDEX_DTYPE)
+    if os.path.exists(files_path):
+        with open(files_path) as f:
+            files = json.load(f)["files"]
+        index = np.load(array_path)
+
+    paths = [os.path.abspath(path) for path in expand_paths(paths)]
+    # Every indexed file is checked, also those not in paths, and modified files are rescanned
+    unchanged = {entry["path"] for entry in files if _unchanged(entry)}
+    kept = [entry for entry in files if entry["path"] in unchanged]
+    dropped = {entry["file_id"] for entry in files} - {entry["file_id"] for entry in kept}
+    if dropped:
+        index = index[~np.isin(index["file_id"], list(dropped))]
+    modified = [entry["path"] for entry in files if entry["path"] not in unchanged and entry["path"] not in paths and os.path.exists(entry["path"])]
+    new_paths = [path for path in paths if path not in unchanged] + modified
+    logging.info(f"Indexing {len(new_paths)} new or modified files, keeping {len(kept)} and dropping {len(dropped)}")
+
+    next_id = max([entry["file_id"] for entry in files], default=-1) + 1
+    new_entries = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        scans = executor.map(scan_file, new_paths, [event_number] * len(new_paths), [run_field] * len(new_paths))
+        for file_id, (entry, event_numbers, runs) in enumerate(scans, start=next_id):
+            if event_numbers is None:
+                logging.warning(f"No eventNumber found in {entry['path']}, it is not indexed")
+                continue
+            entry.update(file_id=file_id, n_events=len(event_numbers))
+            kept.append(entry)
+            entries = np.empty(len(event_numbers), dtype=INDEX_DTYPE)
+            entries["eventNumber"], entries["run"] = event_numbers, runs
+            entries["file_id"], entries["event"] = file_id, np.arange(len(event_numbers))
+            new_entries.append(entries)
+
+    if new_entries:
+        new_index = np.concatenate(new_entries)
+        new_index = new_index[np.argsort(new_index["eventNumber"], kind="stable")]
+        # Merge into the sorted index without sorting it again
+        index = np.insert(index, np.searchsorted(index["eventNumber"], new_index["eventNumber"], side="right"), new_index)
+
+    np.save(array_path + ".tmp.npy", index)
+    os.replace(array_path + ".tmp.npy", array_path)
+    with open(files_path + ".tmp", "w") as f:
+        json.dump({"files": kept}, f, indent=2)
+    os.replace(files_path + ".tmp", files_path)
+    logging.info(f"Event index of {len(index)} events in {len(kept)} files written to {index_path}")
+    return EventIndex(index_path)
+
+class EventIndex:
+    """Sorted eventNumber index of a set of H5 files, memory mapped from disk."""
+    def __init__(self, index_path):
+        with open(os.path.join(index_path, "files.json")) as f:
+            self.files = {entry["file_id"]: entry for entry in json.load(f)["files"]}
+        self.index = np.load(os.path.join(index_path, "index.npy"), mmap_mode="r")
+        self._event_numbers = self.index["eventNumber"]
+
+    def lookup(self, event_numbers, runs=None):
+        """Return all index entries of the given events, with the position of the query they answer."""
+        event_numbers = np.atleast_1d(np.asarray(event_numbers, dtype=np.int64))
+        starts = np.searchsorted(self._event_numbers, event_numbers, side="left")
+        stops = np.searchsorted(self._event_numbers, event_numbers, side="right")
+        lengths = stops - starts
+        query = np.repeat(np.arange(len(event_numbers)), lengths)
+        positions = np.repeat(starts - build_offsets(lengths)[:-1], lengths) + np.arange(lengths.sum())
+        entries = np.asarray(self.index[positions])
+        if runs is not None:
+            keep = entries["run"] == np.atleast_1d(np.asarray(runs, dtype=np.int64))[query]
+            entries, query = entries[keep], query[keep]
+        return entries, query
+
+    def fetch(self, event_numbers, datasets, runs=None, fields=None, coalesce_rows=None):
+        """Fetch the rows of several datasets for many events, aligned with the order of the events.
+
+        Each dataset is read from the first indexed file holding both the event and the dataset, so
+        datasets of differently filtered files can be joined. Returns, per dataset, the rows of all
+        events and the offsets of the rows of each event (empty for events not found). Rows are read
+        per file in increasing order, coalescing ranges less than coalesce_rows (by default one chunk) apart.
+        """
+        event_numbers = np.atleast_1d(np.asarray(event_numbers, dtype=np.int64))
+        entries, query = self.lookup(event_numbers, runs)
+        result = {}
+        for name in datasets:
+            has_dataset = np.array([name in self.files[file_id]["datasets"] for file_id in entries["file_id"]], dtype=bool)
+            # First match of each event in a file with this dataset
+            candidates = np.flatnonzero(has_dataset)
+            first = candidates[np.unique(query[candidates], return_index=True)[1]]
+            by_file = {}
+            for position in first:
+                by_file.setdefault(int(entries["file_id"][position]), []).append((int(query[position]), int(entries["event"][position])))
+
+            blocks, lengths = {}, np.zeros(len(event_numbers), dtype=np.int64)
+            for file_id, matches in sorted(by_file.items()):
+                queries, events = (np.array(values, dtype=np.int64) for values in zip(*matches))
+                for i_query, rows in zip(queries, self._read_events(file_id, name, events, fields, coalesce_rows)):
+                    blocks[i_query] = rows
+                    lengths[i_query] = len(rows)
+            ordered = [blocks[i_query] for i_query in sorted(blocks)]
+            values = np.concatenate(ordered) if ordered else np.empty(0)
+            result[name] = (values, build_offsets(lengths))
+        return result
+
+    def _read_events(self, file_id, name, events, fields=None, coalesce_rows=None):
+        """Read the rows of some events of one dataset of a file, in the given order of events."""
+        entry = self.files[file_id]
+        with h5py.File(entry["path"], "r") as h5f:
+            event_offsets = event_row_offsets(h5f, entry["n_events"])[name]
+            if coalesce_rows is None:
+                node = h5f[name]
+                chunked = node[next(iter(node.keys()))] if isinstance(node, h5py.Group) else node
+                coalesce_rows = chunked.chunks[0] if chunked.chunks else 1
+            starts, stops = event_offsets[events], event_offsets[events + 1]
+            # Coalesce the row ranges into contiguous reads done in increasing row order
+            order = np.argsort(starts, kind="stable")
+            reads, read_start, read_stop = [], None, None
+            for start, stop in zip(starts[order], stops[order]):
+                if read_start is not None and start <= read_stop + coalesce_rows:
+                    read_stop = max(read_stop, stop)
+                    continue
+                if read_start is not None:
+                    reads.append((read_start, read_stop))
+                read_start, read_stop = start, stop
+            if read_start is not None:
+                reads.append((read_start, read_stop))
+            buffers = [(start, read_fields(h5f, name, fields, start, stop)) for start, stop in reads]
+
+        read_starts = np.array([start for start, _ in buffers], dtype=np.int64)
+        rows = []
+        for start, stop in zip(starts, stops):
+            read_start, buffer = buffers[np.searchsorted(read_starts, start, side="right") - 1]
+            rows.append(buffer[start - read_start:stop - read_start])
+        return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Persistent eventNumber index of H5 files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Build or incrementally update an index")
+    build.add_argument("index_path", help="Directory of the index")
+    build.add_argument("paths", nargs="+", help="H5 files, directories or glob patterns")
+    build.add_argument("--event-number", type=str, default=None, help="Dataset and field of the eventNumber, e.g. HSvertex.eventNumber")
+    build.add_argument("--run-field", type=str, default="runNumber", help="Field of the run number in the same dataset, if any")
+    build.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="Number of files scanned in parallel")
+    lookup = subparsers.add_parser("lookup", help="Print the files and rows of events")
+    lookup.add_argument("index_path", help="Directory of the index")
+    lookup.add_argument("event_numbers", nargs="+", type=int, help="eventNumbers to look up")
+    args = parser.parse_args()
+    setup_logging()
+
+    if args.command == "build":
+        update_index(args.index_path, args.paths, args.event_number, args.run_field, args.jobs)
+    else:
+        index = EventIndex(args.index_path)
+        entries, query = index.lookup(args.event_numbers)
+        for i_query, event_number in enumerate(args.event_numbers):
+            matches = entries[query == i_query]
+            if len(matches) == 0:
+                print(f"{event_number}: not found")
+            for match in matches:
+                print(f"{event_number}: run {match['run']}, event {match['event']} of {index.files[int(match['file_id'])]['path']}")
+
+if __name__ == "__main__":
+    main()
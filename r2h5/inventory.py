@@ -0,0 +1,191 @@
+import argparse
+import glob
+import json
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+
+# r2h5-inspect "output/folder/*.h5" -j 16 [--bench 5] [--json inventory.json]
+
+def expand_paths(paths):
+    """Return the sorted H5 files matching a list of files, directories or glob patterns."""
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files.update(glob.glob(os.path.join(path, "**", "*.h5"), recursive=True))
+        else:
+            files.update(glob.glob(path))
+    return sorted(files)
+
+def scan_file(file_name):
+    """Collect the metadata of every dataset in a file without reading its data."""
+    datasets = {}
+    def visit(name, node):
+        if not isinstance(node, h5py.Dataset):
+            return
+        datasets[name] = {
+            "rows": node.shape[0] if node.shape else 1,
+            "shape": list(node.shape[1:]),
+            "dtype": str(node.dtype.descr if node.dtype.names else node.dtype.str),
+            "logical_bytes": node.size * node.dtype.itemsize,
+            "storage_bytes": node.id.get_storage_size(),
+            "chunks": list(node.chunks) if node.chunks else None,
+            "filters": ",".join(f"{k}={v}" if v is not None else k for k, v in sorted(_filters(node).items())) or "none",
+        }
+    try:
+        with h5py.File(file_name, "r") as h5f:
+            h5f.visititems(visit)
+    except Exception as e:
+        return {"file": file_name, "error": str(e), "datasets": {}}
+    return {"file": file_name, "error": None, "datasets": datasets}
+
+def _filters(dataset):
+    filters = {}
+    if dataset.compression:
+        filters[dataset.compression] = dataset.compression_opts
+    if dataset.shuffle:
+        filters["shuffle"] = None
+    if dataset.fletcher32:
+        filters["fletcher32"] = None
+    return filters
+
+def summarize(scans):
+    """Combine the per-file metadata into per-dataset totals and the list of differences between files."""
+    summary = defaultdict(lambda: {
+        "files": 0, "rows": 0, "logical_bytes": 0, "storage_bytes": 0,
+        "dtypes": defaultdict(list), "chunks": defaultdict(int), "filters": defaultdict(int), "shapes": defaultdict(int),
+    })
+    for scan in scans:
+        for name, info in scan["datasets"].items():
+            entry = summary[name]
+            entry["files"] += 1
+            entry["rows"] += info["rows"]
+            entry["logical_bytes"] += info["logical_bytes"]
+            entry["storage_bytes"] += info["storage_bytes"]
+            entry["dtypes"][info["dtype"]].append(scan["file"])
+            entry["chunks"][str(info["chunks"])] += 1
+            entry["filters"][info["filters"]] += 1
+            entry["shapes"][str(info["shape"])] += 1
+    n_files = sum(1 for scan in scans if scan["error"] is None)
+    for name, entry in summary.items():
+        entry["missing"] = n_files - entry["files"]
+    return {name: {key: dict(value) if isinstance(value, defaultdict) else value for key, value in entry.items()} for name, entry in summary.items()}
+
+def benchmark_file(file_name, datasets, block_rows=None, random_reads=20, seed=0):
+    """Measure the sequential and random read throughput of datasets in one file.
+
+    Random reads are done first, so that the sequential pass does not warm the page cache for them.
+    """
+    rng = np.random.default_rng(seed)
+    results = {}
+    with h5py.File(file_name, "r") as h5f:
+        for name in datasets:
+            if name not in h5f or not isinstance(h5f[name], h5py.Dataset) or not h5f[name].shape:
+                continue
+            dataset = h5f[name]
+            n_rows = dataset.shape[0]
+            block = block_rows or (dataset.chunks[0] if dataset.chunks else 1024)
+            row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+
+            starts = rng.integers(0, max(n_rows - block, 0) + 1, size=random_reads)
+            start_time = time.perf_counter()
+            for start in starts:
+                dataset[start:start + block]
+            random_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            for start in range(0, n_rows, block):
+                dataset[start:start + block]
+            sequential_time = time.perf_counter() - start_time
+
+            results[name] = {
+                "sequential_bytes": n_rows * row_bytes,
+                "sequential_seconds": sequential_time,
+                "random_reads": random_reads,
+                "random_bytes": int(sum(min(block, n_rows - start) for start in starts)) * row_bytes,
+                "random_seconds": random_time,
+            }
+    return results
+
+def _format_bytes(n_bytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n_bytes) < 1024:
+            return f"{n_bytes:.1f} {unit}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f} TB"
+
+def print_summary(summary, scans):
+    n_errors = sum(1 for scan in scans if scan["error"])
+    print(f"Scanned {len(scans)} files, {n_errors} unreadable")
+    for scan in scans:
+        if scan["error"]:
+            print(f"    unreadable: {scan['file']} ({scan['error']})")
+    print(f"{'dataset':<30s} {'files':>6s} {'rows':>12s} {'logical':>11s} {'on disk':>11s} {'ratio':>6s}  chunks / filters")
+    for name, entry in sorted(summary.items()):
+        ratio = entry["logical_bytes"] / entry["storage_bytes"] if entry["storage_bytes"] else float("nan")
+        chunks = " | ".join(f"{chunk} x{n}" for chunk, n in entry["chunks"].items())
+        filters = " | ".join(f"{flt} x{n}" for flt, n in entry["filters"].items())
+        print(
+            f"{name:<30s} {entry['files']:>6d} {entry['rows']:>12d} {_format_bytes(entry['logical_bytes']):>11s} "
+            f"{_format_bytes(entry['storage_bytes']):>11s} {ratio:>6.2f}  {chunks} / {filters}"
+        )
+        if entry["missing"]:
+            print(f"    missing in {entry['missing']} files")
+        if len(entry["dtypes"]) > 1:
+            print(f"    {len(entry['dtypes'])} different dtypes:")
+            for dtype, files in entry["dtypes"].items():
+                print(f"        {dtype} in {len(files)} files, e.g. {files[0]}")
+        if len(entry["shapes"]) > 1:
+            print(f"    different row shapes: {', '.join(entry['shapes'])}")
+
+def print_benchmark(results):
+    totals = defaultdict(lambda: defaultdict(float))
+    for file_results in results.values():
+        for name, result in file_results.items():
+            for key, value in result.items():
+                totals[name][key] += value
+    print(f"{'dataset':<30s} {'sequential':>14s} {'random':>14s} {'random reads':>14s}")
+    for name, total in sorted(totals.items()):
+        sequential = total["sequential_bytes"] / max(total["sequential_seconds"], 1e-9)
+        random = total["random_bytes"] / max(total["random_seconds"], 1e-9)
+        reads = total["random_reads"] / max(total["random_seconds"], 1e-9)
+        print(f"{name:<30s} {_format_bytes(sequential) + '/s':>14s} {_format_bytes(random) + '/s':>14s} {reads:>12.1f}/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Inventory of the H5 files of a production, from metadata only")
+    parser.add_argument("paths", nargs="+", help="H5 files, directories or glob patterns")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="Number of files scanned in parallel")
+    parser.add_argument("--bench", type=int, default=0, metavar="N", help="Measure read throughput on N randomly sampled files")
+    parser.add_argument("--block-rows", type=int, default=None, help="Rows per read in the benchmark, defaults to the chunk size")
+    parser.add_argument("--random-reads", type=int, default=20, help="Number of random reads per dataset in the benchmark")
+    parser.add_argument("--json", type=str, default=None, help="Also write the inventory to a JSON file")
+    args = parser.parse_args()
+
+    files = expand_paths(args.paths)
+    if not files:
+        print("No H5 files found")
+        return
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        scans = list(executor.map(scan_file, files, chunksize=max(1, len(files) // (4 * max(args.jobs, 1)))))
+    summary = summarize(scans)
+    print_summary(summary, scans)
+
+    report = {"files": len(files), "datasets": summary}
+    if args.bench:
+        # Page cache effects are not controlled, files read just before are faster
+        readable = [scan["file"] for scan in scans if scan["error"] is None]
+        sample = sorted(np.random.default_rng(0).choice(readable, size=min(args.bench, len(readable)), replace=False))
+        print(f"\nRead throughput on {len(sample)} files:")
+        results = {file_name: benchmark_file(file_name, summary, args.block_rows, args.random_reads) for file_name in sample}
+        print_benchmark(results)
+        report["benchmark"] = results
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
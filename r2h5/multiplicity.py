@@ -0,0 +1,84 @@
+import logging
+import re
+import numpy as np
+from r2h5 import derived
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+def output_itemsize(column_type):
+    """Bytes per element written to H5 for a ROOT column type, following r2h5.type.get_dtype."""
+    element_type = re.findall(r"<([^<>]+)>", column_type)
+    element_type = (element_type[-1] if element_type else column_type).lower()
+    if "float" in element_type or "double" in element_type:
+        return 8
+    if "char" in element_type:
+        return 1
+    # Python bools are ints, so bool elements are converted to int32 like other integers
+    return 4
+
+def derived_itemsizes(derived_fields, input_itemsizes):
+    """Bytes per element of derived fields, given the bytes per element of the input columns they read.
+
+    The fields are evaluated on one row of inputs of the dtypes these columns are written with.
+    """
+    dtypes = {1: np.int8, 4: np.int32, 8: np.float64}
+    columns = {column: np.ones(1, dtype=dtypes[itemsize]) for column, itemsize in input_itemsizes.items()}
+    return {name: values.itemsize for name, values in derived.evaluate(derived_fields, columns, size=1).items()}
+
+def multiplicity_quantile(counts, quantile):
+    """Smallest multiplicity below or at which a fraction quantile of the rows lie."""
+    cumulative = np.cumsum(counts) / max(counts.sum(), 1)
+    return int(np.searchsorted(cumulative, quantile))
+
+def truncation(counts, max_objects):
+    """Fraction of rows and of objects lost when truncating to max_objects."""
+    multiplicity = np.arange(len(counts))
+    n_rows = max(counts.sum(), 1)
+    n_objects = max((multiplicity * counts).sum(), 1)
+    above = multiplicity > max_objects
+    rows_truncated = counts[above].sum() / n_rows
+    objects_lost = ((multiplicity[above] - max_objects) * counts[above]).sum() / n_objects
+    return rows_truncated, objects_lost
+
+def summarize(counts, row_bytes, configured_max_objects=None, truncation_target=0.01):
+    """Summarize a multiplicity histogram and evaluate candidate max_objects values."""
+    counts = np.asarray(counts, dtype=np.int64)
+    n_rows = int(counts.sum())
+    n_objects = int((np.arange(len(counts)) * counts).sum())
+    quantiles = {q: multiplicity_quantile(counts, q) for q in QUANTILES}
+    recommended = multiplicity_quantile(counts, 1 - truncation_target)
+    candidates = sorted({*quantiles.values(), recommended, len(counts) - 1} | ({configured_max_objects} if configured_max_objects else set()))
+
+    rows = []
+    for max_objects in candidates:
+        rows_truncated, objects_lost = truncation(counts, max_objects)
+        rows.append({
+            "max_objects": max_objects,
+            "rows_truncated": rows_truncated,
+            "objects_lost": objects_lost,
+            # Padded values plus the one byte valid mask per slot
+            "padded_bytes": n_rows * max_objects * (row_bytes + 1),
+        })
+    return {
+        "rows": n_rows,
+        "objects": n_objects,
+        "mean": n_objects / max(n_rows, 1),
+        "max": len(counts) - 1,
+        "quantiles": quantiles,
+        "recommended": recommended,
+        "candidates": rows,
+        "ragged_bytes": n_objects * row_bytes + (n_rows + 1) * 8,
+    }
+
+def log_summary(name, summary, configured_max_objects=None):
+    logging.info(f"Multiplicity of {name}: {summary['rows']} rows, {summary['objects']} objects, mean {summary['mean']:.2f}, max {summary['max']}")
+    logging.info("    " + ", ".join(f"q{100*q:g}={n}" for q, n in summary["quantiles"].items()))
+    logging.info(f"    {'max_objects':>11s} {'rows truncated':>15s} {'objects lost':>13s} {'output size':>12s}")
+    for candidate in summary["candidates"]:
+        tag = " (configured)" if candidate["max_objects"] == configured_max_objects else ""
+        tag += " (recommended)" if candidate["max_objects"] == summary["recommended"] else ""
+        logging.info(
+            f"    {candidate['max_objects']:>11d} {100*candidate['rows_truncated']:>14.3f}% "
+            f"{100*candidate['objects_lost']:>12.3f}% {candidate['padded_bytes']/1024**2:>9.1f} MB{tag}"
+        )
+    logging.info(f"    ragged layout: {summary['ragged_bytes']/1024**2:.1f} MB")
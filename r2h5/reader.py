@@ -0,0 +1,87 @@
+import h5py
+import numpy as np
+from .type import pad_jagged
+
+def read_fields(h5f, name, fields=None, start=0, stop=None):
+    """Read rows start:stop of some or all fields of an Object or ObjectCollection as a structured array.
+
+    Works for compound datasets and for the columnar layout, where only the requested fields are read.
+    """
+    node = h5f[name]
+    if not isinstance(node, h5py.Group):
+        return node[start:stop] if fields is None else node.fields(list(fields))[start:stop]
+    fields = list(node.keys()) if fields is None else list(fields)
+    columns = {field: node[field][start:stop] for field in fields}
+    # Padded fields share the (rows, max_objects) shape, like the compound dataset of the padded layout
+    data = np.empty(columns[fields[0]].shape if fields else 0, dtype=[(k, v.dtype) for k, v in columns.items()])
+    for field, values in columns.items():
+        data[field] = values
+    return data
+
+def count_rows(h5f, name):
+    """Return the number of rows of an Object or ObjectCollection in either layout."""
+    node = h5f[name]
+    if isinstance(node, h5py.Group):
+        return len(node[next(iter(node.keys()))]) if len(node) else 0
+    return len(node)
+
+def get_event_slice(h5f, name, i_event):
+    """Return the rows of a dataset with per-event offsets that belong to the i-th event of the file."""
+    offsets = h5f[h5f[name].attrs["offsets"]]
+    start, stop = offsets[i_event:i_event + 2]
+    return read_fields(h5f, name, start=start, stop=stop)
+
+def get_event_rows(h5f, name, event_number):
+    """Return the (start, stop) row range of an event in a dataset with an eventNumber index, or None."""
+    index = h5f[h5f[name].attrs["event_index"]]
+    event_numbers = index["eventNumber"]
+    position = np.searchsorted(event_numbers, event_number)
+    if position == len(event_numbers) or event_numbers[position] != event_number:
+        return None
+    entry = index[position]
+    return int(entry["start"]), int(entry["stop"])
+
+def gather_linked(h5f, name, fields=None, start=0, stop=None):
+    """Gather the values of a linked layout ObjectCollection for rows start:stop of the Object it is linked to.
+
+    Returns the flat values of these objects, read from the values stored once per event, and the
+    number of values of each object.
+    """
+    node = h5f[name]
+    link = h5f[node.attrs["link_indices"]]
+    link_offsets = h5f[link.attrs["offsets"]][start:None if stop is None else stop + 1]
+    indices = link[link_offsets[0]:link_offsets[-1]]
+    lengths = np.diff(link_offsets)
+    if len(indices) == 0:
+        return read_fields(h5f, name, fields, 0, 0), lengths
+    # Event of each object, from the rows of each event of the linked Object
+    object_offsets = h5f[h5f[link.attrs["object_link"]].attrs["offsets"]][:]
+    events = np.searchsorted(object_offsets, np.arange(start, start + len(lengths)), side="right") - 1
+    event_offsets = h5f[node.attrs["offsets"]][events[0]:events[-1] + 1]
+    rows = np.repeat(event_offsets[events - events[0]], lengths) + indices
+    first, last = rows.min(), rows.max() + 1
+    return read_fields(h5f, name, fields, first, last)[rows - first], lengths
+
+def load_padded(h5f, name, max_objects, start=0, stop=None, fields=None):
+    """Load rows start:stop of an ObjectCollection padded to max_objects, with a valid mask.
+
+    Ragged datasets are padded on the fly, so any max_objects can be chosen at load time. Linked
+    datasets are gathered per object of the linked Object first.
+    """
+    if fields is not None:
+        fields = [field for field in fields if field != "valid"]
+    layout = h5f[name].attrs.get("layout")
+    if layout == "linked":
+        flat, lengths = gather_linked(h5f, name, fields, start, stop)
+    elif layout == "ragged":
+        offsets = h5f[h5f[name].attrs["offsets"]][start:None if stop is None else stop + 1]
+        flat = read_fields(h5f, name, fields, offsets[0], offsets[-1])
+        lengths = np.diff(offsets)
+    else:
+        return read_fields(h5f, name, None if fields is None else [*fields, "valid"], start, stop)
+    fields = {field: pad_jagged(flat[field], lengths, max_objects)[0] for field in flat.dtype.names}
+    fields["valid"] = pad_jagged(np.ones(len(flat), dtype=bool), lengths, max_objects)[1]
+    padded = np.empty((len(lengths), max_objects), dtype=[(k, v.dtype) for k, v in fields.items()])
+    for field, values in fields.items():
+        padded[field] = values
+    return padded
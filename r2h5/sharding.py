@@ -0,0 +1,362 @@
+import json
+import logging
+import math
+import os
+import re
+import h5py
+import numpy as np
+from r2h5.reader import count_rows, read_fields
+from r2h5.type import build_event_index, build_offsets
+
+SIZE_UNITS = {"": 1, "B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3}
+
+def parse_size(size):
+    """Convert a size like 512MB or 2GB into bytes."""
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMG]?B?)\s*", str(size).upper())
+    if not match:
+        logging.error(f"Could not parse size {size}, use e.g. 512MB")
+        exit(1)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+def dataset_event_offsets(h5f, config):
+    """Map each dataset of an output file to the row offsets of its events.
+
+    Returns the number of events and, per dataset, a pair of arrays of n_events+1 offsets: the
+    rows of event i are offsets[i]:offsets[i+1], and for datasets with a <name>_offsets dataset
+    the second array holds the same for the rows indexed by those offsets (None otherwise).
+    """
+    n_events = None
+    for name, object_config in config.get("Objects", {}).items():
+        if object_config["source_format"] == "scalar":
+            n_events = count_rows(h5f, name)
+        else:
+            n_events = len(h5f[h5f[name].attrs["offsets"]]) - 1
+        break
+    else:
+        for name, objcol_config in config.get("ObjectCollections", {}).items():
+            if not objcol_config.get("object_link"):
+                dataset = h5f[name]
+                n_events = len(h5f[dataset.attrs["offsets"]]) - 1 if "offsets" in dataset.attrs else count_rows(h5f, name)
+                break
+    if n_events is None:
+        return 0, {}
+
+    events = np.arange(n_events + 1, dtype=np.int64)
+    offsets = {}
+    for name, object_config in config.get("Objects", {}).items():
+        if object_config["source_format"] == "scalar":
+            offsets[name] = (events, None)
+        else:
+            offsets[name] = (h5f[h5f[name].attrs["offsets"]][:], events)
+    for name, objcol_config in config.get("ObjectCollections", {}).items():
+        # Rows of a linked collection follow the rows of the Object it is linked to
+        parent = offsets[objcol_config["object_link"]["object"]][0] if objcol_config.get("object_link") else events
+        if "link_indices" in h5f[name].attrs:
+            # Linked layout: the values are stored per event, the indices into them follow the linked Object
+            link_name = h5f[name].attrs["link_indices"]
+            offsets[link_name] = (h5f[h5f[link_name].attrs["offsets"]][:][parent], parent)
+            parent = events
+        if "offsets" in h5f[name].attrs:
+            offsets[name] = (h5f[h5f[name].attrs["offsets"]][:][parent], parent)
+        else:
+            offsets[name] = (parent, None)
+    for name, (event_offsets, _) in offsets.items():
+        if len(event_offsets) != n_events + 1:
+            logging.error(f"Dataset {name} in {h5f.file.filename} does not have {n_events} events")
+            exit(1)
+    return n_events, offsets
+
+def events_per_shard(n_events, bytes_per_event, sharding):
+    """Number of events per shard, a multiple of chunk_events, giving a multiple of n_workers shards when possible."""
+    chunk_events = sharding.get("chunk_events", 1)
+    if "events_per_shard" in sharding:
+        n_per_shard = sharding["events_per_shard"]
+    elif "bytes_per_shard" in sharding:
+        n_per_shard = max(1, int(parse_size(sharding["bytes_per_shard"]) / max(bytes_per_event, 1)))
+    else:
+        logging.error("output.sharding needs events_per_shard or bytes_per_shard")
+        exit(1)
+    aligned = max(chunk_events, math.ceil(n_per_shard / chunk_events) * chunk_events)
+    n_workers = sharding.get("n_workers")
+    if not n_workers or n_events == 0:
+        return aligned
+    # Spread the events over a number of shards divisible by the number of readers, taking the
+    # number of shards closest to the requested one that chunk-aligned shards can give
+    wanted = max(n_workers, math.ceil(math.ceil(n_events / n_per_shard) / n_workers) * n_workers)
+    max_shards = math.ceil(n_events / chunk_events)
+    for step in range(0, max(wanted, max_shards) + n_workers, n_workers):
+        for n_shards in (wanted + step, wanted - step):
+            if not n_workers <= n_shards <= max_shards:
+                continue
+            size = math.ceil(n_events / n_shards / chunk_events) * chunk_events
+            if math.ceil(n_events / size) == n_shards:
+                return size
+    logging.warning(f"{n_events} events in shards of multiples of {chunk_events} events cannot make a multiple of {n_workers} shards")
+    return aligned
+
+def plan_shards(file_events, n_per_shard):
+    """Split consecutive files into shards of n_per_shard events.
+
+    Returns for each shard a list of (file index, first event, last event + 1) pieces.
+    """
+    shards, pieces, n_in_shard = [], [], 0
+    for i_file, n_events in enumerate(file_events):
+        start = 0
+        while start < n_events:
+            stop = min(n_events, start + n_per_shard - n_in_shard)
+            pieces.append((i_file, start, stop))
+            n_in_shard += stop - start
+            start = stop
+            if n_in_shard == n_per_shard:
+                shards.append(pieces)
+                pieces, n_in_shard = [], 0
+    if pieces:
+        shards.append(pieces)
+    return shards
+
+def reshard(output_files, config, sharding):
+    """Rewrite the per-input output files of one output into shards of a fixed number of events."""
+    shard_path = sharding.get("path", os.path.join(config["output"]["h5_path"], "shards"))
+    os.makedirs(shard_path, exist_ok=True)
+
+    file_events, file_sources, n_bytes = [], [], 0
+    for output_file in output_files:
+        with h5py.File(output_file, "r") as h5f:
+            n_events, _ = dataset_event_offsets(h5f, config)
+            file_events.append(n_events)
+            file_sources.append(h5f.attrs.get("source_file", output_file))
+            n_bytes += _logical_bytes(h5f)
+    n_total = sum(file_events)
+    n_per_shard = events_per_shard(n_total, n_bytes / max(n_total, 1), sharding)
+    shards = plan_shards(file_events, n_per_shard)
+    logging.info(f"Resharding {n_total} events of {len(output_files)} files into {len(shards)} shards of {n_per_shard} events in {shard_path}")
+
+    width = max(5, len(str(len(shards) - 1)))
+    manifest = {"events_per_shard": n_per_shard, "chunk_events": sharding.get("chunk_events", 1), "shards": []}
+    for i_shard, pieces in enumerate(shards):
+        shard_file = os.path.join(shard_path, f"shard_{i_shard:0{width}}.h5")
+        sources = [
+            {
+                "input_file": file_sources[i_file],
+                "output_file": output_files[i_file],
+                "entry_start": start,
+                "entry_stop": stop,
+            }
+            for i_file, start, stop in pieces
+        ]
+        logging.info(f"Writing shard {i_shard+1} of {len(shards)} to {shard_file}")
+        blocks = []
+        for i_file, start, stop in pieces:
+            with h5py.File(output_files[i_file], "r") as h5f:
+                blocks.append(read_events(h5f, config, start, stop))
+        write_block(shard_file, concatenate_blocks(blocks), sharding.get("chunk_events"), {"sources": json.dumps(sources)})
+        manifest["shards"].append({
+            "file": os.path.basename(shard_file),
+            "events": sum(stop - start for _, start, stop in pieces),
+            "sources": sources,
+        })
+    with open(os.path.join(shard_path, "shards.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def _logical_bytes(h5f):
+    """Uncompressed size of all datasets in a file, including the fields of columnar groups."""
+    n_bytes = []
+    h5f.visititems(lambda name, node: n_bytes.append(node.size * node.dtype.itemsize) if isinstance(node, h5py.Dataset) else None)
+    return sum(n_bytes)
+
+def read_events(h5f, config, start, stop, offsets=None):
+    """Read the events start:stop of an output file into an event block.
+
+    An event block holds, per dataset, its rows and the offsets of the rows of each event, from which
+    the <name>_offsets and <name>_event_index datasets are rebuilt when the block is written.
+    """
+    if offsets is None:
+        _, offsets = dataset_event_offsets(h5f, config)
+    n_events = None
+    datasets = {}
+    for name, (event_offsets, parent_offsets) in offsets.items():
+        node = h5f[name]
+        n_events = len(event_offsets) - 1
+        entry = {
+            "values": read_fields(h5f, name, start=event_offsets[start], stop=event_offsets[stop]),
+            "event_offsets": event_offsets[start:stop + 1] - event_offsets[start],
+            "parent_offsets": None,
+            "row_lengths": None,
+            "event_number": None,
+            "attrs": dict(node.attrs),
+            **storage_layout(node),
+        }
+        if parent_offsets is not None:
+            entry["parent_offsets"] = parent_offsets[start:stop + 1] - parent_offsets[start]
+            entry["row_lengths"] = np.diff(h5f[node.attrs["offsets"]][parent_offsets[start]:parent_offsets[stop] + 1])
+        if "event_index" in node.attrs:
+            index = h5f[node.attrs["event_index"]][:]
+            if "event" in index.dtype.names:
+                event_number = np.empty(n_events, dtype=index["eventNumber"].dtype)
+                event_number[index["event"]] = index["eventNumber"]
+                entry["event_number"] = event_number[start:stop]
+            else:
+                logging.warning(f"{node.attrs['event_index']} has no event positions, it is not copied")
+                del entry["attrs"]["event_index"]
+        datasets[name] = entry
+    return {"n_events": stop - start, "datasets": datasets}
+
+def take_events(block, events):
+    """Return a new event block with the given events of a block, in the given order."""
+    events = np.asarray(events, dtype=np.int64)
+    datasets = {}
+    for name, entry in block["datasets"].items():
+        rows, lengths = _event_rows(entry["event_offsets"], events)
+        taken = dict(entry, values=entry["values"][rows], event_offsets=build_offsets(lengths))
+        if entry["parent_offsets"] is not None:
+            parent_rows, parent_lengths = _event_rows(entry["parent_offsets"], events)
+            taken["row_lengths"] = entry["row_lengths"][parent_rows]
+            taken["parent_offsets"] = build_offsets(parent_lengths)
+        if entry["event_number"] is not None:
+            taken["event_number"] = entry["event_number"][events]
+        datasets[name] = taken
+    return {"n_events": len(events), "datasets": datasets}
+
+def concatenate_blocks(blocks):
+    """Concatenate event blocks read from files written with the same config."""
+    blocks = [block for block in blocks if block["datasets"]]
+    if not blocks:
+        return {"n_events": 0, "datasets": {}}
+    datasets = {}
+    for name, first in blocks[0]["datasets"].items():
+        entries = [block["datasets"][name] for block in blocks]
+        merged = dict(first)
+        merged["values"] = np.concatenate([entry["values"] for entry in entries])
+        if first["columnar"]:
+            # Blocks with fewer rows than chunk_rows were written with smaller chunks
+            merged["chunk_rows"] = max((entry["chunk_rows"] for entry in entries if entry["chunk_rows"]), default=None)
+        merged["event_offsets"] = build_offsets(np.concatenate([np.diff(entry["event_offsets"]) for entry in entries]))
+        if first["parent_offsets"] is not None:
+            merged["parent_offsets"] = build_offsets(np.concatenate([np.diff(entry["parent_offsets"]) for entry in entries]))
+            merged["row_lengths"] = np.concatenate([entry["row_lengths"] for entry in entries])
+        if all(entry["event_number"] is not None for entry in entries):
+            merged["event_number"] = np.concatenate([entry["event_number"] for entry in entries])
+        datasets[name] = merged
+    return {"n_events": sum(block["n_events"] for block in blocks), "datasets": datasets}
+
+def write_block(file_name, block, chunk_events=None, attrs=None):
+    """Write an event block to a new H5 file in the layout of the files it was read from."""
+    with h5py.File(file_name, "w") as h5f:
+        for key, value in (attrs or {}).items():
+            h5f.attrs[key] = value
+        write_datasets(h5f, block, chunk_events)
+
+def write_datasets(h5f, block, chunk_events=None):
+    """Write the datasets of an event block into an open H5 file or group."""
+    n_events = block["n_events"]
+    for name, entry in block["datasets"].items():
+        values = entry["values"]
+        chunks = None
+        if chunk_events and entry["parent_offsets"] is None and len(values) == n_events and n_events > 0:
+            # Event-level datasets are chunked along the events, the shards are a multiple of the chunk size
+            chunks = (min(chunk_events, n_events),) + values.shape[1:]
+        if entry["columnar"]:
+            group = h5f.create_group(name, track_order=True)
+            for field in values.dtype.names:
+                column = np.ascontiguousarray(values[field])
+                field_chunks = chunks
+                if field_chunks is None and entry["chunk_rows"] and len(column):
+                    # The chunking along the rows of the columnar layout is kept
+                    field_chunks = (min(entry["chunk_rows"], len(column)),) + column.shape[1:]
+                group.create_dataset(field, data=column, chunks=field_chunks, compression=entry["compression"], compression_opts=entry["compression_opts"])
+        else:
+            h5f.create_dataset(name, data=values, chunks=chunks, compression=entry["compression"], compression_opts=entry["compression_opts"])
+        for key, value in entry["attrs"].items():
+            h5f[name].attrs[key] = value
+        if entry["row_lengths"] is not None:
+            h5f.create_dataset(entry["attrs"]["offsets"], data=build_offsets(entry["row_lengths"]))
+        if entry["event_number"] is not None:
+            h5f.create_dataset(entry["attrs"]["event_index"], data=build_event_index(entry["event_number"], entry["event_offsets"]))
+
+def dataset_sizes(h5f, config, sizes=None):
+    """Add the rows of each dataset of an output file, and the rows its offsets index, to sizes.
+
+    Summed over event blocks, sizes gives the shapes of the datasets of the file they are
+    appended to with append_block.
+    """
+    sizes = {} if sizes is None else sizes
+    _, offsets = dataset_event_offsets(h5f, config)
+    for name in offsets:
+        node = h5f[name]
+        rows, indexed_rows = sizes.get(name, (0, 0))
+        if "offsets" in node.attrs:
+            indexed_rows += len(h5f[node.attrs["offsets"]]) - 1
+        sizes[name] = (rows + count_rows(h5f, name), indexed_rows)
+    return sizes
+
+def append_block(h5f, block, state, sizes, chunk_rows=None):
+    """Write an event block after the rows already written to an open H5 file, creating the datasets for the first block.
+
+    The datasets are created with their final sizes from dataset_sizes, in the layout write_datasets
+    gives them, so the file is the same as when the blocks are concatenated first. state carries the
+    rows written and the per-event lengths and event numbers of each dataset between calls, the event
+    indices are written from it by finish_appended. chunk_rows gives the chunking along the rows of
+    columnar datasets.
+    """
+    for name, entry in block["datasets"].items():
+        values = entry["values"]
+        if name not in state:
+            state[name] = {"rows": 0, "indexed_rows": 0, "event_lengths": [], "event_number": [], "attrs": entry["attrs"]}
+            rows, indexed_rows = sizes[name]
+            if entry["columnar"]:
+                rows_per_chunk = (chunk_rows or {}).get(name) or entry["chunk_rows"]
+                group = h5f.create_group(name, track_order=True)
+                for field in values.dtype.names:
+                    chunks = (min(rows_per_chunk, rows),) + values[field].shape[1:] if rows_per_chunk and rows else None
+                    group.create_dataset(field, shape=(rows,) + values[field].shape[1:], dtype=values[field].dtype, chunks=chunks,
+                                         compression=entry["compression"], compression_opts=entry["compression_opts"])
+            else:
+                h5f.create_dataset(name, shape=(rows,) + values.shape[1:], dtype=values.dtype,
+                                   compression=entry["compression"], compression_opts=entry["compression_opts"])
+            for key, value in entry["attrs"].items():
+                h5f[name].attrs[key] = value
+            if entry["row_lengths"] is not None:
+                h5f.create_dataset(entry["attrs"]["offsets"], data=np.zeros(indexed_rows + 1, dtype=np.int64))
+        written = state[name]
+        start, stop = written["rows"], written["rows"] + len(values)
+        if entry["columnar"]:
+            for field in values.dtype.names:
+                h5f[name][field][start:stop] = values[field]
+        else:
+            h5f[name][start:stop] = values
+        if entry["row_lengths"] is not None:
+            # The row offsets of this block continue after the rows already written
+            first = written["indexed_rows"] + 1
+            h5f[entry["attrs"]["offsets"]][first:first + len(entry["row_lengths"])] = start + np.cumsum(entry["row_lengths"], dtype=np.int64)
+            written["indexed_rows"] += len(entry["row_lengths"])
+        written["rows"] = stop
+        written["event_lengths"].append(np.diff(entry["event_offsets"]))
+        if entry["event_number"] is None:
+            written["event_number"] = None
+        elif written["event_number"] is not None:
+            written["event_number"].append(entry["event_number"])
+
+def finish_appended(h5f, state):
+    """Write the event indices of the datasets appended with append_block."""
+    for name, written in state.items():
+        if written["event_number"] is None:
+            continue
+        event_offsets = build_offsets(np.concatenate(written["event_lengths"]))
+        h5f.create_dataset(written["attrs"]["event_index"], data=build_event_index(np.concatenate(written["event_number"]), event_offsets))
+
+def _event_rows(offsets, events):
+    """Return the row indices of the given events and the number of rows of each of them."""
+    starts = offsets[events]
+    lengths = offsets[events + 1] - starts
+    return np.repeat(starts - build_offsets(lengths)[:-1], lengths) + np.arange(lengths.sum()), lengths
+
+def storage_layout(node):
+    """Layout and filters of a dataset, or of the fields of a columnar group."""
+    if isinstance(node, h5py.Group):
+        field = node[next(iter(node.keys()))]
+        return {"columnar": True, "compression": field.compression, "compression_opts": field.compression_opts,
+                "chunk_rows": field.chunks[0] if field.chunks else None}
+    return {"columnar": False, "compression": node.compression, "compression_opts": node.compression_opts, "chunk_rows": None}
@@ -0,0 +1,157 @@
+import json
+import logging
+import math
+import os
+import shutil
+import h5py
+import numpy as np
+from r2h5.sharding import concatenate_blocks, dataset_event_offsets, read_events, take_events, write_block, write_datasets
+
+DEFAULT_FRACTIONS = {"train": 0.8, "val": 0.1, "test": 0.1}
+
+def hash_event_numbers(event_number, seed=0, stream=0):
+    """Deterministic 64 bit hash of event numbers (splitmix64), independent of the file an event is in.
+
+    Different streams give independent hashes for the same seed.
+    """
+    x = np.asarray(event_number).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        x = x + np.uint64(((2 * seed + stream + 1) * 0x9E3779B97F4A7C15) % 2**64)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    return x
+
+def unit_interval(hashes):
+    """Map 64 bit hashes uniformly to [0, 1)."""
+    return (hashes >> np.uint64(11)).astype(np.float64) / 2**53
+
+def assign_splits(event_number, fractions, seed=0):
+    """Index of the split of each event in fractions, from a hash of its eventNumber."""
+    bounds = np.cumsum(list(fractions.values()), dtype=np.float64)
+    bounds /= bounds[-1]
+    splits = np.searchsorted(bounds, unit_interval(hash_event_numbers(event_number, seed, stream=0)), side="right")
+    return np.minimum(splits, len(bounds) - 1)
+
+def block_event_numbers(block, config, event_number_field=None):
+    """Return the eventNumber of each event of an event block.
+
+    Taken from event_number_field ("Object.field"), a scalar Object with an eventNumber branch,
+    or the event index of a vector Object.
+    """
+    if event_number_field:
+        name, field = event_number_field.split(".")
+        return block["datasets"][name]["values"][field]
+    for name, object_config in config.get("Objects", {}).items():
+        if object_config["source_format"] == "scalar" and "eventNumber" in object_config["branches"]:
+            return block["datasets"][name]["values"]["eventNumber"]
+    for name, entry in block["datasets"].items():
+        if entry["event_number"] is not None:
+            return entry["event_number"]
+    logging.error("Splitting needs the eventNumber of each event: add eventNumber to a scalar Object or set event_index on a vector Object")
+    exit(1)
+
+def split_outputs(output_files, config, split_config):
+    """Write shuffled train/val/test shards of the output files with an external bucket shuffle.
+
+    Events are assigned to a split and given a shuffle key by hashing their eventNumber. A first pass
+    distributes the events into buckets of the shuffle key on disk, a second pass sorts one bucket at
+    a time by the key and writes the shards, so at most max_events_in_memory events are held in memory.
+    """
+    split_path = split_config.get("path", os.path.join(config["output"]["h5_path"], "split"))
+    fractions = split_config.get("fractions", DEFAULT_FRACTIONS)
+    seed = split_config.get("seed", 0)
+    max_events = split_config.get("max_events_in_memory", 1000000)
+    n_per_shard = split_config.get("events_per_shard", 100000)
+    event_number_field = split_config.get("event_number")
+    split_names = list(fractions)
+
+    file_events = []
+    for output_file in output_files:
+        with h5py.File(output_file, "r") as h5f:
+            file_events.append(dataset_event_offsets(h5f, config)[0])
+    n_total = sum(file_events)
+    # Buckets hold about half of the events allowed in memory, summed over the splits
+    n_buckets = max(1, math.ceil(2 * n_total / max_events))
+    block_events = max(1, max_events // 2)
+    logging.info(f"Splitting {n_total} events into {', '.join(split_names)} with {n_buckets} shuffle buckets in {split_path}")
+
+    tmp_path = os.path.join(split_path, "tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    # First pass: distribute the events of each block into (split, bucket) groups of temporary files
+    buffers, n_buffered, flush_files = {}, 0, []
+    for output_file, n_events in zip(output_files, file_events):
+        logging.info(f"Distributing events of {output_file}")
+        with h5py.File(output_file, "r") as h5f:
+            _, offsets = dataset_event_offsets(h5f, config)
+            for start in range(0, n_events, block_events):
+                block = read_events(h5f, config, start, min(n_events, start + block_events), offsets)
+                event_number = block_event_numbers(block, config, event_number_field)
+                group = assign_splits(event_number, fractions, seed) * n_buckets + _bucket(event_number, seed, n_buckets)
+                order = np.argsort(group, kind="stable")
+                groups, starts = np.unique(group[order], return_index=True)
+                for group_id, events in zip(groups, np.split(order, starts[1:])):
+                    buffers.setdefault(int(group_id), []).append(take_events(block, events))
+                n_buffered += block["n_events"]
+                if n_buffered >= block_events:
+                    flush_files.append(_flush(buffers, tmp_path, len(flush_files), split_names, n_buckets))
+                    buffers, n_buffered = {}, 0
+    if buffers:
+        flush_files.append(_flush(buffers, tmp_path, len(flush_files), split_names, n_buckets))
+
+    # Second pass: sort each bucket by the shuffle key and cut the sorted stream into shards
+    manifest = {"seed": seed, "fractions": fractions, "events_per_shard": n_per_shard, "splits": {}}
+    for split_name in split_names:
+        os.makedirs(os.path.join(split_path, split_name), exist_ok=True)
+        shard_files, pending = [], None
+        for bucket in range(n_buckets):
+            group_name = f"{split_name}/{bucket:05}"
+            blocks = []
+            for flush_file in flush_files:
+                with h5py.File(flush_file, "r") as h5f:
+                    if group_name in h5f:
+                        n_events = h5f[group_name].attrs["n_events"]
+                        blocks.append(read_events(h5f[group_name], config, 0, n_events))
+            if not blocks:
+                continue
+            block = concatenate_blocks(blocks)
+            key = hash_event_numbers(block_event_numbers(block, config, event_number_field), seed, stream=1)
+            block = take_events(block, np.argsort(key, kind="stable"))
+            pending = block if pending is None else concatenate_blocks([pending, block])
+            while pending["n_events"] >= n_per_shard:
+                shard_files.append(_write_split_shard(split_path, split_name, len(shard_files), take_events(pending, np.arange(n_per_shard)), split_config, seed))
+                pending = take_events(pending, np.arange(n_per_shard, pending["n_events"]))
+        if pending is not None and pending["n_events"] > 0:
+            shard_files.append(_write_split_shard(split_path, split_name, len(shard_files), pending, split_config, seed))
+        manifest["splits"][split_name] = shard_files
+        logging.info(f"Wrote {sum(shard['events'] for shard in shard_files)} {split_name} events to {len(shard_files)} shards")
+
+    shutil.rmtree(tmp_path)
+    with open(os.path.join(split_path, "split.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def _bucket(event_number, seed, n_buckets):
+    """Bucket of the shuffle key, buckets are ordered like the keys they contain."""
+    return (unit_interval(hash_event_numbers(event_number, seed, stream=1)) * n_buckets).astype(np.int64)
+
+def _flush(buffers, tmp_path, i_flush, split_names, n_buckets):
+    """Write the buffered events of each (split, bucket) group into one temporary file."""
+    flush_file = os.path.join(tmp_path, f"flush_{i_flush:05}.h5")
+    logging.debug(f"Writing {len(buffers)} shuffle buckets to {flush_file}")
+    with h5py.File(flush_file, "w") as h5f:
+        for group_id, blocks in buffers.items():
+            split_name, bucket = split_names[group_id // n_buckets], group_id % n_buckets
+            block = concatenate_blocks(blocks)
+            group = h5f.create_group(f"{split_name}/{bucket:05}")
+            group.attrs["n_events"] = block["n_events"]
+            write_datasets(group, block)
+    return flush_file
+
+def _write_split_shard(split_path, split_name, i_shard, block, split_config, seed):
+    shard_file = os.path.join(split_path, split_name, f"shard_{i_shard:05}.h5")
+    logging.debug(f"Writing {block['n_events']} events to {shard_file}")
+    write_block(shard_file, block, split_config.get("chunk_events"), {"split": split_name, "seed": seed})
+    return {"file": os.path.relpath(shard_file, split_path), "events": block["n_events"]}
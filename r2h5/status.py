@@ -0,0 +1,183 @@
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from r2h5.cost_model import peak_rss
+
+# Jobs whose status file was not updated for this long are reported as stale
+STALE_SECONDS = 600
+# Shortest period of the background threads that refresh the status
+MIN_POLL_SECONDS = 1
+
+def current_rss():
+    """Resident memory of this process in bytes, the peak when /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return peak_rss()
+
+def _format_duration(seconds):
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+class StatusReporter:
+    """Track the progress of a conversion, log it and write it to a JSON status file.
+
+    Updates are cheap, the log line and the file are written at most every interval seconds
+    unless forced. The file is replaced atomically, so readers never see a partial status.
+    """
+    def __init__(self, path=None, job=None, interval=30):
+        self.path = path
+        self.interval = interval
+        self.status = {
+            "job": job, "host": socket.gethostname(), "pid": os.getpid(), "state": "starting",
+            "stage": None, "step": None, "input_file": None, "files_done": 0, "files_total": 0,
+            "events_done": 0, "events_total": 0, "events_per_second": 0.0, "eta_seconds": None,
+            "rss": 0, "peak_rss": 0, "started": time.time(), "updated": None,
+        }
+        self._rate_start = None
+        self._last_write = 0
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def start(self, files_total, events_total):
+        """Start measuring the throughput, after the setup that does not scale with the events."""
+        self._rate_start = (time.time(), self.status["events_done"])
+        self.update(force=True, state="running", files_total=files_total, events_total=events_total)
+
+    def finish(self, state="done"):
+        self.update(force=True, state=state, stage=None, step=None)
+
+    def update(self, force=False, **fields):
+        with self._lock:
+            self.status.update(fields)
+            now = time.time()
+            if not force and now - self._last_write < self.interval:
+                return
+            self._last_write = now
+            self._refresh(now)
+            status = dict(self.status)
+            # Written under the lock, so that the status of a background thread cannot replace a newer one
+            if self.path:
+                with open(f"{self.path}.tmp", "w") as f:
+                    json.dump(status, f, indent=2)
+                os.replace(f"{self.path}.tmp", self.path)
+        if status["state"] == "running" and status["events_total"]:
+            logging.info(
+                f"Progress: {status['events_done']}/{status['events_total']} events "
+                f"({100 * status['events_done'] / status['events_total']:.1f}%), {status['events_per_second']:.0f} events/s, "
+                f"ETA {_format_duration(status['eta_seconds'])}, RSS {status['rss']/1024**3:.2f} GB, stage {status['stage']}"
+            )
+
+    @contextmanager
+    def heartbeat(self):
+        """Refresh the update time and the memory use from a background thread while the block runs.
+
+        Keeps the status of a job that is busy in a step without progress reports from turning stale.
+        """
+        with self._poll(self.update):
+            yield
+
+    @contextmanager
+    def watch(self, processed, base=None):
+        """Poll processed(), the events done in the running event loop, from a background thread.
+
+        The events done are counted from base, by default the events done when the loop starts,
+        and never go back, so event loops that read the same events again do not count them twice.
+        The event loop must run with the GIL released for the thread to get to run.
+        """
+        base = self.status["events_done"] if base is None else base
+        def poll():
+            self.update(events_done=max(self.status["events_done"], base + processed()))
+        with self._poll(poll):
+            yield
+
+    @contextmanager
+    def _poll(self, function):
+        stop = threading.Event()
+        def poll():
+            while not stop.wait(max(self.interval, MIN_POLL_SECONDS)):
+                function()
+        thread = threading.Thread(target=poll, name="r2h5-status", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def _refresh(self, now):
+        self.status["updated"] = now
+        self.status["rss"] = current_rss()
+        # getrusage and /proc count pages differently, the peak is at least the current value
+        self.status["peak_rss"] = max(peak_rss(), self.status["rss"])
+        if self._rate_start is None or now <= self._rate_start[0]:
+            return
+        rate = (self.status["events_done"] - self._rate_start[1]) / (now - self._rate_start[0])
+        self.status["events_per_second"] = rate
+        remaining = self.status["events_total"] - self.status["events_done"]
+        # A total of 0 is unknown
+        self.status["eta_seconds"] = remaining / rate if rate > 0 and self.status["events_total"] else None
+
+def aggregate(status_files, n_jobs=None, stale_after=STALE_SECONDS):
+    """Combine the status files of the jobs of a production into one summary.
+
+    Jobs without a status file count as pending when the number of jobs n_jobs is given.
+    """
+    now = time.time()
+    jobs = []
+    for status_file in status_files:
+        try:
+            with open(status_file) as f:
+                jobs.append(json.load(f))
+        except (OSError, ValueError):
+            logging.debug(f"Could not read status file {status_file}")
+    states = {"pending": 0, "starting": 0, "running": 0, "stale": 0, "done": 0, "failed": 0}
+    for job in jobs:
+        if job["state"] in ("starting", "running") and now - (job["updated"] or job["started"]) > stale_after:
+            job["state"] = "stale"
+        states[job["state"]] += 1
+    if n_jobs is not None:
+        states["pending"] = max(n_jobs - len(jobs), 0)
+    running = [job for job in jobs if job["state"] == "running"]
+    events_per_second = sum(job["events_per_second"] for job in running)
+    events_done = sum(job["events_done"] for job in jobs)
+    events_total = sum(job["events_total"] for job in jobs)
+    return {
+        "states": states,
+        "events_done": events_done,
+        "events_total": events_total,
+        "events_per_second": events_per_second,
+        "eta_seconds": max((job["eta_seconds"] for job in running if job["eta_seconds"] is not None), default=None),
+        "max_rss": max((job["peak_rss"] for job in jobs), default=0),
+        "slowest": sorted(running, key=lambda job: job["events_per_second"])[:5],
+        "problems": [job for job in jobs if job["state"] in ("stale", "failed")],
+    }
+
+def print_status(summary):
+    states = summary["states"]
+    print(", ".join(f"{n} {state}" for state, n in states.items()))
+    if summary["events_total"]:
+        print(f"Events: {summary['events_done']}/{summary['events_total']} of the started jobs ({100 * summary['events_done'] / summary['events_total']:.1f}%)")
+    print(f"Throughput: {summary['events_per_second']:.0f} events/s over {states['running']} running jobs, "
+          f"longest remaining job {_format_duration(summary['eta_seconds'])}")
+    print(f"Largest peak RSS: {summary['max_rss']/1024**3:.2f} GB")
+    for job in summary["slowest"]:
+        print(f"    slow : {job['job']} on {job['host']}: {job['events_per_second']:.0f} events/s in {job['stage']}, ETA {_format_duration(job['eta_seconds'])}")
+    for job in summary["problems"]:
+        print(f"    {job['state']:<5s}: {job['job']} on {job['host']}, last stage {job['stage']} {job['step'] or ''}, "
+              f"{job['events_done']}/{job['events_total']} events, updated {_format_duration(time.time() - (job['updated'] or job['started']))} ago")
+
+def production_status(status_path, n_jobs=None):
+    """Print the summary of the status files in a folder."""
+    summary = aggregate(sorted(glob.glob(os.path.join(status_path, "*.json"))), n_jobs)
+    print_status(summary)
+    return summary
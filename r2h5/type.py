@@ -21,6 +21,17 @@ def get_dtype(rvec):
         logging.error(f"Unexpected error when determining dtype: {e}")
     return np.float32
 
+def output_dtype(dtype):
+    """Return the dtype get_dtype assigns to the elements of a numpy array of a given dtype."""
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return np.float64
+    if dtype == np.int8:
+        return np.int8
+    if dtype.kind in "iub":
+        return np.int32
+    return dtype
+
 def convert_rvec_to_numpy(rvec):
     """Convert ROOT RVec to a numpy array with appropriate dtype."""
     dtype = get_dtype(rvec)
@@ -37,6 +48,71 @@ def convert_rvec_to_numpy(rvec):
         logging.error(f"rvec[0]: {repr(rvec[0])}")
         exit(1)
 
+def build_offsets(lengths):
+    """Build CSR offsets from per-event lengths, rows of event i are offsets[i]:offsets[i+1]."""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+def build_event_index(event_number, offsets):
+    """Build an index sorted by eventNumber holding the row range and the position in the file of each event."""
+    order = np.argsort(event_number, kind="stable")
+    index = np.empty(len(order), dtype=[("eventNumber", np.asarray(event_number).dtype), ("start", np.int64), ("stop", np.int64), ("event", np.int64)])
+    index["eventNumber"] = np.asarray(event_number)[order]
+    index["start"] = offsets[:-1][order]
+    index["stop"] = offsets[1:][order]
+    index["event"] = order
+    return index
+
+def flatten_arrays(arrays):
+    """Concatenate a list of per-row arrays into flat values and per-row lengths."""
+    lengths = np.fromiter((len(a) for a in arrays), dtype=np.int64, count=len(arrays))
+    if len(arrays) == 0:
+        return np.array([], dtype=np.float32), lengths
+    return np.concatenate(arrays), lengths
+
+def select_jagged(flat, lengths, mask):
+    """Apply a flat boolean mask to jagged data and return the selected values and new lengths."""
+    selected_before = np.zeros(len(mask) + 1, dtype=np.int64)
+    np.cumsum(mask, out=selected_before[1:])
+    offsets = build_offsets(lengths)
+    return flat[mask], selected_before[offsets[1:]] - selected_before[offsets[:-1]]
+
+def gather_jagged(flat, lengths, indices, index_lengths, repeat_count):
+    """Gather per-event jagged values with per-object indices into the collection of each event.
+
+    The objects of event i are the repeat_count[i] consecutive rows described by index_lengths.
+    An index outside of the values of its event raises an IndexError, it is never read from another event.
+    """
+    event_starts = np.repeat(build_offsets(lengths)[:-1], repeat_count)
+    event_lengths = np.repeat(np.repeat(lengths, repeat_count), index_lengths)
+    indices = indices.astype(np.int64)
+    out_of_range = (indices < 0) | (indices >= event_lengths)
+    if out_of_range.any():
+        first = np.flatnonzero(out_of_range)[0]
+        raise IndexError(
+            f"{out_of_range.sum()} link indices are outside of their event, "
+            f"e.g. index {indices[first]} into an event with {event_lengths[first]} values"
+        )
+    global_indices = indices + np.repeat(event_starts, index_lengths)
+    return flat[global_indices], index_lengths
+
+def pad_indices(lengths, max_size):
+    """Return the row, column and flat position of every value kept when padding jagged data to max_size."""
+    kept = np.minimum(lengths, max_size)
+    rows = np.repeat(np.arange(len(lengths)), kept)
+    columns = np.arange(kept.sum()) - np.repeat(build_offsets(kept)[:-1], kept)
+    return rows, columns, np.repeat(build_offsets(lengths)[:-1], kept) + columns
+
+def pad_jagged(flat, lengths, max_size):
+    """Pad (or truncate) jagged data to a fixed size per row and return it with the valid mask."""
+    rows, columns, positions = pad_indices(lengths, max_size)
+    padded = np.zeros((len(lengths), max_size), dtype=flat.dtype)
+    padded[rows, columns] = flat[positions]
+    valid = np.zeros((len(lengths), max_size), dtype=bool)
+    valid[rows, columns] = True
+    return padded, valid
+
 def fix_array_size(arrays, max_size):
     """Ensure all arrays are of the maximum specified size, pad with NaN where necessary."""
     if len(arrays) == 0:
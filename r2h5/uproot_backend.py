@@ -0,0 +1,64 @@
+import logging
+import numpy as np
+from r2h5.type import output_dtype
+
+# Size of the batches the columns shared by several outputs are read in, progress is reported after each
+PREFETCH_STEP_SIZE = "100 MB"
+
+class UprootSource:
+    """Read the branches of one input file with uproot as vectorized awkward arrays.
+
+    Used instead of an RDataFrame when the config needs no cpp_helpers or rdf_defines,
+    so neither ROOT nor cling are loaded.
+    """
+    def __init__(self, root_file, tree_name, max_events=None, entry_start=None):
+        import uproot
+        self.tree = uproot.open(root_file)[tree_name]
+        self.entry_start = entry_start
+        self.entry_stop = max_events
+        self._arrays = {}
+
+    def prefetch(self, columns, progress=None):
+        """Read several columns in one pass over the file and keep them until the source is released.
+
+        The file is read in batches of PREFETCH_STEP_SIZE, progress is called with the number of
+        events read after each of them.
+        """
+        import awkward as ak
+        logging.debug(f"Reading {len(columns)} columns with uproot")
+        batches = {column: [] for column in columns}
+        n_events = 0
+        for arrays in self.tree.iterate(columns, step_size=PREFETCH_STEP_SIZE, entry_start=self.entry_start, entry_stop=self.entry_stop, library="ak", how=dict):
+            for column, array in arrays.items():
+                batches[column].append(array)
+            n_events += len(next(iter(arrays.values()))) if arrays else 0
+            if progress is not None:
+                progress(n_events)
+        for column in columns:
+            self._arrays[column] = ak.concatenate(batches.pop(column)) if batches[column] else self._read(column)
+
+    def get_scalar(self, column):
+        """Return a scalar branch as a numpy array."""
+        import awkward as ak
+        return ak.to_numpy(self._read(column))
+
+    def get_jagged(self, column):
+        """Return a vector branch as flat values, converted like the RDF backend, and lengths per event."""
+        import awkward as ak
+        array = self._read(column)
+        flat = ak.to_numpy(ak.flatten(array, axis=1))
+        lengths = ak.to_numpy(ak.num(array, axis=1)).astype(np.int64)
+        return flat.astype(output_dtype(flat.dtype), copy=False), lengths
+
+    def get_link(self, column):
+        """Return a vector<vector<int>> branch as flat indices and the number of indices per object."""
+        import awkward as ak
+        array = self._read(column)
+        indices = ak.to_numpy(ak.flatten(array, axis=None)).astype(np.int64)
+        index_lengths = ak.to_numpy(ak.flatten(ak.num(array, axis=2), axis=None)).astype(np.int64)
+        return indices, index_lengths
+
+    def _read(self, column):
+        if column in self._arrays:
+            return self._arrays[column]
+        return self.tree[column].array(entry_start=self.entry_start, entry_stop=self.entry_stop, library="ak")
@@ -0,0 +1,63 @@
+import logging
+import queue
+import threading
+
+_STOP = object()
+
+class BackgroundWriter:
+    """Run H5 write calls in order on a background thread, fed by a bounded queue.
+
+    The queue depth caps the number of extracted blocks waiting in memory. With a depth of 0
+    the writes are done synchronously in the calling thread.
+    """
+    def __init__(self, queue_depth=2):
+        self.queue_depth = queue_depth
+        self._queue = queue.Queue(maxsize=max(queue_depth, 1))
+        self._thread = None
+        self._error = None
+
+    def __enter__(self):
+        if self.queue_depth > 0:
+            self._thread = threading.Thread(target=self._run, name="r2h5-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_error=exc_type is None)
+        return False
+
+    def submit(self, write_function, *args):
+        """Queue a write call, blocking while the queue is full."""
+        if self._thread is None:
+            write_function(*args)
+            return
+        self._raise_error()
+        self._queue.put((write_function, args))
+
+    def close(self, raise_error=True):
+        """Wait for all queued writes to finish."""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        if raise_error:
+            self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            if self._error is not None:
+                # Drain the queue without writing after a failure, the error is raised in the main thread
+                continue
+            write_function, args = item
+            try:
+                write_function(*args)
+            except Exception as e:
+                logging.error(f"Background H5 write failed: {e}")
+                self._error = e
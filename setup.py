@@ -7,6 +7,8 @@ setup(
     entry_points={
         'console_scripts': [
             'r2h5=r2h5.cli:main',
+            'r2h5-inspect=r2h5.inventory:main',
+            'r2h5-index=r2h5.event_index:main',
         ],
     },
     install_requires=[
@@ -0,0 +1,92 @@
+import copy
+import os
+import h5py
+import numpy as np
+import pytest
+from r2h5 import read_fields
+from r2h5.config_parser import add_internal_settings
+from r2h5.converter import DatasetConverter
+
+N_EVENTS = 50
+
+def make_data():
+    rng = np.random.default_rng(1)
+    n_tracks = rng.integers(0, 8, N_EVENTS)
+    return {
+        "eventNumber": np.arange(N_EVENTS) * 7 + 3,
+        "trk_pt": [rng.random(n) for n in n_tracks],
+        "trk_sel": [rng.integers(0, 2, n) for n in n_tracks],
+    }
+
+class FakeDataFrame:
+    """Stand-in for an RDataFrame returning the columns of make_data."""
+    def __init__(self, data):
+        self.data = data
+
+    def AsNumpy(self, columns):
+        out = {}
+        for column in columns:
+            values = self.data[column]
+            if isinstance(values, np.ndarray):
+                out[column] = values
+            else:
+                out[column] = np.empty(len(values), dtype=object)
+                out[column][:] = values
+        return out
+
+def make_config(tmp_path, tracks):
+    return add_internal_settings({
+        "input": {"root_file_list": ["fake.root"], "tree_name": "ntuple"},
+        "output": {"h5_path": str(tmp_path)},
+        "Objects": {"event": {"source_format": "scalar", "branches": ["eventNumber"]}},
+        "ObjectCollections": {"tracks": dict({"source_format": "vector", "branches": ["trk_pt"], "max_objects": 4}, **tracks)},
+    })
+
+def make_converter(config, data, **kwargs):
+    converter = DatasetConverter(copy.deepcopy(config), **kwargs)
+    converter.define_plan = []
+    converter._open_input = lambda root_file, entry_range=None: FakeDataFrame(data)
+    # The fake dataframe has no C++ event loop to count
+    converter._as_numpy_with_progress = lambda df, columns: df.AsNumpy(columns=columns)
+    return converter
+
+@pytest.fixture
+def output_file(tmp_path):
+    config = make_config(tmp_path, {"selection": "trk_sel"})
+    output_file = os.path.join(tmp_path, "output_000.h5")
+    converter = make_converter(config, make_data())
+    converter._root_to_h5(df=FakeDataFrame(make_data()), output_file_name=output_file, config=converter.output_configs[0])
+    return output_file
+
+def test_add_fields_lines_up_with_the_stored_rows(tmp_path, output_file):
+    config = make_config(tmp_path, {"selection": "trk_sel", "derived": {"trk_pt3": "trk_pt * 3"}})
+    make_converter(config, make_data(), add_fields=True)._add_fields("fake.root", [output_file])
+
+    with h5py.File(output_file, "r") as h5f:
+        tracks = read_fields(h5f, "tracks")
+    np.testing.assert_allclose(tracks["trk_pt3"][tracks["valid"]], 3 * tracks["trk_pt"][tracks["valid"]])
+
+def test_add_fields_refuses_a_changed_selection(tmp_path, output_file):
+    with h5py.File(output_file, "r") as h5f:
+        before = read_fields(h5f, "tracks")
+    # Same padded shape, but other objects fill the rows without the selection
+    config = make_config(tmp_path, {"derived": {"trk_pt3": "trk_pt * 3"}})
+
+    with pytest.raises(SystemExit):
+        make_converter(config, make_data(), add_fields=True)._add_fields("fake.root", [output_file])
+
+    assert not os.path.exists(f"{output_file}.added.tmp")
+    with h5py.File(output_file, "r") as h5f:
+        after = read_fields(h5f, "tracks")
+    assert after.dtype == before.dtype
+    np.testing.assert_array_equal(after, before)
+
+def test_add_fields_refuses_events_in_another_order(tmp_path, output_file):
+    data = make_data()
+    order = np.arange(N_EVENTS)[::-1]
+    reordered = {column: values[order] if isinstance(values, np.ndarray) else [values[i] for i in order] for column, values in data.items()}
+    config = make_config(tmp_path, {"selection": "trk_sel", "derived": {"trk_pt3": "trk_pt * 3"}})
+
+    with pytest.raises(SystemExit):
+        make_converter(config, reordered, add_fields=True)._add_fields("fake.root", [output_file])
+    assert not os.path.exists(f"{output_file}.added.tmp")
@@ -0,0 +1,28 @@
+import numpy as np
+from r2h5 import derived, multiplicity
+from r2h5.config_parser import add_internal_settings
+from r2h5.converter import DatasetConverter
+
+def test_evaluate_broadcasts_constant_fields_to_size():
+    results = derived.evaluate({"one": "1.0", "pt2": "pt * 2"}, {"pt": np.array([1.0, 2.0, 3.0])}, size=3)
+
+    np.testing.assert_array_equal(results["one"], [1.0, 1.0, 1.0])
+    np.testing.assert_array_equal(results["pt2"], [2.0, 4.0, 6.0])
+
+def test_constant_derived_field_has_one_value_per_row_of_the_branches(tmp_path):
+    config = add_internal_settings({
+        "input": {"root_file_list": ["fake.root"], "tree_name": "ntuple"},
+        "output": {"h5_path": str(tmp_path)},
+        "ObjectCollections": {"tracks": {"source_format": "vector", "branches": ["trk_pt"], "max_objects": 4, "derived": {"one": "1.0"}}},
+    })
+    converter = DatasetConverter(config)
+    objcol_config = converter.output_configs[0]["ObjectCollections"]["tracks"]
+
+    results = converter._evaluate_derived("tracks", objcol_config, {"trk_pt": np.array([0.5, 1.5, 2.5, 3.5])})
+
+    np.testing.assert_array_equal(results["one"], np.ones(4))
+
+def test_derived_itemsizes_follow_the_output_dtypes():
+    itemsizes = multiplicity.derived_itemsizes({"pt2": "pt * 2", "positive": "q > 0", "one": "1.0"}, {"pt": 8, "q": 4})
+
+    assert itemsizes == {"pt2": 8, "positive": 4, "one": 8}
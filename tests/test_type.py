@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from r2h5.type import flatten_arrays, gather_jagged
+
+def repeat_vectors(data_list, counts):
+    """Per-event gather of the original converter, each object indexes its own event's values."""
+    repeated = []
+    for i in range(len(counts)):
+        repeated.extend([data_list[i]] * counts[i])
+    return repeated
+
+def test_gather_jagged_matches_per_event_gather():
+    rng = np.random.default_rng(0)
+    values = [rng.random(n) for n in rng.integers(0, 8, 50)]
+    repeat_count = rng.integers(0, 4, len(values))
+    links = [rng.integers(0, len(v), rng.integers(0, len(v) + 1)) for v, count in zip(values, repeat_count) for _ in range(count)]
+    expected = [v[idx] for v, idx in zip(repeat_vectors(values, repeat_count), links)]
+
+    flat, lengths = flatten_arrays(values)
+    indices, index_lengths = flatten_arrays([idx.astype(np.int64) for idx in links]) if links else (np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+    gathered, gathered_lengths = gather_jagged(flat, lengths, indices, index_lengths, repeat_count)
+
+    assert list(gathered_lengths) == [len(e) for e in expected]
+    np.testing.assert_array_equal(gathered, np.concatenate(expected) if expected else [])
+
+@pytest.mark.parametrize("bad_index", [-1, 2])
+def test_gather_jagged_rejects_indices_outside_of_their_event(bad_index):
+    flat, lengths = flatten_arrays([np.array([1.0, 2.0]), np.array([3.0, 4.0])])
+    # One object per event, the one of event 1 points outside of it
+    with pytest.raises(IndexError):
+        gather_jagged(flat, lengths, np.array([0, bad_index]), np.array([1, 1]), np.array([1, 1]))